@@ -0,0 +1,174 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from benchmarks.local_mongo import LocalMongoClient
+from benchmarks.round_trip_counter import RoundTripCounter
+from benchmarks.synthetic_catalog import PAGE_SIZE, SyntheticCatalogTransport
+from pricehistory.db_client import DBClient
+from pricehistory.constants import PRODUCTS_QUERIES, QUERY_PROFILE_PRICES
+from pricehistory.logger_util import LoggerUtil
+from pricehistory.metrics_util import MetricsUtil
+from pricehistory.rate_limiter import RateLimiter
+from pricehistory.receny_util import RecencyUtil
+from pricehistory.source_client import SourceClient
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+PRODUCTS_PER_CATEGORY = 1_000
+BENCHMARK_DATABASE_NAME = "price_history_benchmark"
+
+
+def _get_peak_rss_mib() -> float:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes while macOS reports bytes
+    return peak_rss / 2**20 if sys.platform == "darwin" else peak_rss / 2**10
+
+
+def run_benchmark(
+    num_products: int,
+    runs: int,
+    concurrency: int,
+    mongo_url: Optional[str] = None,
+    write_buffer_size: int = 0,
+    query_profile: str = QUERY_PROFILE_PRICES,
+) -> list:
+    """
+    Crawls a synthetic catalog without the live API and measures every run.
+
+    The first run starts from an empty database and later runs only see a small fraction of prices change, so
+    comparing them shows both the cold and the steady-state cost of a crawl.
+    """
+    num_categories = max(1, num_products // PRODUCTS_PER_CATEGORY)
+    transport = SyntheticCatalogTransport(num_products=num_products, num_categories=num_categories)
+    logger_util = LoggerUtil(level=logging.WARNING)
+
+    if mongo_url:
+        db_client = DBClient(
+            db_connection_string=mongo_url, logger_util=logger_util, database_name=BENCHMARK_DATABASE_NAME
+        )
+        db_client.client.drop_database(BENCHMARK_DATABASE_NAME)
+        db_client = DBClient(
+            db_connection_string=mongo_url,
+            logger_util=logger_util,
+            database_name=BENCHMARK_DATABASE_NAME,
+            write_buffer_size=write_buffer_size,
+        )
+    else:
+        db_client = DBClient(
+            db_connection_string="",
+            logger_util=logger_util,
+            mongo_client=LocalMongoClient(),
+            write_buffer_size=write_buffer_size,
+        )
+    counter = RoundTripCounter()
+    counter.instrument(db_client)
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for run_number in range(runs):
+            transport.start_run(run_number)
+            transport.num_pages = 0
+            counter.reset()
+            metrics_util = MetricsUtil()
+
+            recency_util = RecencyUtil(
+                recency_file_path=os.path.join(temp_dir, f"recency_{run_number}.journal"),
+                legacy_recency_file_path=None,
+            )
+            source_client = SourceClient(
+                api_url="http://localhost",
+                store_ids=[1],
+                categories=transport.categories,
+                cookies={},
+                db_client=db_client,
+                recency_util=recency_util,
+                logger_util=logger_util,
+                rate_limiter=RateLimiter(requests_per_minute=None, jitter_seconds=0),
+                transport=transport,
+                metrics_util=metrics_util,
+                query_profile=query_profile,
+            )
+
+            start_time = time.perf_counter()
+            asyncio.run(source_client.process_all_categories_async(concurrency=concurrency))
+            elapsed_seconds = time.perf_counter() - start_time
+            # Counted per category, so they are added up here
+            response_bytes = sum(metrics_util.summary()["counters"].get("response_bytes", {}).values())
+
+            results.append(
+                {
+                    "products": num_products,
+                    "run": run_number,
+                    "pages": transport.num_pages,
+                    "seconds": elapsed_seconds,
+                    "pages_per_second": transport.num_pages / elapsed_seconds,
+                    "mongo_round_trips": counter.mongo,
+                    "redis_round_trips": counter.redis,
+                    "mongo_round_trips_per_page": counter.mongo / max(1, transport.num_pages),
+                    "response_kib_per_page": response_bytes / 1024 / max(1, transport.num_pages),
+                    # Peak memory of the whole benchmark process so far, which only ever grows between runs
+                    "peak_rss_mib": _get_peak_rss_mib(),
+                }
+            )
+
+    if mongo_url:
+        db_client.client.drop_database(BENCHMARK_DATABASE_NAME)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs SourceClient over synthetic catalogs without the live API")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Catalog sizes in products")
+    parser.add_argument("--runs", type=int, default=2, help="Crawls per catalog; runs after the first are warm")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--mongo-url", help="Use this MongoDB server instead of the in-memory stand-in")
+    parser.add_argument(
+        "--write-buffer-size", type=int, default=0, help="Buffer this many writes before flushing, 0 writes every page"
+    )
+    parser.add_argument(
+        "--query-profile", choices=list(PRODUCTS_QUERIES), default=QUERY_PROFILE_PRICES, help="Fields to ask for"
+    )
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    all_results = []
+    for num_products in args.sizes:
+        # A fresh process per catalog size keeps the peak memory of one size from hiding the next
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results = executor.submit(
+                run_benchmark,
+                num_products,
+                args.runs,
+                args.concurrency,
+                args.mongo_url,
+                args.write_buffer_size,
+                args.query_profile,
+            ).result()
+
+        for result in results:
+            print(
+                f"{result['products']:>7} products, run {result['run']}: {result['pages']} pages of {PAGE_SIZE} in "
+                f"{result['seconds']:.2f}s ({result['pages_per_second']:.1f} pages/s), "
+                f"{result['mongo_round_trips']} Mongo / {result['redis_round_trips']} Redis round trips "
+                f"({result['mongo_round_trips_per_page']:.2f} Mongo per page), "
+                f"{result['response_kib_per_page']:.1f} KiB per response, "
+                f"peak RSS {result['peak_rss_mib']:.1f} MiB"
+            )
+            all_results.append(result)
+
+    if args.output:
+        with open(args.output, mode="w", encoding="utf-8") as output_file:
+            json.dump(all_results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
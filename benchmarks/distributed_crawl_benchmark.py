@@ -0,0 +1,131 @@
+import argparse
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+from typing import Optional
+
+import redis
+from fakeredis import TcpFakeServer
+
+from benchmarks.local_mongo import LocalMongoClient
+from benchmarks.synthetic_catalog import PAGE_SIZE, SyntheticCatalogTransport
+from pricehistory.constants import RECENCY_CATEGORY_COMPLETE
+from pricehistory.crawl_worker import CrawlWorker
+from pricehistory.db_client import DBClient
+from pricehistory.logger_util import LoggerUtil
+from pricehistory.rate_limiter import RateLimiter
+from pricehistory.redis_recency_util import RedisRecencyUtil
+from pricehistory.source_client import SourceClient
+from pricehistory.work_queue import WorkQueue
+
+PRODUCTS_PER_CATEGORY = 1_000
+PAGES_COUNTER_KEY = "benchmark_pages"
+
+
+class _CountingTransport(SyntheticCatalogTransport):
+    # Counts pages in Redis so pages fetched by a worker that was killed are still counted
+    def __init__(self, cache: redis.Redis, kill_after_pages: Optional[int], **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+        self.kill_after_pages = kill_after_pages
+
+    def load_response(self, category_id: str, store_id: str, cursor: Optional[str]) -> dict:
+        if self.kill_after_pages is not None and self.num_pages >= self.kill_after_pages:
+            # Die without releasing the lease, like a worker whose machine went away
+            os._exit(1)
+        self.cache.incr(PAGES_COUNTER_KEY)
+        return super().load_response(category_id, store_id, cursor)
+
+
+def run_worker(redis_url: str, num_products: int, lease_seconds: float, kill_after_pages: Optional[int]):
+    cache = redis.Redis.from_url(redis_url)
+    logger_util = LoggerUtil(level=logging.WARNING)
+    transport = _CountingTransport(
+        cache=cache,
+        kill_after_pages=kill_after_pages,
+        num_products=num_products,
+        num_categories=max(1, num_products // PRODUCTS_PER_CATEGORY),
+    )
+    # Each worker has its own in-memory database, the benchmark is about how the work is shared out
+    db_client = DBClient(db_connection_string="", logger_util=logger_util, mongo_client=LocalMongoClient(), cache=cache)
+    source_client = SourceClient(
+        api_url="http://localhost",
+        store_ids=[1],
+        categories=transport.categories,
+        cookies={},
+        db_client=db_client,
+        recency_util=RedisRecencyUtil(cache),
+        logger_util=logger_util,
+        rate_limiter=RateLimiter(requests_per_minute=None, jitter_seconds=0),
+        transport=transport,
+    )
+    crawl_worker = CrawlWorker(
+        source_client=source_client, work_queue=WorkQueue(cache, lease_seconds=lease_seconds), logger_util=logger_util
+    )
+
+    async def run_async():
+        async with source_client.client as session:
+            await crawl_worker.run_async(session, exit_when_idle=True)
+
+    asyncio.run(run_async())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Crawls a synthetic catalog with several worker processes sharing one in-memory Redis server"
+    )
+    parser.add_argument("--products", type=int, default=20_000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--lease-seconds", type=float, default=2)
+    parser.add_argument(
+        "--kill-after-pages", type=int, help="Kill the first worker after this many pages to show its work taken over"
+    )
+    args = parser.parse_args()
+
+    server = TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    redis_url = f"redis://127.0.0.1:{server.server_address[1]}"
+    cache = redis.Redis.from_url(redis_url)
+
+    num_categories = max(1, args.products // PRODUCTS_PER_CATEGORY)
+    category_sizes = [len(range(i, args.products, num_categories)) for i in range(num_categories)]
+    min_pages = sum(max(1, math.ceil(size / PAGE_SIZE)) for size in category_sizes)
+    WorkQueue(cache).start_cycle([(1, category_id) for category_id in range(1, num_categories + 1)])
+
+    start_time = time.perf_counter()
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=run_worker,
+            args=(redis_url, args.products, args.lease_seconds, args.kill_after_pages if i == 0 else None),
+        )
+        for i in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed_seconds = time.perf_counter() - start_time
+
+    recency_util = RedisRecencyUtil(cache)
+    num_complete = sum(
+        1
+        for category_id in range(1, num_categories + 1)
+        if recency_util.get_category_after_cursor(category_id) == RECENCY_CATEGORY_COMPLETE
+    )
+    num_pages = int(cache.get(PAGES_COUNTER_KEY) or 0)
+    print(
+        f"{args.workers} workers crawled {num_complete} of {num_categories} categories in {elapsed_seconds:.2f}s: "
+        f"{num_pages} pages fetched for {min_pages} pages in the catalog, "
+        f"{WorkQueue(cache).num_items()} categories left in the queue, "
+        f"worker exit codes {[process.exitcode for process in processes]}"
+    )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
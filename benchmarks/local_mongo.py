@@ -0,0 +1,532 @@
+import copy
+import itertools
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional
+
+import pymongo
+from bson import ObjectId
+from pymongo.operations import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+
+_MISSING = object()
+
+
+@dataclass
+class WriteResult:
+    inserted_count: int = 0
+    matched_count: int = 0
+    modified_count: int = 0
+    deleted_count: int = 0
+    upserted_count: int = 0
+    upserted_id: Any = None
+
+    @property
+    def acknowledged(self) -> bool:
+        return True
+
+
+def _get_field(document: dict, field: str):
+    value = document
+    for part in field.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _set_field(document: dict, field: str, value):
+    parts = field.split(".")
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def _sort_key(value):
+    # Mongo orders missing and null values before everything else
+    if value is _MISSING or value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, value)
+
+
+def _matches_condition(value, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        for operator, operand in condition.items():
+            if operator == "$in":
+                if value is _MISSING:
+                    value = None
+                if value not in operand:
+                    return False
+            elif operator == "$nin":
+                if value in operand:
+                    return False
+            elif operator == "$ne":
+                if (None if value is _MISSING else value) == operand:
+                    return False
+            elif operator == "$exists":
+                if (value is not _MISSING) != bool(operand):
+                    return False
+            elif operator in ("$gt", "$gte", "$lt", "$lte"):
+                if value is _MISSING or value is None:
+                    return False
+                if operator == "$gt" and not value > operand:
+                    return False
+                if operator == "$gte" and not value >= operand:
+                    return False
+                if operator == "$lt" and not value < operand:
+                    return False
+                if operator == "$lte" and not value <= operand:
+                    return False
+            else:
+                raise NotImplementedError(f"Unsupported query operator {operator}")
+        return True
+
+    if value is _MISSING:
+        return condition is None
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    return value == condition
+
+
+def _matches(document: dict, query: Optional[dict]) -> bool:
+    if not query:
+        return True
+
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(_matches(document, sub_query) for sub_query in condition):
+                return False
+        elif field == "$and":
+            if not all(_matches(document, sub_query) for sub_query in condition):
+                return False
+        elif not _matches_condition(_get_field(document, field), condition):
+            return False
+    return True
+
+
+def _sort_documents(documents: List[dict], sort) -> List[dict]:
+    for field, direction in reversed(list(sort)):
+        documents.sort(key=lambda document: _sort_key(_get_field(document, field)), reverse=direction < 0)
+    return documents
+
+
+def _project(document: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return copy.deepcopy(document)
+
+    include = {field for field, flag in projection.items() if flag}
+    if include:
+        projected = {field: copy.deepcopy(document[field]) for field in include if field in document}
+        if projection.get("_id", 1) and "_id" in document:
+            projected["_id"] = document["_id"]
+        return projected
+
+    return {field: copy.deepcopy(value) for field, value in document.items() if projection.get(field, 1)}
+
+
+class Cursor:
+    def __init__(self, documents: Iterable[dict], projection: Optional[dict] = None):
+        self._documents = list(documents)
+        self._projection = projection
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=None):
+        sort = [(key_or_list, direction or pymongo.ASCENDING)] if isinstance(key_or_list, str) else key_or_list
+        _sort_documents(self._documents, sort)
+        return self
+
+    def skip(self, skip: int):
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size: int):
+        return self
+
+    def __iter__(self):
+        stop = self._skip + self._limit if self._limit else None
+        documents = itertools.islice(self._documents, self._skip, stop)
+        return (_project(document, self._projection) for document in documents)
+
+
+class _Admin:
+    def command(self, command: str, *args, **kwargs):
+        return {"ok": 1.0}
+
+
+class LocalCollection:
+    """
+    An in-memory collection implementing the subset of the pymongo Collection API that DBClient uses.
+
+    Equality and $in lookups on indexed fields are served from a hash index, so large catalogs do not degrade into a
+    full scan per query.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._documents: Dict[Any, dict] = {}
+        self._indexes: Dict[str, Dict[Any, set]] = {}
+
+    # Indexes
+
+    def create_index(self, keys, **kwargs) -> str:
+        field, direction = keys[0] if isinstance(keys, list) else (keys, pymongo.ASCENDING)
+        if direction in (pymongo.ASCENDING, pymongo.DESCENDING) and field not in self._indexes:
+            index = defaultdict(set)
+            for document_id, document in self._documents.items():
+                for value in self._index_values(document, field):
+                    index[value].add(document_id)
+            self._indexes[field] = index
+        return "_".join(f"{key}_{value}" for key, value in (keys if isinstance(keys, list) else [(keys, 1)]))
+
+    @staticmethod
+    def _index_values(document: dict, field: str) -> list:
+        value = _get_field(document, field)
+        if value is _MISSING:
+            return [None]
+        # Like a multikey index, an array is indexed under each of its elements
+        return list(value) if isinstance(value, list) else [value]
+
+    def _add_to_indexes(self, document: dict):
+        for field, index in self._indexes.items():
+            for value in self._index_values(document, field):
+                index[value].add(document["_id"])
+
+    def _remove_from_indexes(self, document: dict):
+        for field, index in self._indexes.items():
+            for value in self._index_values(document, field):
+                document_ids = index.get(value)
+                if document_ids is not None:
+                    document_ids.discard(document["_id"])
+
+    def _candidates(self, query: Optional[dict]) -> Iterable[dict]:
+        for field, condition in (query or {}).items():
+            if field == "_id" and not isinstance(condition, dict):
+                document = self._documents.get(condition)
+                return [document] if document is not None else []
+
+            index = self._indexes.get(field)
+            if index is None:
+                continue
+            if isinstance(condition, dict) and set(condition) == {"$in"}:
+                document_ids = set().union(*(index.get(value, ()) for value in condition["$in"]))
+            elif not isinstance(condition, (dict, list)):
+                document_ids = index.get(condition, ())
+            else:
+                continue
+            return [self._documents[document_id] for document_id in document_ids]
+
+        return list(self._documents.values())
+
+    def _find(self, query: Optional[dict]) -> List[dict]:
+        return [document for document in self._candidates(query) if _matches(document, query)]
+
+    # Reads
+
+    def find(self, filter: Optional[dict] = None, projection: Optional[dict] = None, sort=None, **kwargs) -> Cursor:
+        cursor = Cursor(self._find(filter), projection)
+        if sort:
+            cursor.sort(sort)
+        if kwargs.get("limit"):
+            cursor.limit(kwargs["limit"])
+        return cursor
+
+    def find_one(self, filter: Optional[dict] = None, projection: Optional[dict] = None, sort=None, **kwargs):
+        for document in self.find(filter, projection, sort=sort).limit(1):
+            return document
+        return None
+
+    def count_documents(self, filter: Optional[dict] = None, **kwargs) -> int:
+        return len(self._find(filter))
+
+    def estimated_document_count(self, **kwargs) -> int:
+        return len(self._documents)
+
+    def distinct(self, key: str, filter: Optional[dict] = None, **kwargs) -> list:
+        values = []
+        for document in self._find(filter):
+            value = _get_field(document, key)
+            if value is not _MISSING and value not in values:
+                values.append(value)
+        return values
+
+    def aggregate(self, pipeline: List[dict], **kwargs) -> Cursor:
+        documents = None
+        for stage in pipeline:
+            (operator, argument), *_ = stage.items()
+            if operator == "$match":
+                documents = (
+                    self._find(argument) if documents is None else [d for d in documents if _matches(d, argument)]
+                )
+                continue
+
+            if documents is None:
+                documents = list(self._documents.values())
+            if operator == "$sort":
+                documents = _sort_documents(list(documents), argument.items())
+            elif operator == "$group":
+                documents = self._group(documents, argument)
+            elif operator == "$limit":
+                documents = documents[:argument]
+            elif operator == "$project":
+                documents = [self._project_stage(document, argument) for document in documents]
+            elif operator == "$unwind":
+                field = argument[1:]
+                documents = [
+                    {**document, field: value}
+                    for document in documents
+                    for value in (_get_field(document, field) if isinstance(document.get(field), list) else [])
+                ]
+            else:
+                raise NotImplementedError(f"Unsupported aggregation stage {operator}")
+
+        return Cursor(documents if documents is not None else self._documents.values())
+
+    @staticmethod
+    def _project_stage(document: dict, projection: dict) -> dict:
+        # Unlike a find projection, a $project stage can compute fields from expressions
+        flags = {field: flag for field, flag in projection.items() if isinstance(flag, (bool, int))}
+        computed = {field: expression for field, expression in projection.items() if field not in flags}
+        if computed and not any(flags.values()):
+            # Computed fields make it an inclusion projection even without included fields
+            projected = {"_id": document["_id"]} if flags.get("_id", 1) and "_id" in document else {}
+        else:
+            projected = _project(document, flags)
+        for field, expression in computed.items():
+            projected[field] = LocalCollection._evaluate(expression, document)
+        return projected
+
+    @staticmethod
+    def _evaluate(expression, document: dict):
+        if isinstance(expression, str) and expression.startswith("$"):
+            value = _get_field(document, expression[1:])
+            return None if value is _MISSING else value
+        if isinstance(expression, dict) and list(expression) == ["$ifNull"]:
+            value, replacement = (LocalCollection._evaluate(value, document) for value in expression["$ifNull"])
+            return replacement if value is None else value
+        if isinstance(expression, dict):
+            return {key: LocalCollection._evaluate(value, document) for key, value in expression.items()}
+        return expression
+
+    def _group(self, documents: List[dict], specification: dict) -> List[dict]:
+        groups: Dict[Any, dict] = {}
+        for document in documents:
+            group_id = self._evaluate(specification["_id"], document)
+            group_key = tuple(sorted(group_id.items())) if isinstance(group_id, dict) else group_id
+            group = groups.get(group_key)
+            is_new_group = group is None
+            if is_new_group:
+                group = groups[group_key] = {"_id": group_id}
+
+            for field, accumulator in specification.items():
+                if field == "_id":
+                    continue
+                (operator, expression), *_ = accumulator.items()
+                value = self._evaluate(expression, document)
+                if operator == "$first":
+                    if is_new_group:
+                        group[field] = value
+                elif operator == "$last":
+                    group[field] = value
+                elif operator == "$sum":
+                    group[field] = group.get(field, 0) + (value or 0)
+                elif operator == "$min":
+                    if value is not None and (group.get(field) is None or value < group[field]):
+                        group[field] = value
+                    group.setdefault(field, None)
+                elif operator == "$max":
+                    if value is not None and (group.get(field) is None or value > group[field]):
+                        group[field] = value
+                    group.setdefault(field, None)
+                elif operator == "$push":
+                    group.setdefault(field, []).append(value)
+                else:
+                    raise NotImplementedError(f"Unsupported accumulator {operator}")
+
+        return list(groups.values())
+
+    # Writes
+
+    def _insert(self, document: dict) -> Any:
+        document = copy.deepcopy(document)
+        document.setdefault("_id", ObjectId())
+        self._documents[document["_id"]] = document
+        self._add_to_indexes(document)
+        return document["_id"]
+
+    def insert_one(self, document: dict, **kwargs) -> WriteResult:
+        return WriteResult(inserted_count=1, upserted_id=self._insert(document))
+
+    def insert_many(self, documents: Iterable[dict], **kwargs) -> WriteResult:
+        return WriteResult(inserted_count=sum(1 for document in documents if self._insert(document) is not None))
+
+    @staticmethod
+    def _apply_update(document: dict, update: dict, is_insert: bool):
+        for operator, fields in update.items():
+            for field, value in fields.items():
+                current = _get_field(document, field)
+                if operator == "$set":
+                    _set_field(document, field, copy.deepcopy(value))
+                elif operator == "$setOnInsert":
+                    if is_insert:
+                        _set_field(document, field, copy.deepcopy(value))
+                elif operator == "$inc":
+                    _set_field(document, field, (0 if current is _MISSING else current) + value)
+                elif operator == "$min":
+                    if current is _MISSING or value < current:
+                        _set_field(document, field, value)
+                elif operator == "$max":
+                    if current is _MISSING or value > current:
+                        _set_field(document, field, value)
+                elif operator == "$push":
+                    values = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                    _set_field(document, field, (list(current) if current is not _MISSING else []) + values)
+                elif operator == "$addToSet":
+                    values = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                    existing = list(current) if current is not _MISSING else []
+                    _set_field(document, field, existing + [v for v in values if v not in existing])
+                elif operator == "$unset":
+                    parts = field.split(".")
+                    parent = _get_field(document, ".".join(parts[:-1])) if len(parts) > 1 else document
+                    if isinstance(parent, dict):
+                        parent.pop(parts[-1], None)
+                else:
+                    raise NotImplementedError(f"Unsupported update operator {operator}")
+
+    def _update(self, filter: dict, update: dict, upsert: bool, many: bool) -> WriteResult:
+        matched = self._find(filter)
+        if not many:
+            matched = matched[:1]
+
+        result = WriteResult(matched_count=len(matched))
+        for document in matched:
+            before = copy.deepcopy(document)
+            self._remove_from_indexes(document)
+            self._apply_update(document, update, is_insert=False)
+            self._add_to_indexes(document)
+            if document != before:
+                result.modified_count += 1
+
+        if not matched and upsert:
+            document = {
+                field: value
+                for field, value in filter.items()
+                if not field.startswith("$") and not (isinstance(value, dict) and any(k.startswith("$") for k in value))
+            }
+            self._apply_update(document, update, is_insert=True)
+            result.upserted_id = self._insert(document)
+            result.upserted_count = 1
+
+        return result
+
+    def update_one(self, filter: dict, update: dict, upsert: bool = False, **kwargs) -> WriteResult:
+        return self._update(filter, update, upsert, many=False)
+
+    def update_many(self, filter: dict, update: dict, upsert: bool = False, **kwargs) -> WriteResult:
+        return self._update(filter, update, upsert, many=True)
+
+    def replace_one(self, filter: dict, replacement: dict, upsert: bool = False, **kwargs) -> WriteResult:
+        matched = self._find(filter)[:1]
+        for document in matched:
+            self._remove_from_indexes(document)
+            replacement = dict(copy.deepcopy(replacement), _id=document["_id"])
+            self._documents[document["_id"]] = replacement
+            self._add_to_indexes(replacement)
+            return WriteResult(matched_count=1, modified_count=1)
+
+        if upsert:
+            return WriteResult(upserted_count=1, upserted_id=self._insert(replacement))
+        return WriteResult()
+
+    def _delete(self, filter: dict, many: bool) -> WriteResult:
+        matched = self._find(filter)
+        if not many:
+            matched = matched[:1]
+
+        for document in matched:
+            self._remove_from_indexes(document)
+            del self._documents[document["_id"]]
+        return WriteResult(deleted_count=len(matched))
+
+    def delete_one(self, filter: dict, **kwargs) -> WriteResult:
+        return self._delete(filter, many=False)
+
+    def delete_many(self, filter: dict, **kwargs) -> WriteResult:
+        return self._delete(filter, many=True)
+
+    def bulk_write(self, requests: list, ordered: bool = True, **kwargs) -> WriteResult:
+        result = WriteResult()
+        for request in requests:
+            if isinstance(request, InsertOne):
+                self._insert(request._doc)
+                result.inserted_count += 1
+                continue
+
+            if isinstance(request, (UpdateOne, UpdateMany)):
+                partial = self._update(request._filter, request._doc, request._upsert, isinstance(request, UpdateMany))
+            elif isinstance(request, ReplaceOne):
+                partial = self.replace_one(request._filter, request._doc, request._upsert)
+            elif isinstance(request, (DeleteOne, DeleteMany)):
+                partial = self._delete(request._filter, isinstance(request, DeleteMany))
+            else:
+                raise NotImplementedError(f"Unsupported bulk operation {type(request).__name__}")
+
+            result.matched_count += partial.matched_count
+            result.modified_count += partial.modified_count
+            result.deleted_count += partial.deleted_count
+            result.upserted_count += partial.upserted_count
+
+        return result
+
+    def drop(self, **kwargs):
+        self._documents.clear()
+        for index in self._indexes.values():
+            index.clear()
+
+
+class LocalDatabase:
+    def __init__(self, name: str):
+        self.name = name
+        self._collections: Dict[str, LocalCollection] = {}
+
+    def __getitem__(self, name: str) -> LocalCollection:
+        if name not in self._collections:
+            self._collections[name] = LocalCollection(name)
+        return self._collections[name]
+
+    def list_collection_names(self, **kwargs) -> List[str]:
+        return list(self._collections)
+
+    def create_collection(self, name: str, **kwargs) -> LocalCollection:
+        return self[name]
+
+    def drop_collection(self, name: str, **kwargs):
+        self._collections.pop(name, None)
+
+
+class LocalMongoClient:
+    """
+    Stands in for pymongo's MongoClient so crawls can be benchmarked without a database server.
+    """
+
+    def __init__(self):
+        self.admin = _Admin()
+        self._databases: Dict[str, LocalDatabase] = {}
+
+    def __getitem__(self, name: str) -> LocalDatabase:
+        if name not in self._databases:
+            self._databases[name] = LocalDatabase(name)
+        return self._databases[name]
+
+    def drop_database(self, name: str):
+        self._databases.pop(name, None)
+
+    def close(self):
+        pass
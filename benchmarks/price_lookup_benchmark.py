@@ -0,0 +1,128 @@
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+import pymongo
+from pymongo import MongoClient, monitoring
+
+from pricehistory.data.price_container import PriceContainer
+from pricehistory.data.price_document import PriceDocument
+from pricehistory.data.product_document import ProductDocument
+from pricehistory.db_client import DBClient
+from pricehistory.logger_util import LoggerUtil
+
+PAGE_SIZE = 100
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def _seed_prices(db_client: DBClient, num_products: int, history_depth: int):
+    db_client.prices_collection.delete_many({})
+
+    start = datetime.today() - timedelta(days=history_depth)
+    documents = []
+    for product_id in range(num_products):
+        for day in range(history_depth):
+            documents.append(
+                {
+                    "product_id": product_id,
+                    "price_cents": random.randint(100, 2000),
+                    "start_date": start + timedelta(day),
+                }
+            )
+    db_client.prices_collection.insert_many(documents)
+
+
+def _build_page(num_products: int) -> list:
+    today = datetime.today()
+    price_containers = []
+    for product_id in random.sample(range(num_products), PAGE_SIZE):
+        price_containers.append(
+            PriceContainer(
+                product_document=ProductDocument(id=product_id, display_name=f"Product {product_id}", category=0),
+                price_document=PriceDocument(
+                    product_id=product_id, price_cents=random.randint(100, 2000), start_date=today
+                ),
+            )
+        )
+    return price_containers
+
+
+def _legacy_lookup(db_client: DBClient, price_containers: list) -> dict:
+    latest_prices = {}
+    for price_container in price_containers:
+        product_id = price_container.price_document.product_id
+        document = db_client.prices_collection.find_one(
+            filter={"product_id": product_id}, sort=[("start_date", pymongo.DESCENDING)]
+        )
+        if document:
+            latest_prices[product_id] = document["price_cents"]
+    return latest_prices
+
+
+def _measure(counter: CommandCounter, function, *args):
+    counter.count = 0
+    start = time.perf_counter()
+    result = function(*args)
+    return result, counter.count, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Counts database round trips per page for the latest price lookup")
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument("--products", type=int, default=10_000)
+    parser.add_argument("--history-depth", type=int, default=10)
+    parser.add_argument("--pages", type=int, default=20)
+    args = parser.parse_args()
+
+    counter = CommandCounter()
+    mongo_client = MongoClient(args.mongo_url, event_listeners=[counter])
+
+    with LoggerUtil() as logger_util:
+        db_client = DBClient(
+            db_connection_string=args.mongo_url,
+            logger_util=logger_util,
+            mongo_client=mongo_client,
+            database_name="price_history_benchmark",
+        )
+        _seed_prices(db_client, args.products, args.history_depth)
+
+        totals = {"legacy": [0, 0.0], "batched": [0, 0.0]}
+        for _ in range(args.pages):
+            page = _build_page(args.products)
+            legacy_prices, legacy_trips, legacy_seconds = _measure(counter, _legacy_lookup, db_client, page)
+            batched_prices, batched_trips, batched_seconds = _measure(
+                counter, db_client.get_latest_prices, [c.price_document.product_id for c in page]
+            )
+            if legacy_prices != batched_prices:
+                raise AssertionError("Batched lookup disagrees with the legacy lookup")
+
+            totals["legacy"][0] += legacy_trips
+            totals["legacy"][1] += legacy_seconds
+            totals["batched"][0] += batched_trips
+            totals["batched"][1] += batched_seconds
+
+        for name, (trips, seconds) in totals.items():
+            print(
+                f"{name}: {trips / args.pages:.1f} round trips/page, "
+                f"{seconds / args.pages * 1000:.1f} ms/page over {args.pages} page(s)"
+            )
+
+        mongo_client.drop_database("price_history_benchmark")
+
+
+if __name__ == "__main__":
+    main()
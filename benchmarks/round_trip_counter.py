@@ -0,0 +1,80 @@
+from collections import Counter
+
+from pricehistory.db_client import DBClient
+
+
+class _CountingProxy:
+    def __init__(self, target, counter: Counter, name: str):
+        self._target = target
+        self._counter = counter
+        self._name = name
+
+    def __getattr__(self, attribute: str):
+        value = getattr(self._target, attribute)
+        if attribute.startswith("_") or not callable(value):
+            return value
+
+        def counted(*args, **kwargs):
+            self._counter[self._name] += 1
+            return value(*args, **kwargs)
+
+        return counted
+
+
+class _CountingRedisProxy(_CountingProxy):
+    def pipeline(self, *args, **kwargs):
+        # Commands queued on a pipeline are sent together, so only executing the pipeline is a round trip
+        return _CountingPipelineProxy(self._target.pipeline(*args, **kwargs), self._counter, self._name)
+
+
+class _CountingPipelineProxy:
+    def __init__(self, pipeline, counter: Counter, name: str):
+        self._pipeline = pipeline
+        self._counter = counter
+        self._name = name
+
+    def __getattr__(self, attribute: str):
+        return getattr(self._pipeline, attribute)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._pipeline.reset()
+
+    def execute(self, *args, **kwargs):
+        self._counter[self._name] += 1
+        return self._pipeline.execute(*args, **kwargs)
+
+
+class RoundTripCounter:
+    """
+    Counts the calls DBClient makes to MongoDB and Redis, treating each call as one round trip.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def instrument(self, db_client: DBClient):
+        for attribute, value in list(vars(db_client).items()):
+            if attribute.endswith("_collection"):
+                setattr(db_client, attribute, _CountingProxy(value, self.counts, "mongo"))
+
+        # The helpers DBClient hands its Redis client to, like the search index, have to count through the same proxy
+        cache = db_client.cache
+        counting_cache = _CountingRedisProxy(cache, self.counts, "redis")
+        db_client.cache = counting_cache
+        for value in vars(db_client).values():
+            if getattr(value, "cache", None) is cache:
+                value.cache = counting_cache
+
+    def reset(self):
+        self.counts.clear()
+
+    @property
+    def mongo(self) -> int:
+        return self.counts["mongo"]
+
+    @property
+    def redis(self) -> int:
+        return self.counts["redis"]
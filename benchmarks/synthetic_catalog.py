@@ -0,0 +1,101 @@
+import random
+from typing import List, Optional
+
+from pricehistory.transport_util import ReplayTransport
+
+PAGE_SIZE = 100
+
+
+class SyntheticCatalogTransport(ReplayTransport):
+    """
+    Generates browseCategory pages for a made-up catalog instead of reading recorded fixtures.
+
+    Products are spread evenly over the categories. Each run (see `start_run`) keeps most prices the same and
+    changes a fraction of them, like a real store between crawls.
+    """
+
+    def __init__(self, num_products: int, num_categories: int, price_change_rate: float = 0.05, seed: int = 0):
+        super().__init__(fixtures_dir="")
+        self.num_products = num_products
+        self.num_categories = num_categories
+        self.price_change_rate = price_change_rate
+        self.seed = seed
+        self.run_number = 0
+
+        self.num_pages = 0
+
+    @property
+    def categories(self) -> List[int]:
+        return list(range(1, self.num_categories + 1))
+
+    def start_run(self, run_number: int):
+        self.run_number = run_number
+
+    def _get_product_ids(self, category_id: int) -> List[int]:
+        return list(range(category_id - 1, self.num_products, self.num_categories))
+
+    def _get_price_cents(self, product_id: int) -> int:
+        base_price = random.Random(self.seed * 1_000_003 + product_id).randint(100, 2000)
+        changes = sum(
+            1
+            for run_number in range(1, self.run_number + 1)
+            if random.Random(hash((self.seed, product_id, run_number))).random() < self.price_change_rate
+        )
+        return base_price + changes * 10
+
+    def _build_record(self, product_id: int) -> dict:
+        # Every field of the full query is filled in, so replaying the price-only profile shows its smaller pages
+        price_cents = self._get_price_cents(product_id)
+        formatted_price = f"${price_cents / 100:.2f}"
+        return {
+            "id": str(product_id),
+            "displayName": f"Product {product_id}",
+            "productImageUrls": [
+                {"size": size, "url": f"https://images.example.com/{size}/{product_id}.jpg"}
+                for size in ("SMALL", "MEDIUM", "LARGE")
+            ],
+            "bestAvailable": False,
+            "onAd": False,
+            "isNew": False,
+            "isComboLoco": False,
+            "deal": False,
+            "pricedByWeight": False,
+            "brand": {"name": f"Brand {product_id % 50}", "isOwnBrand": product_id % 5 == 0},
+            "SKUs": [
+                {
+                    "id": str(product_id),
+                    "contextPrices": [
+                        {
+                            "context": context,
+                            "isOnSale": False,
+                            "unitListPrice": {"unit": "oz", "formattedAmount": f"${price_cents / 1200:.2f}"},
+                            "priceType": "AVERAGE",
+                            "listPrice": {"unit": "each", "formattedAmount": formatted_price},
+                            "salePrice": None,
+                        }
+                        for context in ("CURBSIDE", "ONLINE")
+                    ],
+                    "productAvailability": ["IN_STORE", "CURBSIDE_PICKUP"],
+                    "customerFriendlySize": "12 oz",
+                    "skuPrice": {"listPrice": {"displayName": formatted_price}},
+                }
+            ],
+        }
+
+    def load_response(self, category_id: str, store_id: str, cursor: Optional[str]) -> dict:
+        product_ids = self._get_product_ids(int(category_id))
+        page_start = int(cursor) if cursor else 0
+        page_end = page_start + PAGE_SIZE
+        has_more_records = page_end < len(product_ids)
+
+        self.num_pages += 1
+        return {
+            "browseCategory": {
+                "pageTitle": f"Category {category_id}",
+                "records": [self._build_record(product_id) for product_id in product_ids[page_start:page_end]],
+                "total": len(product_ids),
+                "hasMoreRecords": has_more_records,
+                "nextCursor": str(page_end) if has_more_records else None,
+                "previousCursor": str(page_start),
+            }
+        }
@@ -1,69 +1,141 @@
-import json
+import argparse
 import logging
+from typing import Optional
 
-import redis
-import requests
-
-from pricehistory.constants import DB_CONNECTION_STRING
-from pricehistory.cookie_util import get_cookies
-from pricehistory.db_client import DBClient
+from pricehistory.config_util import load_config
+from pricehistory.crawl_service import CrawlService
 from pricehistory.logger_util import LoggerUtil
-from pricehistory.receny_util import RecencyUtil
-from pricehistory.source_client import SourceClient
-
+from pricehistory.price_export_util import PriceExporter
+from pricehistory.price_maintenance_util import PriceCompactor
 
 logging.basicConfig(level=logging.INFO)
 logging.getLogger("engineio.server").setLevel(logging.WARNING)
 logging.getLogger("socketio.server").setLevel(logging.WARNING)
 
 
-def main(logger_util: LoggerUtil):
-    with open("config.json") as config_file:
-        config_json = json.load(config_file)
-        api_url = config_json["apiUrl"]
-        categories = config_json["categories"]
-        cookie_url = config_json["cookieUrl"]
-        store_id = config_json["storeId"]
-        db_username = config_json["db_username"]
-        db_password = config_json["db_password"]
-        db_host = config_json["db_host"]
-        healthcheck_url = config_json["healthcheck_url"]
-        data_cache_url = config_json["data_cache_url"]
+def main(
+    logger_util: LoggerUtil,
+    rebuild_price_snapshot: bool = False,
+    backfill_price_buckets: bool = False,
+    daemon: bool = False,
+    coordinator: bool = False,
+    worker: bool = False,
+    exit_when_idle: bool = False,
+    export_prices_dir: Optional[str] = None,
+    rebuild_search_index: bool = False,
+    compact_prices: bool = False,
+    dry_run: bool = False,
+    drop_missing_prices: bool = False,
+):
+    crawl_service = CrawlService(config=load_config(), logger_util=logger_util)
 
-    if data_cache_url:
-        cache = redis.Redis.from_url(data_cache_url)
-        cache.ping()
-        logger_util.write("Using Redis cache for data")
-    else:
-        cache = None
+    if backfill_price_buckets:
+        crawl_service.db_client.backfill_price_buckets()
+        return
 
-    db_connection_string = DB_CONNECTION_STRING % (db_username, db_password, db_host)
-    db_client = DBClient(db_connection_string=db_connection_string, logger_util=logger_util, cache=cache)
+    if rebuild_price_snapshot:
+        crawl_service.db_client.rebuild_price_snapshot()
+        return
 
-    logger_util.write("Fetching cookies...")
-    cookies = get_cookies(cookie_url)
-    logger_util.write("Done fetching cookies")
+    if rebuild_search_index:
+        db_client = crawl_service.db_client
+        num_products = db_client.search_index.rebuild(db_client.products_collection)
+        logger_util.write(f"Rebuilt search index with {num_products} products")
+        return
 
-    recency_util = RecencyUtil()
-    recency_util.clean_records()
+    if compact_prices:
+        price_compactor = PriceCompactor(
+            db_client=crawl_service.db_client, logger_util=logger_util, drop_missing_prices=drop_missing_prices
+        )
+        price_compactor.run(dry_run=dry_run)
+        return
 
-    source_client = SourceClient(
-        api_url=api_url,
-        store_id=store_id,
-        categories=categories,
-        cookies=cookies,
-        db_client=db_client,
-        recency_util=recency_util,
-        logger_util=logger_util,
-    )
-    source_client.process_all_categories()
+    if export_prices_dir:
+        PriceExporter(db_client=crawl_service.db_client, export_dir=export_prices_dir, logger_util=logger_util).export()
+        return
 
-    logger_util.write("Pinging healthcheck URL...")
-    response = requests.get(healthcheck_url)
-    response.raise_for_status()
-    logger_util.write("Done!")
+    if coordinator:
+        crawl_service.run_coordinator(daemon=daemon)
+    elif worker:
+        crawl_service.run_worker(exit_when_idle=exit_when_idle)
+    elif daemon:
+        crawl_service.run_forever()
+    else:
+        crawl_service.run_once()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="pricehistory")
+    parser.add_argument(
+        "--rebuild-price-snapshot",
+        action="store_true",
+        help="Rebuild the last-known-price snapshot from the prices collection and exit",
+    )
+    parser.add_argument(
+        "--backfill-price-buckets",
+        action="store_true",
+        help="Copy the prices collection into monthly price buckets and exit",
+    )
+    parser.add_argument(
+        "--rebuild-search-index",
+        action="store_true",
+        help="Rebuild the product search index from the products collection and exit",
+    )
+    parser.add_argument(
+        "--compact-prices",
+        action="store_true",
+        help="Remove redundant and duplicate price documents in resumable batches and exit",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="With --compact-prices, only report what would be removed and how much space it would free",
+    )
+    parser.add_argument(
+        "--drop-missing-prices",
+        action="store_true",
+        help="With --compact-prices, also remove the prices saved while a product had no online price",
+    )
+    parser.add_argument(
+        "--export-prices",
+        metavar="DIR",
+        help="Export the prices saved since the last export and all products to NumPy files in DIR and exit",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and crawl every crawlIntervalMinutes, reusing the connections between crawls",
+    )
+    parser.add_argument(
+        "--coordinator",
+        action="store_true",
+        help="Queue every category in Redis for crawl workers instead of crawling and wait for them to finish, every "
+        "cycle with --daemon",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Crawl categories leased from the coordinator's queue until terminated",
+    )
+    parser.add_argument(
+        "--exit-when-idle",
+        action="store_true",
+        help="With --worker, exit once the queue is empty instead of waiting for the next cycle",
+    )
+    args = parser.parse_args()
+
     with LoggerUtil() as logger:
-        main(logger)
+        main(
+            logger,
+            rebuild_price_snapshot=args.rebuild_price_snapshot,
+            backfill_price_buckets=args.backfill_price_buckets,
+            daemon=args.daemon,
+            coordinator=args.coordinator,
+            worker=args.worker,
+            exit_when_idle=args.exit_when_idle,
+            export_prices_dir=args.export_prices,
+            rebuild_search_index=args.rebuild_search_index,
+            compact_prices=args.compact_prices,
+            dry_run=args.dry_run,
+            drop_missing_prices=args.drop_missing_prices,
+        )
@@ -0,0 +1,62 @@
+import threading
+from typing import Set
+
+import redis
+
+from pricehistory.constants import CACHE_INVALIDATION_BATCH_SIZE
+
+
+class CacheInvalidator:
+    """
+    Collects cache keys that need to be dropped and removes them together in one pipelined round trip.
+
+    Keys should only be added after the database write they depend on has gone through. By default the keys are
+    removed on every flush. When deferred, flushes only happen once enough keys have built up or when forced, so
+    several pages can share one round trip at the cost of the cache serving the old data for a little longer.
+    """
+
+    def __init__(
+        self, cache: redis.Redis, deferred: bool = False, max_pending_keys: int = CACHE_INVALIDATION_BATCH_SIZE
+    ):
+        self.cache = cache
+        self.deferred = deferred
+        self.max_pending_keys = max_pending_keys
+
+        self.pending_keys: Set[str] = set()
+        self.lock = threading.Lock()
+
+    def add(self, *keys: str):
+        with self.lock:
+            self.pending_keys.update(keys)
+
+    def flush(self, force: bool = False) -> int:
+        """
+        Removes the pending keys from the cache.
+
+        Args:
+            force: Flush even if invalidation is deferred and not enough keys have built up yet
+
+        Returns:
+            The number of keys that were removed
+        """
+        with self.lock:
+            if not self.pending_keys:
+                return 0
+            if self.deferred and not force and len(self.pending_keys) < self.max_pending_keys:
+                return 0
+
+            keys = list(self.pending_keys)
+            self.pending_keys.clear()
+
+        # UNLINK frees the memory in the background, so Redis does not block on large cached values
+        pipeline = self.cache.pipeline(transaction=False)
+        for i in range(0, len(keys), CACHE_INVALIDATION_BATCH_SIZE):
+            batch_end = i + CACHE_INVALIDATION_BATCH_SIZE
+            pipeline.unlink(*keys[i:batch_end])
+        try:
+            pipeline.execute()
+        except Exception:
+            # Keep the keys so the next flush tries again
+            self.add(*keys)
+            raise
+        return len(keys)
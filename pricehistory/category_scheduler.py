@@ -0,0 +1,137 @@
+import json
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from atomicwrites import atomic_write
+
+from pricehistory.constants import (
+    SCHEDULE_FILE_NAME,
+    SCHEDULER_CHANGE_THRESHOLD,
+    SCHEDULER_DEFAULT_PAGES,
+    SCHEDULER_MAX_INTERVAL_HOURS,
+    SCHEDULER_SMOOTHING,
+)
+from pricehistory.logger_util import LoggerUtil
+
+CrawlTarget = Tuple[int, int]
+
+
+class CategoryScheduler:
+    """
+    Decides which categories are worth crawling in a run based on how often their prices have changed before.
+
+    Each category keeps a smoothed rate of price changes per hour, learned from the new and changed prices of every
+    completed crawl. A category is due once the changes expected since its last crawl pass `change_threshold`, or
+    once it has not been crawled for `max_interval_hours`. When there is a request budget, the categories expected
+    to have the most changes are crawled first until their estimated pages use up the budget.
+    """
+
+    def __init__(
+        self,
+        logger_util: LoggerUtil,
+        schedule_file_path: str = SCHEDULE_FILE_NAME,
+        request_budget: Optional[int] = None,
+        change_threshold: float = SCHEDULER_CHANGE_THRESHOLD,
+        max_interval_hours: float = SCHEDULER_MAX_INTERVAL_HOURS,
+    ):
+        self.logger_util = logger_util
+        self.schedule_file_path = schedule_file_path
+        self.request_budget = request_budget
+        self.change_threshold = change_threshold
+        self.max_interval_hours = max_interval_hours
+
+        self.schedule: Dict[str, dict] = {}
+        if os.path.exists(self.schedule_file_path):
+            with open(self.schedule_file_path, mode="r", encoding="utf-8") as schedule_file:
+                self.schedule = json.load(schedule_file)
+
+    @staticmethod
+    def _get_key(store_id: int, category_id: int) -> str:
+        return f"{store_id}_{category_id}"
+
+    def _get_priority(self, store_id: int, category_id: int, now: datetime) -> float:
+        entry = self.schedule.get(self._get_key(store_id, category_id))
+        if entry is None:
+            # Nothing is known about the category yet, so learn about it first
+            return float("inf")
+
+        hours_since_crawl = (now - datetime.fromisoformat(entry["last_crawled"])).total_seconds() / 3600
+        if hours_since_crawl >= self.max_interval_hours:
+            return float("inf")
+
+        # The fraction of the category's prices expected to have changed since it was last crawled
+        return entry["change_rate"] * hours_since_crawl
+
+    def _get_estimated_pages(self, store_id: int, category_id: int) -> float:
+        entry = self.schedule.get(self._get_key(store_id, category_id))
+        return SCHEDULER_DEFAULT_PAGES if entry is None else entry["pages"]
+
+    def select(self, crawl_targets: List[CrawlTarget], in_progress: Set[CrawlTarget]) -> List[CrawlTarget]:
+        """
+        Picks the crawl targets for this run, most valuable first.
+
+        Args:
+            crawl_targets: Every (store ID, category ID) pair that could be crawled
+            in_progress: Targets an earlier run stopped part way through, which are always finished
+
+        Returns:
+            The targets to crawl
+        """
+        now = datetime.now()
+        priorities = {target: self._get_priority(*target, now) for target in crawl_targets}
+        due_targets = [
+            target for target in crawl_targets if target in in_progress or priorities[target] >= self.change_threshold
+        ]
+        due_targets.sort(key=lambda target: (target not in in_progress, -priorities[target]))
+
+        selected_targets = []
+        estimated_pages = 0.0
+        for target in due_targets:
+            target_pages = self._get_estimated_pages(*target)
+            within_budget = self.request_budget is None or estimated_pages + target_pages <= self.request_budget
+            # An unfinished category is always finished, and at least one category is crawled per run
+            if within_budget or target in in_progress or not selected_targets:
+                selected_targets.append(target)
+                estimated_pages += target_pages
+
+        self.logger_util.write(
+            f"Scheduled {len(selected_targets)} of {len(crawl_targets)} categories "
+            f"({len(due_targets)} due, about {estimated_pages:.0f} pages)"
+        )
+        return selected_targets
+
+    def record_crawl(self, store_id: int, category_id: int, num_prices: int, num_changed: int, num_pages: int):
+        """
+        Learns from a completed crawl of a category.
+
+        Args:
+            store_id: The ID of the store
+            category_id: The ID of the category
+            num_prices: How many prices were seen
+            num_changed: How many of them were new or changed
+            num_pages: How many pages were fetched
+        """
+        now = datetime.now()
+        key = self._get_key(store_id, category_id)
+        entry = self.schedule.get(key)
+        changed_fraction = num_changed / num_prices if num_prices else 0.0
+
+        if entry is None:
+            # Without an earlier crawl there is no interval to spread the changes over, so assume a day
+            self.schedule[key] = {
+                "change_rate": changed_fraction / 24,
+                "pages": num_pages,
+                "last_crawled": now.isoformat(),
+            }
+            return
+
+        hours_since_crawl = max(1.0, (now - datetime.fromisoformat(entry["last_crawled"])).total_seconds() / 3600)
+        change_rate = changed_fraction / hours_since_crawl
+        entry["change_rate"] = SCHEDULER_SMOOTHING * change_rate + (1 - SCHEDULER_SMOOTHING) * entry["change_rate"]
+        entry["pages"] = SCHEDULER_SMOOTHING * num_pages + (1 - SCHEDULER_SMOOTHING) * entry["pages"]
+        entry["last_crawled"] = now.isoformat()
+
+    def save(self):
+        with atomic_write(self.schedule_file_path, mode="w", encoding="utf-8", overwrite=True) as schedule_file:
+            json.dump(self.schedule, schedule_file, indent=2)
@@ -0,0 +1,105 @@
+import json
+import os
+from dataclasses import dataclass, fields
+from typing import List, Optional
+
+from pricehistory.constants import (
+    CONFIG_FILE_NAME,
+    DEFAULT_CRAWL_CONCURRENCY,
+    DEFAULT_CRAWL_INTERVAL_MINUTES,
+    DEFAULT_REQUESTS_PER_MINUTE,
+    PRICE_LAYOUT_DOCUMENTS,
+    PRODUCTS_QUERIES,
+    QUERY_PROFILE_PRICES,
+    WRITE_BUFFER_MAX_OPERATIONS,
+)
+
+
+@dataclass
+class Config:
+    api_url: str
+    categories: List[int]
+    cookie_url: str
+    store_ids: List[int]
+    db_username: str
+    db_password: str
+    db_host: str
+    healthcheck_url: str
+    data_cache_url: Optional[str]
+    crawl_concurrency: int = DEFAULT_CRAWL_CONCURRENCY
+    crawl_interval_minutes: float = DEFAULT_CRAWL_INTERVAL_MINUTES
+    requests_per_minute: Optional[float] = DEFAULT_REQUESTS_PER_MINUTE
+    log_level: str = "INFO"
+    dump_responses: bool = False
+    record_fixtures_dir: Optional[str] = None
+    replay_fixtures_dir: Optional[str] = None
+    metrics_file: Optional[str] = None
+    prometheus_file: Optional[str] = None
+    price_layout: str = PRICE_LAYOUT_DOCUMENTS
+    defer_cache_invalidation: bool = False
+    write_buffer_size: int = WRITE_BUFFER_MAX_OPERATIONS
+    adaptive_scheduling: bool = False
+    request_budget: Optional[int] = None
+    query_profile: str = QUERY_PROFILE_PRICES
+
+
+# Settings that are only read when the connections are opened, so changing them needs a restart of the daemon
+RESTART_REQUIRED_SETTINGS = (
+    "api_url",
+    "cookie_url",
+    "db_username",
+    "db_password",
+    "db_host",
+    "data_cache_url",
+    "record_fixtures_dir",
+    "replay_fixtures_dir",
+    "price_layout",
+)
+
+
+def load_config(config_file_path: str = CONFIG_FILE_NAME) -> Config:
+    with open(config_file_path) as config_file:
+        config_json = json.load(config_file)
+
+    # Checked here so a daemon keeps its current config rather than failing every page after a bad reload
+    query_profile = config_json.get("queryProfile", QUERY_PROFILE_PRICES)
+    if query_profile not in PRODUCTS_QUERIES:
+        raise ValueError(f"Unknown query profile {query_profile}")
+
+    return Config(
+        api_url=config_json["apiUrl"],
+        categories=config_json["categories"],
+        cookie_url=config_json["cookieUrl"],
+        # storeIds crawls several stores in one run, the single storeId is still read for older configs
+        store_ids=config_json.get("storeIds") or [config_json["storeId"]],
+        db_username=config_json["db_username"],
+        db_password=config_json["db_password"],
+        db_host=config_json["db_host"],
+        healthcheck_url=config_json["healthcheck_url"],
+        data_cache_url=config_json["data_cache_url"],
+        crawl_concurrency=config_json.get("crawlConcurrency", DEFAULT_CRAWL_CONCURRENCY),
+        crawl_interval_minutes=config_json.get("crawlIntervalMinutes", DEFAULT_CRAWL_INTERVAL_MINUTES),
+        requests_per_minute=config_json.get("requestsPerMinute", DEFAULT_REQUESTS_PER_MINUTE),
+        log_level=config_json.get("logLevel", "INFO"),
+        dump_responses=config_json.get("dumpResponses", False),
+        record_fixtures_dir=config_json.get("recordFixturesDir"),
+        replay_fixtures_dir=config_json.get("replayFixturesDir"),
+        metrics_file=config_json.get("metricsFile"),
+        prometheus_file=config_json.get("prometheusFile"),
+        price_layout=config_json.get("priceLayout", PRICE_LAYOUT_DOCUMENTS),
+        defer_cache_invalidation=config_json.get("deferCacheInvalidation", False),
+        write_buffer_size=config_json.get("writeBufferSize", WRITE_BUFFER_MAX_OPERATIONS),
+        adaptive_scheduling=config_json.get("adaptiveScheduling", False),
+        request_budget=config_json.get("requestBudget"),
+        query_profile=query_profile,
+    )
+
+
+def get_config_mtime(config_file_path: str = CONFIG_FILE_NAME) -> float:
+    return os.stat(config_file_path).st_mtime
+
+
+def get_changed_settings(old_config: Config, new_config: Config) -> List[str]:
+    return [
+        field.name for field in fields(Config) if getattr(old_config, field.name) != getattr(new_config, field.name)
+    ]
@@ -1,19 +1,137 @@
-MIN_SLEEP_SECONDS = 3
-MAX_SLEEP_SECONDS = 120
+# Rate limiting
+DEFAULT_REQUESTS_PER_MINUTE = 30
+RATE_LIMIT_JITTER_SECONDS = 1.0
+MIN_RATE_FRACTION = 0.1
+LATENCY_SLOWDOWN_FACTOR = 2.0
+FETCH_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 5
+BACKOFF_MAX_SECONDS = 300
+THROTTLED_STATUS_CODES = (403, 429)
 
-RECENCY_FILE_NAME = "recency.pickle"
+# Cookies
+COOKIE_FILE_NAME = "cookies.json"
+# Session cookies have no expiry, so they are trusted for this long after being harvested
+COOKIE_SESSION_TTL_HOURS = 12
+COOKIE_MIN_REFRESH_INTERVAL_SECONDS = 60
+REJECTED_STATUS_CODES = (401, 403)
+
+CONFIG_FILE_NAME = "config.json"
+
+DEFAULT_CRAWL_CONCURRENCY = 1
+# Time from the start of one crawl cycle to the start of the next when running as a daemon
+DEFAULT_CRAWL_INTERVAL_MINUTES = 60
+# Number of pages each crawl pipeline stage can hold before the stage before it has to wait
+PIPELINE_QUEUE_SIZE = 2
+
+# Logging
+LOG_FLUSH_SIZE_BYTES = 64 * 1024
+LOG_FLUSH_INTERVAL_SECONDS = 1.0
+
+# Metrics
+METRICS_PREFIX = "pricehistory"
+METRICS_LATENCY_BUCKETS_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+RECENCY_FILE_NAME = "recency.journal"
+LEGACY_RECENCY_FILE_NAME = "recency.pickle"
+# The journal is rewritten once it holds this many times more entries than there are categories in it
+RECENCY_COMPACTION_FACTOR = 4
+RECENCY_COMPACTION_MIN_ENTRIES = 1000
 RECENCY_MINIMUM_AGE_HOURS = 12
 RECENCY_CATEGORY_COMPLETE = "*_*SKIP*_*"
 
+# Scheduling
+SCHEDULE_FILE_NAME = "schedule.json"
+# Weight of the newest crawl in the smoothed change rate and page count of a category
+SCHEDULER_SMOOTHING = 0.3
+# A category is due once this fraction of its prices is expected to have changed since it was last crawled
+SCHEDULER_CHANGE_THRESHOLD = 0.02
+SCHEDULER_MAX_INTERVAL_HOURS = 7 * 24
+# Page estimate for categories that have never been crawled
+SCHEDULER_DEFAULT_PAGES = 10
+
+# Distributed crawling
+WORK_QUEUE_NAME = "wq"
+# A worker that has not renewed its lease for this long is assumed dead and its category is handed to another worker
+WORK_LEASE_SECONDS = 60
+# Fraction of the lease between renewals, so a couple of slow renewals do not lose the lease
+WORK_HEARTBEAT_FRACTION = 1 / 3
+WORK_QUEUE_POLL_SECONDS = 5
+# A category that failed on a worker is only retried after this long, so a persistent failure does not spin
+WORK_RETRY_DELAY_SECONDS = 60
+# A category that failed this many times in a cycle is set aside as failed so the queue can still drain
+WORK_MAX_ATTEMPTS = 5
+# Workers run until they are stopped, so they write out their metrics this often instead of only on exit
+WORKER_METRICS_INTERVAL_SECONDS = 60
+RECENCY_CACHE_KEY = "rcy"
+
+# Database
+LATEST_PRICE_BATCH_SIZE = 1000
+# Prices are either stored one document per price change or grouped into one document per product per month
+PRICE_LAYOUT_DOCUMENTS = "documents"
+PRICE_LAYOUT_BUCKETS = "buckets"
+PRICE_BUCKET_BATCH_SIZE = 1000
+# Writes are held back until this many are buffered or the oldest is this old, 0 writes every page straight through
+WRITE_BUFFER_MAX_OPERATIONS = 5000
+WRITE_BUFFER_MAX_AGE_SECONDS = 30
+
+# Export
+EXPORT_STATE_FILE_NAME = "export_state.json"
+EXPORT_CURSOR_BATCH_SIZE = 10_000
+# Prices are written to a new compressed part file every this many rows, so exports never hold a whole collection
+EXPORT_PART_ROWS = 1_000_000
+# Stand-ins for missing values in the integer columns of an export
+MISSING_PRICE_CENTS = -1
+MISSING_STORE_ID = -1
+
+# Maintenance
+MAINTENANCE_STATE_FILE_NAME = "maintenance_state.json"
+# Progress is saved and the run pauses after about this many price documents, so it does not starve the crawler
+MAINTENANCE_BATCH_DOCUMENTS = 10_000
+MAINTENANCE_PAUSE_SECONDS = 1.0
+
 # Cache
 REDIS_VERSION = 6
 PRODUCT_DISPLAY_NAME_CACHE_PREFIX = "pdn_"
 PRODUCT_PRICE_HISTORY_CACHE_PREFIX = "pph_"
 PRODUCT_SEARCH_CACHE_PREFIX = "ps_"
 PRODUCT_IDS_SEARCH_CACHE_PREFIX = "pis_"
+# The product search index: a set of product IDs per trigram, the indexed display name and category of every product,
+# and a counter bumped on every index change that is part of the search cache keys
+PRODUCT_SEARCH_TRIGRAM_PREFIX = "pst_"
+PRODUCT_SEARCH_DOCUMENTS_KEY = "psd"
+PRODUCT_SEARCH_GENERATION_KEY = "psg"
 CATEGORY_PRODUCTS_CACHE_KEY = "cpd_"
 CATEGORIES_CACHE_KEY = "categories"
 CATEGORY_NAME_CACHE_KEY = "cn_"
+LAST_PRICE_SNAPSHOT_CACHE_KEY = "lps"
+# Stream of price change events, trimmed to about this many, and a hash per store of rolling price statistics for each
+# product
+PRICE_CHANGE_STREAM_KEY = "pce"
+PRICE_CHANGE_STREAM_MAX_LENGTH = 100_000
+PRICE_STATS_CACHE_KEY = "pcs"
+PRICE_STATS_WINDOW_DAYS = 30
+# Hash of product ID to a fingerprint of the product document last written, deleting it makes the next crawl rewrite
+# every product
+PRODUCT_FINGERPRINT_CACHE_KEY = "pfp"
+# Sorted set per category of product IDs scored by when they were last listed in it. Products that have not been listed
+# in a category for this long are taken out of it.
+CATEGORY_LAST_SEEN_CACHE_KEY = "cls_"
+CATEGORY_MEMBERSHIP_EXPIRY_DAYS = 7
+# Entries that DBClient invalidates on writes can live for a day, search results go stale with every index change so
+# expire sooner
+CACHE_TTL_SECONDS = 24 * 60 * 60
+SEARCH_CACHE_TTL_SECONDS = 60 * 60
+# Only one reader rebuilds a missing entry; the others wait for it up to the lock timeout
+CACHE_LOCK_PREFIX = "lock_"
+CACHE_LOCK_TIMEOUT_SECONDS = 10
+CACHE_LOCK_POLL_SECONDS = 0.05
+SEARCH_RESULT_LIMIT = 50
+# A product has to contain this fraction of the search text's trigrams to be a match, which allows for typos
+SEARCH_MIN_MATCH_FRACTION = 0.6
+# Best trigram matches per result that are re-ranked by prefix and name length
+SEARCH_CANDIDATES_PER_RESULT = 4
+SEARCH_INDEX_BATCH_SIZE = 1000
+CACHE_INVALIDATION_BATCH_SIZE = 1000
 
 CATEGORIES_QUERY = """
     query {
@@ -24,6 +142,12 @@ CATEGORIES_QUERY = """
     }
 """
 
+# Query profiles: only what a crawl saves, or every field for enrichment and recording fixtures
+QUERY_PROFILE_PRICES = "prices"
+QUERY_PROFILE_FULL = "full"
+# Extension added to each page's result with the size of the response body
+RESPONSE_BYTES_EXTENSION = "responseBytes"
+
 # Need to replace strings:
 # - Category ID
 # - Store ID
@@ -93,6 +217,41 @@ PRODUCTS_QUERY = """
     }
 """
 
+# The same query with only the fields a crawl saves, which makes pages several times smaller
+PRICE_PRODUCTS_QUERY = """
+    query {
+        browseCategory(
+            categoryId: "%s"
+            storeId: %s
+            shoppingContext: CURBSIDE_PICKUP
+            limit: 100
+            cursor: %s
+        ) {
+            pageTitle
+            records {
+                id
+                displayName
+                SKUs {
+                    contextPrices {
+                        context
+                        listPrice {
+                            formattedAmount
+                        }
+                        salePrice {
+                            formattedAmount
+                        }
+                    }
+                    customerFriendlySize
+                }
+            }
+            hasMoreRecords
+            nextCursor
+        }
+    }
+"""
+
+PRODUCTS_QUERIES = {QUERY_PROFILE_PRICES: PRICE_PRODUCTS_QUERY, QUERY_PROFILE_FULL: PRODUCTS_QUERY}
+
 # Need to replace strings:
 # - username
 # - password
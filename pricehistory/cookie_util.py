@@ -1,8 +1,18 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+from atomicwrites import atomic_write
 from playwright.sync_api import sync_playwright
 from playwright_stealth import stealth_sync
 
+from pricehistory.constants import COOKIE_FILE_NAME, COOKIE_MIN_REFRESH_INTERVAL_SECONDS, COOKIE_SESSION_TTL_HOURS
+from pricehistory.logger_util import LoggerUtil
+
 
-def get_cookies(cookie_url: str) -> dict:
+def _harvest_cookies(cookie_url: str) -> List[dict]:
     with sync_playwright() as p:
         browser = p.firefox.launch()
         page = browser.new_page()
@@ -11,9 +21,95 @@ def get_cookies(cookie_url: str) -> dict:
         cookies = page.context.cookies()
         browser.close()
 
-    session_cookies = {}
-    for cookie in cookies:
-        if cookie["name"].startswith("incap_ses_"):
-            session_cookies[cookie["name"]] = cookie["value"]
+    return [cookie for cookie in cookies if cookie["name"].startswith("incap_ses_")]
+
+
+class CookieManager:
+    """
+    Caches harvested session cookies on disk so the browser only has to be launched when they are missing, expired
+    or rejected by the API.
+    """
+
+    def __init__(self, cookie_url: str, logger_util: LoggerUtil, cookie_file_path: str = COOKIE_FILE_NAME):
+        self.cookie_url = cookie_url
+        self.logger_util = logger_util
+        self.cookie_file_path = cookie_file_path
+
+        self.cookies: List[dict] = []
+        self.harvested_at = 0.0
+        self.listeners: List[Callable[[dict], None]] = []
+        self.lock = threading.Lock()
+
+        if os.path.exists(self.cookie_file_path):
+            with open(self.cookie_file_path, mode="r", encoding="utf-8") as cookie_file:
+                cookie_json = json.load(cookie_file)
+                self.cookies = cookie_json["cookies"]
+                self.harvested_at = cookie_json["harvested_at"]
+
+    def _is_valid(self) -> bool:
+        if not self.cookies:
+            return False
+
+        now = time.time()
+        for cookie in self.cookies:
+            # Session cookies have no expiry of their own, so assume they last for a fixed time after harvesting
+            expires = cookie.get("expires", -1)
+            if expires is None or expires < 0:
+                expires = self.harvested_at + COOKIE_SESSION_TTL_HOURS * 3600
+            if expires <= now:
+                return False
+
+        return True
+
+    def _as_dict(self) -> dict:
+        return {cookie["name"]: cookie["value"] for cookie in self.cookies}
+
+    def _save(self):
+        with atomic_write(self.cookie_file_path, mode="w", encoding="utf-8", overwrite=True) as cookie_file:
+            json.dump({"harvested_at": self.harvested_at, "cookies": self.cookies}, cookie_file)
+
+    def add_listener(self, listener: Callable[[dict], None]):
+        """
+        Registers a callback that is given the new cookies every time they are refreshed.
+        """
+        self.listeners.append(listener)
+
+    def get_cookies(self) -> dict:
+        with self.lock:
+            if self._is_valid():
+                self.logger_util.write("Using cached cookies")
+                return self._as_dict()
+
+        return self.refresh()
+
+    def refresh(self, rejected_cookies: Optional[dict] = None) -> dict:
+        """
+        Harvests new cookies with the browser and notifies every listener.
+
+        Args:
+            rejected_cookies: The cookies the API rejected. If the cookies have already been refreshed since then,
+                the browser is not launched again.
+
+        Returns:
+            The current cookies
+        """
+        with self.lock:
+            recently_refreshed = time.time() - self.harvested_at < COOKIE_MIN_REFRESH_INTERVAL_SECONDS
+            if rejected_cookies is not None and (rejected_cookies != self._as_dict() or recently_refreshed):
+                return self._as_dict()
+
+            self.logger_util.write("Fetching cookies...")
+            self.cookies = [
+                {"name": cookie["name"], "value": cookie["value"], "expires": cookie.get("expires", -1)}
+                for cookie in _harvest_cookies(self.cookie_url)
+            ]
+            self.harvested_at = time.time()
+            self._save()
+            self.logger_util.write("Done fetching cookies")
+
+            cookies = self._as_dict()
+
+        for listener in self.listeners:
+            listener(cookies)
 
-    return session_cookies
+        return cookies
@@ -0,0 +1,364 @@
+import asyncio
+import logging
+import signal
+import time
+from typing import Optional, Union
+
+import redis
+import requests
+
+from pricehistory.category_scheduler import CategoryScheduler
+from pricehistory.config_util import (
+    RESTART_REQUIRED_SETTINGS,
+    Config,
+    get_changed_settings,
+    get_config_mtime,
+    load_config,
+)
+from pricehistory.constants import (
+    CONFIG_FILE_NAME,
+    DB_CONNECTION_STRING,
+    WORK_QUEUE_POLL_SECONDS,
+    WORKER_METRICS_INTERVAL_SECONDS,
+)
+from pricehistory.cookie_util import CookieManager
+from pricehistory.crawl_worker import CrawlWorker
+from pricehistory.db_client import DBClient
+from pricehistory.logger_util import LoggerUtil
+from pricehistory.metrics_util import MetricsUtil
+from pricehistory.rate_limiter import RateLimiter
+from pricehistory.receny_util import RecencyUtil
+from pricehistory.redis_recency_util import RedisRecencyUtil
+from pricehistory.source_client import SourceClient
+from pricehistory.transport_util import RecordingAIOHTTPTransport, ReplayTransport
+from pricehistory.work_queue import WorkQueue
+
+
+class CrawlService:
+    """
+    Owns the database, cache and upstream clients for crawling and runs crawl cycles with them.
+
+    A single crawl is run with `run_once`. `run_forever` keeps the Mongo client, Redis pool, HTTP session and cookies
+    open across cycles, so indexes are only created and the browser only launched once. The config file is re-read
+    before each cycle when it has changed, and every setting that does not need new connections is applied right away.
+
+    To spread a crawl over several machines, `run_coordinator` queues the categories in Redis and `run_worker` leases
+    and crawls them, with the checkpoints kept in the same Redis.
+    """
+
+    def __init__(self, config: Config, logger_util: LoggerUtil, config_file_path: str = CONFIG_FILE_NAME):
+        self.config = config
+        self.logger_util = logger_util
+        self.config_file_path = config_file_path
+        self.config_mtime = get_config_mtime(config_file_path)
+
+        self.logger_util.configure(level=logging.getLevelName(config.log_level), dump_responses=config.dump_responses)
+
+        if config.data_cache_url:
+            self.cache = redis.Redis.from_url(config.data_cache_url)
+            self.cache.ping()
+            self.logger_util.write("Using Redis cache for data")
+        else:
+            self.cache = None
+
+        self.metrics_util = MetricsUtil()
+        self.db_client = DBClient(
+            db_connection_string=DB_CONNECTION_STRING % (config.db_username, config.db_password, config.db_host),
+            logger_util=logger_util,
+            cache=self.cache,
+            metrics_util=self.metrics_util,
+            price_layout=config.price_layout,
+            defer_cache_invalidation=config.defer_cache_invalidation,
+            write_buffer_size=config.write_buffer_size,
+            default_store_id=config.store_ids[0],
+        )
+
+        # Only built for crawls, so the maintenance commands do not launch a browser
+        self.cookie_manager: Optional[CookieManager] = None
+        self.recency_util: Optional[Union[RecencyUtil, RedisRecencyUtil]] = None
+        self.source_client: Optional[SourceClient] = None
+
+    def _get_shared_cache(self):
+        if self.cache is None:
+            raise ValueError(
+                "Distributed crawling needs data_cache_url to point at a Redis server every worker can reach"
+            )
+        return self.cache
+
+    def _build_source_client(self, distributed: bool = False):
+        config = self.config
+        self.cookie_manager = CookieManager(cookie_url=config.cookie_url, logger_util=self.logger_util)
+        cookies = self.cookie_manager.get_cookies()
+
+        if distributed:
+            self.recency_util = RedisRecencyUtil(self._get_shared_cache(), metrics_util=self.metrics_util)
+        else:
+            self.recency_util = RecencyUtil(metrics_util=self.metrics_util)
+
+        if config.replay_fixtures_dir:
+            self.logger_util.write(f"Replaying responses from {config.replay_fixtures_dir}")
+            transport = ReplayTransport(fixtures_dir=config.replay_fixtures_dir)
+        elif config.record_fixtures_dir:
+            self.logger_util.write(f"Recording responses to {config.record_fixtures_dir}")
+            transport = RecordingAIOHTTPTransport(
+                fixtures_dir=config.record_fixtures_dir,
+                url=config.api_url,
+                cookies=cookies,
+            )
+        else:
+            transport = None
+
+        self.source_client = SourceClient(
+            api_url=config.api_url,
+            store_ids=config.store_ids,
+            categories=config.categories,
+            cookies=cookies,
+            db_client=self.db_client,
+            recency_util=self.recency_util,
+            logger_util=self.logger_util,
+            rate_limiter=RateLimiter(requests_per_minute=config.requests_per_minute),
+            cookie_manager=self.cookie_manager,
+            transport=transport,
+            metrics_util=self.metrics_util,
+            # Workers only see the categories they lease, so the schedule is not learned in distributed crawls
+            category_scheduler=None if distributed else self._build_category_scheduler(config),
+            query_profile=config.query_profile,
+        )
+
+    def _build_category_scheduler(self, config: Config) -> Optional[CategoryScheduler]:
+        if not config.adaptive_scheduling:
+            return None
+        return CategoryScheduler(logger_util=self.logger_util, request_budget=config.request_budget)
+
+    async def _run_cycle_async(self, session):
+        self.logger_util.write(f"Crawling up to {self.config.crawl_concurrency} categories at once")
+        # Cheap while the cookies are still valid, and harvests new ones before the crawl once they have expired
+        await asyncio.to_thread(self.cookie_manager.get_cookies)
+        self.recency_util.clean_records()
+
+        try:
+            await self.source_client.process_all_categories_in_session_async(
+                session, concurrency=self.config.crawl_concurrency
+            )
+        finally:
+            self._write_metrics()
+
+        await asyncio.to_thread(self._ping_healthcheck)
+
+    def _write_metrics(self, reset: bool = True):
+        # Write the metrics even for a failed run since those are the runs we most want to look at
+        if self.config.metrics_file:
+            self.metrics_util.write_summary(self.config.metrics_file)
+        if self.config.prometheus_file:
+            self.metrics_util.write_prometheus(self.config.prometheus_file)
+        if reset:
+            self.metrics_util.reset()
+
+    def _ping_healthcheck(self):
+        self.logger_util.write("Pinging healthcheck URL...")
+        response = requests.get(self.config.healthcheck_url)
+        response.raise_for_status()
+        self.logger_util.write("Done!")
+
+    def run_once(self):
+        self._build_source_client()
+
+        async def run_async():
+            async with self.source_client.client as session:
+                await self._run_cycle_async(session)
+
+        asyncio.run(run_async())
+
+    def reload_config(self) -> bool:
+        """
+        Re-reads the config file if it changed since it was last read and applies the new settings.
+
+        Returns:
+            Whether a new config was applied
+        """
+        try:
+            config_mtime = get_config_mtime(self.config_file_path)
+            if config_mtime == self.config_mtime:
+                return False
+            self.config_mtime = config_mtime
+            config = load_config(self.config_file_path)
+        except Exception:
+            self.logger_util.exception("Could not reload the config, keeping the current one")
+            return False
+
+        changed_settings = get_changed_settings(self.config, config)
+        if not changed_settings:
+            return False
+
+        restart_settings = [setting for setting in changed_settings if setting in RESTART_REQUIRED_SETTINGS]
+        for setting in restart_settings:
+            setattr(config, setting, getattr(self.config, setting))
+        # Prices saved without a store belong to the first store, so it cannot change under a running crawler
+        if config.store_ids[0] != self.config.store_ids[0]:
+            restart_settings.append("the first store ID")
+            config.store_ids = self.config.store_ids
+        if restart_settings:
+            self.logger_util.warning(f"Changes to {', '.join(restart_settings)} only apply after a restart")
+
+        self._apply_config(config)
+        self.logger_util.write(f"Reloaded config: {', '.join(changed_settings)}")
+        return True
+
+    def _apply_config(self, config: Config):
+        old_config = self.config
+        self.config = config
+
+        self.logger_util.configure(level=logging.getLevelName(config.log_level), dump_responses=config.dump_responses)
+        self.db_client.write_buffer.max_operations = config.write_buffer_size
+        self.db_client.cache_invalidator.deferred = config.defer_cache_invalidation
+
+        if self.source_client is None:
+            return
+        self.source_client.store_ids = config.store_ids
+        self.source_client.categories = config.categories
+        self.source_client.query_profile = config.query_profile
+        if config.requests_per_minute != old_config.requests_per_minute:
+            self.source_client.rate_limiter.set_requests_per_minute(config.requests_per_minute)
+
+        if config.adaptive_scheduling != old_config.adaptive_scheduling:
+            self.source_client.category_scheduler = self._build_category_scheduler(config)
+        elif self.source_client.category_scheduler is not None:
+            self.source_client.category_scheduler.request_budget = config.request_budget
+
+    def run_forever(self):
+        """
+        Runs a crawl cycle every `crawl_interval_minutes` until the process is interrupted or terminated.
+
+        A failed cycle is logged and skips its healthcheck ping, and the next cycle still runs on schedule. A
+        termination signal lets the current cycle finish before stopping.
+        """
+        self._build_source_client()
+        asyncio.run(self._run_forever_async())
+
+    @staticmethod
+    def _create_stop_event() -> asyncio.Event:
+        stop_event = asyncio.Event()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_event.set)
+        except NotImplementedError:
+            # Windows event loops have no signal handlers, so the daemon can only be interrupted there
+            pass
+        return stop_event
+
+    async def _run_forever_async(self):
+        stop_event = self._create_stop_event()
+        async with self.source_client.client as session:
+            while not stop_event.is_set():
+                cycle_start = time.monotonic()
+                self.reload_config()
+                try:
+                    await self._run_cycle_async(session)
+                except Exception:
+                    self.logger_util.exception("Crawl cycle failed")
+
+                wait_seconds = self.config.crawl_interval_minutes * 60 - (time.monotonic() - cycle_start)
+                if wait_seconds > 0 and not stop_event.is_set():
+                    self.logger_util.write(f"Next crawl in {wait_seconds / 60:.1f} minutes")
+                    try:
+                        await asyncio.wait_for(stop_event.wait(), timeout=wait_seconds)
+                    except asyncio.TimeoutError:
+                        pass
+
+        self.logger_util.write("Stopped crawling")
+
+    @staticmethod
+    def _wait_for_cycle(work_queue: WorkQueue, deadline: Optional[float]) -> bool:
+        # Leased categories stay queued until their worker completes them, so an empty queue means the cycle is done
+        while work_queue.num_items():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            poll_seconds = WORK_QUEUE_POLL_SECONDS
+            if deadline is not None:
+                poll_seconds = min(poll_seconds, deadline - time.monotonic())
+            time.sleep(max(0.0, poll_seconds))
+        return True
+
+    def run_coordinator(self, daemon: bool = False):
+        """
+        Queues every category of every store for the workers, once or every `crawl_interval_minutes` as a daemon.
+
+        Categories that are still queued or leased from an earlier cycle are left where they are. The healthcheck is
+        pinged once the workers have finished a cycle. A cycle that is not finished by the time the next one is due, or
+        in which the workers gave up on a category, skips its ping.
+        """
+        work_queue = WorkQueue(self._get_shared_cache())
+        recency_util = RedisRecencyUtil(self.cache, metrics_util=self.metrics_util)
+
+        while True:
+            cycle_start = time.monotonic()
+            try:
+                if daemon:
+                    self.reload_config()
+                recency_util.clean_records()
+
+                num_waiting = work_queue.num_items()
+                if num_waiting:
+                    self.logger_util.warning(f"{num_waiting} categories from the last cycle are still queued")
+                crawl_targets = [
+                    (store_id, category_id)
+                    for store_id in self.config.store_ids
+                    for category_id in self.config.categories
+                ]
+                num_added = work_queue.start_cycle(crawl_targets)
+                self.logger_util.write(f"Queued {num_added} of {len(crawl_targets)} categories for the workers")
+
+                deadline = cycle_start + self.config.crawl_interval_minutes * 60 if daemon else None
+                if self._wait_for_cycle(work_queue, deadline):
+                    failed_targets = work_queue.get_failed()
+                    # The workers flush their writes before completing a category, so every page is in by now
+                    failed_categories = {category_id for _, category_id in failed_targets}
+                    self.db_client.prune_category_products(
+                        [category_id for category_id in self.config.categories if category_id not in failed_categories]
+                    )
+                    if failed_targets:
+                        # Like a failed crawl, a cycle with failed categories skips its ping
+                        self.logger_util.error(f"Workers gave up on (store ID, category ID) {failed_targets}")
+                    else:
+                        self.logger_util.write("Workers finished the cycle")
+                        self._ping_healthcheck()
+                else:
+                    self.logger_util.warning("Workers did not finish the cycle before the next one was due")
+            except Exception:
+                if not daemon:
+                    raise
+                self.logger_util.exception("Coordinator cycle failed")
+
+            if not daemon:
+                return
+            time.sleep(max(0.0, self.config.crawl_interval_minutes * 60 - (time.monotonic() - cycle_start)))
+
+    def run_worker(self, exit_when_idle: bool = False):
+        """
+        Crawls categories leased from the coordinator's queue until terminated, or until the queue is empty.
+        """
+        self._build_source_client(distributed=True)
+        crawl_worker = CrawlWorker(
+            source_client=self.source_client,
+            work_queue=WorkQueue(self.cache),
+            logger_util=self.logger_util,
+            concurrency=self.config.crawl_concurrency,
+        )
+
+        async def write_metrics_periodically():
+            while True:
+                await asyncio.sleep(WORKER_METRICS_INTERVAL_SECONDS)
+                # Snapshots keep counting up, since resetting them would break rates computed from the counters
+                await asyncio.to_thread(self._write_metrics, False)
+
+        async def run_async():
+            stop_event = self._create_stop_event()
+            metrics_writer = asyncio.create_task(write_metrics_periodically())
+            async with self.source_client.client as session:
+                try:
+                    await crawl_worker.run_async(session, stop_event=stop_event, exit_when_idle=exit_when_idle)
+                finally:
+                    metrics_writer.cancel()
+                    await asyncio.gather(metrics_writer, return_exceptions=True)
+                    self._write_metrics()
+
+        asyncio.run(run_async())
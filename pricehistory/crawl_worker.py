@@ -0,0 +1,131 @@
+import asyncio
+import os
+import socket
+from typing import Optional
+
+from pricehistory.constants import WORK_HEARTBEAT_FRACTION, WORK_QUEUE_POLL_SECONDS, WORK_RETRY_DELAY_SECONDS
+from pricehistory.data.work_lease import WorkLease
+from pricehistory.logger_util import LoggerUtil
+from pricehistory.source_client import SourceClient
+from pricehistory.work_queue import WorkQueue
+
+
+class CrawlWorker:
+    """
+    Crawls categories leased from a shared work queue until it is stopped.
+
+    The lease on a category is renewed in the background while it is crawled. Checkpoints have to be kept somewhere
+    every worker can read, like RedisRecencyUtil, so that when a worker dies another one takes over the category at
+    its last cursor once the lease runs out. A worker that finds its lease taken over stops crawling the category.
+    """
+
+    def __init__(
+        self,
+        source_client: SourceClient,
+        work_queue: WorkQueue,
+        logger_util: LoggerUtil,
+        worker_id: Optional[str] = None,
+        concurrency: int = 1,
+    ):
+        self.source_client = source_client
+        self.db_client = source_client.db_client
+        self.metrics_util = source_client.metrics_util
+        self.work_queue = work_queue
+        self.logger_util = logger_util
+        self.worker_id = worker_id if worker_id is not None else f"{socket.gethostname()}-{os.getpid()}"
+        self.concurrency = concurrency
+        # The coordinator's crawl cycle this worker is crawling
+        self.cycle_id: Optional[int] = None
+
+    async def run_async(self, session, stop_event: Optional[asyncio.Event] = None, exit_when_idle: bool = False):
+        """
+        Leases and crawls categories, up to `concurrency` at once.
+
+        Args:
+            session: The async gql session to crawl with
+            stop_event: Stops the worker once the categories it is crawling are done
+            exit_when_idle: Stop once the queue is empty instead of waiting for more work
+        """
+        if stop_event is None:
+            stop_event = asyncio.Event()
+
+        self.logger_util.write(f"Worker {self.worker_id} crawling up to {self.concurrency} categories at once")
+        try:
+            await asyncio.gather(
+                *(self._work_async(session, stop_event, exit_when_idle) for _ in range(self.concurrency))
+            )
+        finally:
+            await asyncio.to_thread(self.db_client.flush_writes)
+
+    async def _work_async(self, session, stop_event: asyncio.Event, exit_when_idle: bool):
+        while not stop_event.is_set():
+            lease = await asyncio.to_thread(self.work_queue.lease, self.worker_id)
+            if lease is not None:
+                await self._process_lease_async(session, lease)
+                continue
+
+            # Leased categories can still come back if their worker dies, so only an empty queue means the work is done
+            if exit_when_idle and await asyncio.to_thread(self.work_queue.num_items) == 0:
+                return
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=WORK_QUEUE_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process_lease_async(self, session, lease: WorkLease):
+        if lease.previous_owner is not None:
+            self.logger_util.write(
+                f"Taking over category {lease.category_id} for store {lease.store_id} from {lease.previous_owner}"
+            )
+            self.metrics_util.increment("work_items_taken_over")
+
+        if lease.cycle_id is not None and lease.cycle_id != self.cycle_id:
+            self.source_client.start_run(lease.cycle_start)
+            self.cycle_id = lease.cycle_id
+
+        crawl = asyncio.create_task(
+            self.source_client.process_category_async(session, lease.category_id, lease.store_id)
+        )
+        heartbeat = asyncio.create_task(self._heartbeat_async(lease))
+        await asyncio.wait({crawl, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+
+        if not crawl.done():
+            crawl.cancel()
+            await asyncio.gather(crawl, return_exceptions=True)
+            # Pages still in the write buffer would otherwise overwrite the new owner's checkpoints once flushed
+            self.source_client.abandon_category(lease.category_id, lease.store_id)
+            self.logger_util.warning(
+                f"Lost the lease on category {lease.category_id} for store {lease.store_id} to another worker"
+            )
+            self.metrics_util.increment("work_leases_lost")
+            return
+
+        heartbeat.cancel()
+        await asyncio.gather(heartbeat, return_exceptions=True)
+        try:
+            crawl.result()
+            # Checkpoints are only recorded once the writes behind them are flushed, so flush before letting go
+            await asyncio.to_thread(self.db_client.flush_writes)
+            await asyncio.to_thread(self.work_queue.complete, lease, self.worker_id)
+            self.metrics_util.increment("work_items_completed")
+        except Exception:
+            self.logger_util.exception(f"Failed to process category {lease.category_id} for store {lease.store_id}")
+            # The next worker to lease the category resumes from the checkpoints recorded so far
+            self.source_client.abandon_category(lease.category_id, lease.store_id)
+            if not await asyncio.to_thread(self.work_queue.fail, lease, self.worker_id, WORK_RETRY_DELAY_SECONDS):
+                self.logger_util.error(
+                    f"Giving up on category {lease.category_id} for store {lease.store_id} after "
+                    f"{lease.attempts + 1} failed attempts"
+                )
+                self.metrics_util.increment("work_items_failed")
+
+    async def _heartbeat_async(self, lease: WorkLease):
+        # Returns once the lease has been taken over by another worker
+        while True:
+            await asyncio.sleep(self.work_queue.lease_seconds * WORK_HEARTBEAT_FRACTION)
+            try:
+                if not await asyncio.to_thread(self.work_queue.renew, lease, self.worker_id):
+                    return
+            except Exception:
+                # Keep crawling through a failed renewal, the lease only goes to another worker once it runs out
+                self.logger_util.exception("Could not renew work lease")
@@ -0,0 +1,15 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+
+@dataclass
+class PriceChangeEvent:
+    product_id: int
+    store_id: Optional[int]
+    # None when the product had no online price
+    old_price_cents: Optional[int]
+    new_price_cents: Optional[int]
+    # Change relative to the old price, negative for a drop. None unless both prices are known and the old one positive.
+    change_percent: Optional[float]
+    time: datetime
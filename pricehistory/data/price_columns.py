@@ -0,0 +1,15 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class PriceColumns:
+    product_id: np.ndarray
+    store_id: np.ndarray
+    # MISSING_PRICE_CENTS where the product had no online price
+    price_cents: np.ndarray
+    start_date: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.product_id)
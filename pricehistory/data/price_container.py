@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Optional
 
 from pricehistory.data.price_document import PriceDocument
 from pricehistory.data.product_document import ProductDocument
@@ -7,4 +8,5 @@ from pricehistory.data.product_document import ProductDocument
 @dataclass
 class PriceContainer:
     product_document: ProductDocument
-    price_document: PriceDocument
+    # None when the product's price at the store was already saved earlier in the crawl
+    price_document: Optional[PriceDocument]
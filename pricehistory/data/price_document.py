@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from datetime import datetime
+from typing import Optional
 
 
 @dataclass
@@ -7,3 +8,4 @@ class PriceDocument:
     product_id: int
     price_cents: int
     start_date: datetime
+    store_id: Optional[int] = None
@@ -0,0 +1,18 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class PriceMaintenanceReport:
+    documents_scanned: int = 0
+    products_scanned: int = 0
+    # Prices equal to the price before them, which carry no information
+    redundant_prices: int = 0
+    # Prices with the same start date as another price of the product at the store
+    duplicate_dates: int = 0
+    # Prices saved while the product had no online price
+    missing_prices: int = 0
+    non_positive_prices: int = 0
+    # Prices saved before stores were tracked, which belong to the default store
+    missing_store_ids: int = 0
+    documents_deleted: int = 0
+    reclaimable_bytes: int = 0
@@ -0,0 +1,8 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class PriceSaveResult:
+    num_new: int = 0
+    num_changed: int = 0
+    num_unchanged: int = 0
@@ -0,0 +1,12 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+
+@dataclass
+class PriceStats:
+    price_cents: Optional[int]
+    all_time_low_cents: Optional[int]
+    all_time_low_date: Optional[datetime]
+    # Lowest price in effect at any time during the last PRICE_STATS_WINDOW_DAYS days
+    window_low_cents: Optional[int]
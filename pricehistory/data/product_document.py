@@ -1,8 +1,12 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import List
 
 
 @dataclass
 class ProductDocument:
     id: int
     display_name: str
+    # The lowest of `categories`, kept for readers from before products had several
     category: int
+    # Every category the product has been seen in
+    categories: List[int] = field(default_factory=list)
@@ -0,0 +1,17 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+
+@dataclass
+class WorkLease:
+    store_id: int
+    category_id: int
+    # The worker that held the item before its lease ran out, if it was taken over
+    previous_owner: Optional[str] = None
+    # The crawl cycle the coordinator was on when the item was leased, None if it was queued without one
+    cycle_id: Optional[int] = None
+    # When the coordinator started that cycle, which every worker saves the cycle's prices with
+    cycle_start: Optional[datetime] = None
+    # How many times crawling the item has failed so far this cycle
+    attempts: int = 0
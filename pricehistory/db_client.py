@@ -1,37 +1,101 @@
 import dataclasses
-import logging
-from typing import List
+import hashlib
+import json
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 import fakeredis
 import pymongo
 import redis
 from pymongo import MongoClient, UpdateOne
 from pymongo.collection import Collection
-from pymongo.operations import InsertOne
+from pymongo.operations import ReplaceOne
 from pymongo.server_api import ServerApi
 
 from .constants import (
+    LATEST_PRICE_BATCH_SIZE,
+    LAST_PRICE_SNAPSHOT_CACHE_KEY,
+    PRICE_BUCKET_BATCH_SIZE,
+    PRICE_LAYOUT_BUCKETS,
+    PRICE_LAYOUT_DOCUMENTS,
     REDIS_VERSION,
     PRODUCT_PRICE_HISTORY_CACHE_PREFIX,
+    PRODUCT_DISPLAY_NAME_CACHE_PREFIX,
+    PRODUCT_FINGERPRINT_CACHE_KEY,
+    CATEGORY_LAST_SEEN_CACHE_KEY,
+    CATEGORY_MEMBERSHIP_EXPIRY_DAYS,
     CATEGORY_PRODUCTS_CACHE_KEY,
     CATEGORY_NAME_CACHE_KEY,
+    CATEGORIES_CACHE_KEY,
 )
+from .cache_invalidator import CacheInvalidator
+from .price_change_feed import PriceChangeFeed, get_change_percent
+from .search_index import SearchIndex
+from .write_behind_buffer import WriteBehindBuffer
 from .data.category_document import CategoryDocument
+from .data.price_change_event import PriceChangeEvent
 from .data.price_container import PriceContainer
+from .data.price_document import PriceDocument
+from .data.product_document import ProductDocument
+from .data.price_save_result import PriceSaveResult
 from .logger_util import LoggerUtil
+from .metrics_util import MetricsUtil
 
 
 class DBClient:
-    def __init__(self, db_connection_string: str, logger_util: LoggerUtil, cache: redis.Redis = None):
+    def __init__(
+        self,
+        db_connection_string: str,
+        logger_util: LoggerUtil,
+        cache: redis.Redis = None,
+        mongo_client: Optional[MongoClient] = None,
+        database_name: str = "price_history",
+        metrics_util: Optional[MetricsUtil] = None,
+        price_layout: str = PRICE_LAYOUT_DOCUMENTS,
+        defer_cache_invalidation: bool = False,
+        write_buffer_size: int = 0,
+        default_store_id: Optional[int] = None,
+    ):
+        if price_layout not in (PRICE_LAYOUT_DOCUMENTS, PRICE_LAYOUT_BUCKETS):
+            raise ValueError(f"Unknown price layout {price_layout}")
+        self.price_layout = price_layout
+        # Prices saved before stores were tracked have no store_id and belong to this store, which also keeps the
+        # original snapshot and price history cache keys
+        self.default_store_id = default_store_id
+
         # If no cache is given, spin up a fake one
         if cache is None:
             self.cache = fakeredis.FakeStrictRedis(version=REDIS_VERSION)
         else:
             self.cache = cache
+        self.cache_invalidator = CacheInvalidator(self.cache, deferred=defer_cache_invalidation)
+        self.search_index = SearchIndex(self.cache)
+        self.price_change_feed = PriceChangeFeed(self.cache)
+
+        if mongo_client is None:
+            self.client = MongoClient(db_connection_string, server_api=ServerApi("1"))
+        else:
+            self.client = mongo_client
 
-        self.client = MongoClient(db_connection_string, server_api=ServerApi("1"))
-        
         self.logger_util = logger_util
+        self.metrics_util = metrics_util if metrics_util is not None else MetricsUtil()
+
+        self.write_buffer = WriteBehindBuffer(max_operations=write_buffer_size, metrics_util=self.metrics_util)
+        self.write_buffer.add_flush_listener(self._on_writes_flushed)
+        # What the writes still sitting in the buffer will change, so later pages see them before they are flushed
+        self.pending_latest_prices: Dict[Tuple[Optional[int], int], Optional[int]] = {}
+        self.pending_price_product_ids: Set[Tuple[Optional[int], int]] = set()
+        self.pending_fingerprints: Dict[int, str] = {}
+        self.pending_search_products: Dict[int, ProductDocument] = {}
+        self.pending_price_events: List[PriceChangeEvent] = []
+        self.pending_new_prices: List[PriceDocument] = []
+        self.pending_cache_keys: Set[str] = set()
+        # When each product was last listed in each category, by category ID
+        self.pending_last_seen: Dict[int, Dict[int, float]] = {}
+        # Categories already written by this client, by ID, with their display name
+        self.saved_categories: Dict[int, str] = {}
 
         # Send a ping to confirm a successful connection
         try:
@@ -41,123 +105,713 @@ class DBClient:
             self.logger_util.exception("Error connecting to database!")
 
         # Collections
-        self.database = self.client["price_history"]
+        self.database = self.client[database_name]
         self.products_collection: Collection = self.database["products"]
         self.categories_collection: Collection = self.database["categories"]
         self.prices_collection: Collection = self.database["prices"]
+        # Only used by the bucketed price layout, which stores all of a product's prices for a month in one document
+        self.price_buckets_collection: Collection = self.database["price_buckets"]
 
         # Indexes
         self.products_collection.create_index([("id", pymongo.ASCENDING)], unique=True)
         self.products_collection.create_index([("display_name", pymongo.TEXT)])
+        self.products_collection.create_index([("categories", pymongo.ASCENDING)])
         self.categories_collection.create_index([("id", pymongo.ASCENDING)], unique=True)
         self.prices_collection.create_index(
             [("product_id", pymongo.ASCENDING), ("start_date", pymongo.DESCENDING)], unique=False
         )
+        # Incremental exports read the prices saved since their last run
+        self.prices_collection.create_index([("start_date", pymongo.ASCENDING)])
+        if self.price_layout == PRICE_LAYOUT_BUCKETS:
+            self._create_price_buckets_index()
+
+        # Product name search is served by SearchIndex, which needs no Atlas search tier
+
+    def save_product_prices(
+        self,
+        price_containers: List[PriceContainer],
+        category_document: CategoryDocument,
+        on_saved: Optional[Callable[[], None]] = None,
+    ) -> PriceSaveResult:
+        """
+        Saves a page of products and prices through the write buffer.
+
+        Args:
+            price_containers: The products and prices on the page
+            category_document: The category the page belongs to
+            on_saved: Called once the page's writes are in the database, which may be during a later call
+
+        Returns:
+            How many of the prices were new, changed or unchanged
+        """
+        with self.write_buffer.lock:
+            price_save_result = self.stage_product_prices(price_containers, category_document, on_saved)
+            self.write_buffer.flush_if_due()
+        return price_save_result
 
-        # TODO uncomment this when pymongo supports creating a search index
-        # Search index for string searching
-        # search_index_definition = {
-        #     "mappings": {
-        #         "dynamic": False,
-        #         "fields": {
-        #             "display_name": [
-        #                 {
-        #                     "foldDiacritics": True,
-        #                     "maxGrams": 6,
-        #                     "minGrams": 3,
-        #                     "tokenization": "nGram",
-        #                     "type": "autocomplete",
-        #                 }
-        #             ]
-        #         },
-        #     }
-        # }
-        # search_index_model = SearchIndexModel(name="default", definition=search_index_definition)
-        # self.products_collection.create_search_index(search_index_model)
-
-    def save_product_prices(self, price_containers: List[PriceContainer], category_document: CategoryDocument):
-        # Ensure we have a document for the category
-        self._ensure_category_exists(category_document)
-
-        # Ensure we have a document for each product
-        self._ensure_products_exist(price_containers, category_document)
-
-        # Save all the prices to the database
-        self._ensure_prices_exist(price_containers)
+    def stage_product_prices(
+        self,
+        price_containers: List[PriceContainer],
+        category_document: CategoryDocument,
+        on_saved: Optional[Callable[[], None]] = None,
+    ) -> PriceSaveResult:
+        """
+        Queues a page of products and prices in the write buffer like `save_product_prices`, without checking whether
+        the buffer is due to be flushed. A page that was staged stays in the buffer even if a later flush fails, so
+        only the flush has to be retried.
+        """
+        category_id = category_document.id
+        # Pages are staged one at a time so each one sees the pending writes of the pages before it
+        with self.write_buffer.lock, self.metrics_util.timer("save_product_prices", category_id):
+            # Ensure we have a document for the category
+            with self.metrics_util.timer("ensure_category", category_id):
+                self._ensure_category_exists(category_document)
+
+            # Ensure we have a document for each product
+            with self.metrics_util.timer("ensure_products", category_id):
+                self._ensure_products_exist(price_containers, category_document)
+
+            # Save all the prices to the database
+            with self.metrics_util.timer("ensure_prices", category_id):
+                price_save_result = self._ensure_prices_exist(price_containers)
+
+            if on_saved is not None:
+                self.write_buffer.add_after_flush(on_saved)
+
+        self.metrics_util.increment("prices_new", price_save_result.num_new, category_id)
+        self.metrics_util.increment("prices_changed", price_save_result.num_changed, category_id)
+        self.metrics_util.increment("prices_unchanged", price_save_result.num_unchanged, category_id)
+        return price_save_result
+
+    @staticmethod
+    def _get_product_fingerprint(product_document: ProductDocument) -> str:
+        # The categories are kept in the clear so a later page can tell which ones the product is already stored with
+        content = json.dumps(dataclasses.asdict(product_document), sort_keys=True)
+        digest = hashlib.blake2b(content.encode("utf-8"), digest_size=8).hexdigest()
+        return f"{','.join(str(category_id) for category_id in product_document.categories)}:{digest}"
+
+    @staticmethod
+    def _get_fingerprint_categories(fingerprint: str) -> Set[int]:
+        # Fingerprints from before products had several categories hold just the one
+        return {int(category_id) for category_id in fingerprint.split(":", 1)[0].split(",") if category_id}
 
     def _ensure_products_exist(self, price_containers: List[PriceContainer], category_document: CategoryDocument):
+        product_documents = {
+            price_container.product_document.id: price_container.product_document
+            for price_container in price_containers
+        }
+        if not product_documents:
+            self.logger_util.write("Queued 0 product document upserts")
+            return
+
+        product_ids = list(product_documents)
+        now = time.time()
+        self.pending_last_seen.setdefault(category_document.id, {}).update(
+            (product_id, now) for product_id in product_ids
+        )
+
+        # Only products whose content changed since they were last written need to go to the database
+        stored_fingerprints = {**self._get_stored_fingerprints(product_ids), **self.pending_fingerprints}
+        changed_fingerprints = {}
+        changed_categories = set()
+        for product_id in product_ids:
+            # A page only knows the categories the product was seen in so far, the stored ones are kept as well
+            stored_fingerprint = stored_fingerprints.get(product_id)
+            product_document = product_documents[product_id]
+            categories = {product_document.category, *product_document.categories}
+            if stored_fingerprint is not None:
+                categories |= self._get_fingerprint_categories(stored_fingerprint)
+            product_document = product_documents[product_id] = dataclasses.replace(
+                product_document, category=min(categories), categories=sorted(categories)
+            )
+
+            fingerprint = self._get_product_fingerprint(product_document)
+            if stored_fingerprint == fingerprint:
+                continue
+
+            changed_fingerprints[product_id] = fingerprint
+            changed_categories.update(categories)
+
+        num_unchanged = len(product_ids) - len(changed_fingerprints)
+        self.metrics_util.increment("products_unchanged", num_unchanged, category_document.id)
+        if not changed_fingerprints:
+            self.logger_util.write(f"Queued 0 product document upserts ({num_unchanged} unchanged)")
+            return
+
+        for product_id in changed_fingerprints:
+            product_fields = dataclasses.asdict(product_documents[product_id])
+            categories = product_fields.pop("categories")
+            self.write_buffer.add(
+                self.products_collection,
+                UpdateOne(
+                    filter={"id": product_id},
+                    # Adding to the stored categories keeps them even if the fingerprint cache was cleared
+                    update={"$set": product_fields, "$addToSet": {"categories": {"$each": categories}}},
+                    upsert=True,
+                ),
+                key=product_id,
+            )
+        self.logger_util.write(
+            f"Queued {len(changed_fingerprints)} product document upserts ({num_unchanged} unchanged)"
+        )
+        self.metrics_util.increment("products_changed", len(changed_fingerprints), category_document.id)
+
+        # The fingerprints are only stored once the writes are flushed so a failed write is retried on the next crawl.
+        # We know exactly which products changed, so reset their display names along with the category listings.
+        self.pending_fingerprints.update(changed_fingerprints)
+        self.pending_search_products.update(
+            (product_id, product_documents[product_id]) for product_id in changed_fingerprints
+        )
+        self.pending_cache_keys.update(
+            f"{PRODUCT_DISPLAY_NAME_CACHE_PREFIX}_{product_id}" for product_id in changed_fingerprints
+        )
+        self.pending_cache_keys.update(
+            f"{CATEGORY_PRODUCTS_CACHE_KEY}_{category_id}"
+            for category_id in changed_categories | {category_document.id}
+        )
+
+    def _get_stored_fingerprints(self, product_ids: List[int]) -> Dict[int, str]:
+        missing_product_ids = [product_id for product_id in product_ids if product_id not in self.pending_fingerprints]
+        if not missing_product_ids:
+            return {}
+
+        values = self.cache.hmget(PRODUCT_FINGERPRINT_CACHE_KEY, missing_product_ids)
+        return {
+            product_id: value.decode("utf-8")
+            for product_id, value in zip(missing_product_ids, values)
+            if value is not None
+        }
+
+    def _on_writes_flushed(self):
+        # Everything the buffered writes changed is now in the database, so the cache can catch up
+        if self.pending_latest_prices:
+            latest_prices_by_store: Dict[Optional[int], Dict[int, Optional[int]]] = {}
+            for (store_id, product_id), price_cents in self.pending_latest_prices.items():
+                latest_prices_by_store.setdefault(store_id, {})[product_id] = price_cents
+            with self.metrics_util.timer("snapshot_write"):
+                for store_id, latest_prices in latest_prices_by_store.items():
+                    self.update_snapshot_prices(latest_prices, store_id)
+        if self.pending_fingerprints:
+            self.cache.hset(PRODUCT_FINGERPRINT_CACHE_KEY, mapping=self.pending_fingerprints)
+        if self.pending_search_products:
+            with self.metrics_util.timer("search_index_update"):
+                self.search_index.update(list(self.pending_search_products.values()))
+        if self.pending_price_events or self.pending_new_prices:
+            with self.metrics_util.timer("price_feed_write"):
+                self.price_change_feed.record(self.pending_price_events, self.pending_new_prices)
+        if self.pending_last_seen:
+            # Another worker may have seen the products since, so the union keeps the later time without needing the
+            # GT flag of ZADD, which Redis 6.0 lacks
+            pipeline = self.cache.pipeline(transaction=False)
+            for category_id, last_seen in self.pending_last_seen.items():
+                last_seen_key = f"{CATEGORY_LAST_SEEN_CACHE_KEY}_{category_id}"
+                temp_key = f"{last_seen_key}_flush_{uuid.uuid4().hex}"
+                pipeline.zadd(temp_key, last_seen)
+                pipeline.zunionstore(last_seen_key, [last_seen_key, temp_key], aggregate="MAX")
+                pipeline.delete(temp_key)
+            pipeline.execute()
+        self.cache_invalidator.add(*self.pending_cache_keys)
+        with self.metrics_util.timer("cache_invalidate"):
+            self.cache_invalidator.flush()
+
+        self.pending_latest_prices = {}
+        self.pending_price_product_ids = set()
+        self.pending_fingerprints = {}
+        self.pending_search_products = {}
+        self.pending_price_events = []
+        self.pending_new_prices = []
+        self.pending_cache_keys = set()
+        self.pending_last_seen = {}
+
+    def flush_writes(self):
+        """
+        Writes everything in the write buffer to the database, e.g. before shutting down.
+        """
+        self.write_buffer.flush()
+        self.flush_cache_invalidations()
+
+    def prune_category_products(
+        self, category_ids: List[int], expiry_days: int = CATEGORY_MEMBERSHIP_EXPIRY_DAYS
+    ) -> int:
+        """
+        Takes categories out of the products that have not been listed in them for `expiry_days`, so products that
+        left a category drop out of its listing. Products already in a category before it was first pruned count as
+        listed at that time.
+
+        Meant to run once at the end of a crawl, after `flush_writes`: a write still in the buffer could add a category
+        back to a product after it was taken out.
+
+        Returns:
+            The number of memberships removed
+        """
+        # Hold off new writes while the products are updated
+        with self.write_buffer.lock:
+            num_pruned = sum(self._prune_category(category_id, expiry_days) for category_id in category_ids)
+        return num_pruned
+
+    def _prune_category(self, category_id: int, expiry_days: int) -> int:
+        last_seen_key = f"{CATEGORY_LAST_SEEN_CACHE_KEY}_{category_id}"
+        # The same products get_category_products lists
+        category_filter = {
+            "$or": [{"categories": category_id}, {"categories": {"$exists": False}, "category": category_id}]
+        }
+        now = time.time()
+        member_ids = [
+            document["id"]
+            for document in self.products_collection.find(category_filter, projection={"_id": False, "id": True})
+        ]
+        if member_ids:
+            self.cache.zadd(last_seen_key, {product_id: now for product_id in member_ids}, nx=True)
+        stale_product_ids = [
+            int(product_id)
+            for product_id in self.cache.zrangebyscore(last_seen_key, "-inf", now - expiry_days * 24 * 60 * 60)
+        ]
+        if not stale_product_ids:
+            return 0
+
         operations = []
-        for price_container in price_containers:
-            product_document = price_container.product_document
-            operations.append(
+        recategorized_products = []
+        cache_keys = {f"{CATEGORY_PRODUCTS_CACHE_KEY}_{category_id}"}
+        for document in self.products_collection.find(
+            {"id": {"$in": stale_product_ids}, **category_filter}, projection={"_id": False}
+        ):
+            categories = [c for c in document.get("categories", [document["category"]]) if c != category_id]
+            # A product left without categories keeps its last one as the primary category but is not listed
+            fields = {"categories": categories, "category": min(categories) if categories else document["category"]}
+            operations.append(UpdateOne(filter={"id": document["id"]}, update={"$set": fields}))
+            if fields["category"] != document["category"]:
+                recategorized_products.append(
+                    ProductDocument(id=document["id"], display_name=document["display_name"], **fields)
+                )
+            # Listings of the other categories show the product's categories as well
+            cache_keys.update(f"{CATEGORY_PRODUCTS_CACHE_KEY}_{c}" for c in categories)
+
+        if operations:
+            self.products_collection.bulk_write(operations, ordered=False)
+        # The fingerprints still hold the category, which would be merged back into the next write of the products
+        self.cache.hdel(PRODUCT_FINGERPRINT_CACHE_KEY, *stale_product_ids)
+        self.cache.zrem(last_seen_key, *stale_product_ids)
+        if recategorized_products:
+            self.search_index.update(recategorized_products)
+        self.cache_invalidator.add(*cache_keys)
+        self.cache_invalidator.flush()
+
+        self.logger_util.write(
+            f"Took {len(operations)} products that are no longer listed out of category {category_id}"
+        )
+        self.metrics_util.increment("category_products_pruned", len(operations), category_id)
+        return len(operations)
+
+    def _get_store_id(self, store_id: Optional[int]) -> Optional[int]:
+        return self.default_store_id if store_id is None else store_id
+
+    def _get_store_filter(self, store_id: Optional[int]) -> dict:
+        store_id = self._get_store_id(store_id)
+        if self.price_layout == PRICE_LAYOUT_BUCKETS or store_id != self.default_store_id:
+            return {"store_id": store_id}
+
+        # None also matches documents without the field
+        return {"store_id": {"$in": [store_id, None]}}
+
+    def get_price_history_cache_key(self, product_id: int, store_id: Optional[int] = None) -> str:
+        store_id = self._get_store_id(store_id)
+        if store_id == self.default_store_id:
+            return f"{PRODUCT_PRICE_HISTORY_CACHE_PREFIX}_{product_id}"
+        return f"{PRODUCT_PRICE_HISTORY_CACHE_PREFIX}_{store_id}_{product_id}"
+
+    def _create_price_buckets_index(self):
+        self.price_buckets_collection.create_index(
+            [("product_id", pymongo.ASCENDING), ("store_id", pymongo.ASCENDING), ("bucket_start", pymongo.DESCENDING)],
+            unique=True,
+        )
+        self.price_buckets_collection.create_index([("last_date", pymongo.ASCENDING)])
+
+    def get_latest_prices(self, product_ids: List[int], store_id: Optional[int] = None) -> Dict[int, Optional[int]]:
+        """
+        Fetches the most recent price for each of the given products at a store.
+
+        The lookup is done with one aggregation per batch of products rather than one query per product.
+
+        Args:
+            product_ids: The IDs of the products to look up
+            store_id: The store the prices are from, the default store if not given
+
+        Returns:
+            A mapping from product ID to its most recent price in cents. Products without a price are left out.
+        """
+        unique_product_ids = list(dict.fromkeys(product_ids))
+
+        latest_prices = {}
+        for i in range(0, len(unique_product_ids), LATEST_PRICE_BATCH_SIZE):
+            batch_end = i + LATEST_PRICE_BATCH_SIZE
+            batch = unique_product_ids[i:batch_end]
+            collection, pipeline = self._get_latest_price_pipeline(
+                {"product_id": {"$in": batch}, **self._get_store_filter(store_id)}
+            )
+            for document in collection.aggregate(pipeline):
+                latest_prices[document["_id"]] = document["price_cents"]
+
+        return latest_prices
+
+    def _get_latest_price_pipeline(self, match: Optional[dict], group_by_store: bool = False):
+        # Sorting on the (product_id, date) index lets the group stage pick the newest document directly
+        if self.price_layout == PRICE_LAYOUT_BUCKETS:
+            collection, date_field, price_field = self.price_buckets_collection, "bucket_start", "$last_price_cents"
+        else:
+            collection, date_field, price_field = self.prices_collection, "start_date", "$price_cents"
+
+        group_id = "$product_id"
+        if group_by_store:
+            group_id = {"product_id": "$product_id", "store_id": {"$ifNull": ["$store_id", self.default_store_id]}}
+
+        pipeline = [] if match is None else [{"$match": match}]
+        pipeline.append({"$sort": {"product_id": pymongo.ASCENDING, date_field: pymongo.DESCENDING}})
+        pipeline.append({"$group": {"_id": group_id, "price_cents": {"$first": price_field}}})
+        return collection, pipeline
+
+    def get_price_history(self, product_id: int, store_id: Optional[int] = None) -> List[PriceDocument]:
+        """
+        Fetches every price point recorded for a product at a store, oldest first, from whichever price layout is in
+        use.
+        """
+        return self.get_price_histories([product_id], store_id)[product_id]
+
+    def get_price_histories(
+        self, product_ids: List[int], store_id: Optional[int] = None
+    ) -> Dict[int, List[PriceDocument]]:
+        """
+        Fetches the price history of many products at a store with one query per batch of products.
+
+        Args:
+            product_ids: The IDs of the products to look up
+            store_id: The store the prices are from, the default store if not given
+
+        Returns:
+            A mapping from product ID to its price points, oldest first. Products without prices map to an empty list.
+        """
+        store_id = self._get_store_id(store_id)
+        unique_product_ids = list(dict.fromkeys(product_ids))
+        price_histories: Dict[int, List[PriceDocument]] = {product_id: [] for product_id in unique_product_ids}
+
+        for i in range(0, len(unique_product_ids), LATEST_PRICE_BATCH_SIZE):
+            batch_end = i + LATEST_PRICE_BATCH_SIZE
+            batch = unique_product_ids[i:batch_end]
+            if self.price_layout == PRICE_LAYOUT_BUCKETS:
+                buckets = self.price_buckets_collection.find(
+                    filter={"product_id": {"$in": batch}, **self._get_store_filter(store_id)},
+                    sort=[("product_id", pymongo.ASCENDING), ("bucket_start", pymongo.ASCENDING)],
+                )
+                for bucket in buckets:
+                    price_histories[bucket["product_id"]].extend(
+                        PriceDocument(
+                            product_id=bucket["product_id"],
+                            price_cents=price["price_cents"],
+                            start_date=price["start_date"],
+                            store_id=store_id,
+                        )
+                        for price in bucket["prices"]
+                    )
+            else:
+                documents = self.prices_collection.find(
+                    filter={"product_id": {"$in": batch}, **self._get_store_filter(store_id)},
+                    sort=[("product_id", pymongo.ASCENDING), ("start_date", pymongo.ASCENDING)],
+                )
+                for document in documents:
+                    price_histories[document["product_id"]].append(
+                        PriceDocument(
+                            product_id=document["product_id"],
+                            price_cents=document["price_cents"],
+                            start_date=document["start_date"],
+                            store_id=store_id,
+                        )
+                    )
+
+        return price_histories
+
+    @staticmethod
+    def _get_bucket_start(start_date: datetime) -> datetime:
+        return datetime(start_date.year, start_date.month, 1)
+
+    def _build_price_operations(self, price_documents: List[PriceDocument]) -> list:
+        # A failed flush can leave some of its writes applied, so every write has to be safe to send again
+        if self.price_layout != PRICE_LAYOUT_BUCKETS:
+            return [
                 UpdateOne(
-                    filter={"id": product_document.id},
-                    update={"$set": dataclasses.asdict(product_document)},
+                    filter={
+                        "product_id": price_document.product_id,
+                        "store_id": self._get_store_id(price_document.store_id),
+                        "start_date": price_document.start_date,
+                    },
+                    update={"$set": {"price_cents": price_document.price_cents}},
                     upsert=True,
                 )
+                for price_document in price_documents
+            ]
+
+        # Prices are always recorded in date order, so the newest price in a bucket is the last one added
+        return [
+            UpdateOne(
+                filter={
+                    "product_id": price_document.product_id,
+                    "store_id": self._get_store_id(price_document.store_id),
+                    "bucket_start": self._get_bucket_start(price_document.start_date),
+                },
+                update={
+                    "$addToSet": {
+                        "prices": {"price_cents": price_document.price_cents, "start_date": price_document.start_date}
+                    },
+                    "$set": {"last_price_cents": price_document.price_cents},
+                    "$max": {"last_date": price_document.start_date},
+                },
+                upsert=True,
             )
+            for price_document in price_documents
+        ]
+
+    def backfill_price_buckets(self) -> int:
+        """
+        Copies the prices collection into the bucketed layout.
+
+        Buckets are replaced wholesale, so this is safe to run again but should finish before crawls start writing
+        buckets for the current month.
+
+        Returns:
+            The number of bucket documents written
+        """
+        self._create_price_buckets_index()
+
+        operations = []
+        num_buckets = 0
+        product_id = None
+        # The open buckets of the current product, by store and month
+        buckets: Dict[Tuple[Optional[int], datetime], dict] = {}
+        # Walking the (product_id, start_date) index backwards gives each product's prices in date order
+        documents = self.prices_collection.find(
+            sort=[("product_id", pymongo.DESCENDING), ("start_date", pymongo.ASCENDING)]
+        )
+        for document in documents:
+            if document["product_id"] != product_id:
+                operations.extend(self._build_bucket_replacement(bucket) for bucket in buckets.values())
+                product_id = document["product_id"]
+                buckets = {}
+
+            store_id = self._get_store_id(document.get("store_id"))
+            bucket_start = self._get_bucket_start(document["start_date"])
+            bucket = buckets.setdefault(
+                (store_id, bucket_start),
+                {"product_id": product_id, "store_id": store_id, "bucket_start": bucket_start, "prices": []},
+            )
+            bucket["prices"].append({"price_cents": document["price_cents"], "start_date": document["start_date"]})
+
+            if len(operations) >= PRICE_BUCKET_BATCH_SIZE:
+                self.price_buckets_collection.bulk_write(operations, ordered=False)
+                num_buckets += len(operations)
+                operations = []
+
+        operations.extend(self._build_bucket_replacement(bucket) for bucket in buckets.values())
+        if operations:
+            self.price_buckets_collection.bulk_write(operations, ordered=False)
+            num_buckets += len(operations)
+
+        self.logger_util.write(f"Backfilled {num_buckets} price buckets")
+        return num_buckets
 
-        if not operations:
-            self.logger_util.write("Upserted 0 product documents")
+    @staticmethod
+    def _build_bucket_replacement(bucket: dict) -> ReplaceOne:
+        bucket["last_price_cents"] = bucket["prices"][-1]["price_cents"]
+        bucket["last_date"] = bucket["prices"][-1]["start_date"]
+        return ReplaceOne(
+            filter={
+                "product_id": bucket["product_id"],
+                "store_id": bucket["store_id"],
+                "bucket_start": bucket["bucket_start"],
+            },
+            replacement=bucket,
+            upsert=True,
+        )
+
+    @staticmethod
+    def _encode_snapshot_price(price_cents: Optional[int]) -> str:
+        # Redis cannot store None, so products without a price are stored as an empty string
+        return "" if price_cents is None else str(price_cents)
+
+    @staticmethod
+    def _decode_snapshot_price(value: bytes) -> Optional[int]:
+        return int(value) if value else None
+
+    def _get_snapshot_key(self, store_id: Optional[int]) -> str:
+        store_id = self._get_store_id(store_id)
+        if store_id == self.default_store_id:
+            return LAST_PRICE_SNAPSHOT_CACHE_KEY
+        return f"{LAST_PRICE_SNAPSHOT_CACHE_KEY}_{store_id}"
+
+    def _get_snapshot_prices(self, product_ids: List[int], store_id: Optional[int]) -> Dict[int, Optional[int]]:
+        if not product_ids:
+            return {}
+
+        values = self.cache.hmget(self._get_snapshot_key(store_id), product_ids)
+        return {
+            product_id: self._decode_snapshot_price(value)
+            for product_id, value in zip(product_ids, values)
+            if value is not None
+        }
+
+    def update_snapshot_prices(self, latest_prices: Dict[int, Optional[int]], store_id: Optional[int]):
+        """
+        Sets the last known price of products at a store, e.g. after their stored prices were changed outside a crawl.
+        """
+        if not latest_prices:
             return
 
-        result = self.products_collection.bulk_write(operations)
-        num_documents_changed = result.upserted_count + result.modified_count
-        self.logger_util.write(f"Upserted/Modified {num_documents_changed} product documents")
-
-        if num_documents_changed > 0:
-            # We should reset this category's cache to show the new product data
-            cache_key = f"{CATEGORY_PRODUCTS_CACHE_KEY}_{category_document.id}"
-            self.cache.delete(cache_key)
-            # We should also reset the product display name cache for any products
-            # that actually changed, but this is not easy to do since bulk_write
-            # does not return the ids of modified documents, only the ones that
-            # were upserted (did not exist before). Instead, we just rely on the
-            # one-day cache TTL and know that there may be stale product names
-            # for a single day.
-
-    def _ensure_prices_exist(self, price_containers: List[PriceContainer]):
+        mapping = {product_id: self._encode_snapshot_price(price) for product_id, price in latest_prices.items()}
+        self.cache.hset(self._get_snapshot_key(store_id), mapping=mapping)
+
+    def rebuild_price_snapshot(self) -> int:
+        """
+        Rebuilds the last-known-price snapshot of every store from the stored prices.
+
+        Returns:
+            The number of products in the rebuilt snapshots, counted once per store
+        """
+        self.cache.delete(LAST_PRICE_SNAPSHOT_CACHE_KEY, *self.cache.scan_iter(f"{LAST_PRICE_SNAPSHOT_CACHE_KEY}_*"))
+
+        collection, pipeline = self._get_latest_price_pipeline(match=None, group_by_store=True)
+        num_products = 0
+        batches: Dict[Optional[int], Dict[int, Optional[int]]] = {}
+        for document in collection.aggregate(pipeline, allowDiskUse=True):
+            store_id = document["_id"]["store_id"]
+            batch = batches.setdefault(store_id, {})
+            batch[document["_id"]["product_id"]] = document["price_cents"]
+            if len(batch) >= LATEST_PRICE_BATCH_SIZE:
+                self.update_snapshot_prices(batch, store_id)
+                num_products += len(batch)
+                batches[store_id] = {}
+
+        for store_id, batch in batches.items():
+            self.update_snapshot_prices(batch, store_id)
+            num_products += len(batch)
+
+        self.logger_util.write(f"Rebuilt price snapshot with {num_products} products")
+        return num_products
+
+    def _ensure_prices_exist(self, price_containers: List[PriceContainer]) -> PriceSaveResult:
+        # To save space in the database, we only want to insert documents when the price changes. The snapshot
+        # answers this for most products so we only need to ask the database about the ones it does not know.
+        # Every price on a page comes from the same store.
+        price_containers = [
+            price_container for price_container in price_containers if price_container.price_document is not None
+        ]
+        if not price_containers:
+            return PriceSaveResult()
+        store_id = self._get_store_id(price_containers[0].price_document.store_id)
+        product_ids = [price_container.price_document.product_id for price_container in price_containers]
+        latest_prices = {
+            product_id: self.pending_latest_prices[(store_id, product_id)]
+            for product_id in product_ids
+            if (store_id, product_id) in self.pending_latest_prices
+        }
+        with self.metrics_util.timer("snapshot_read"):
+            latest_prices.update(
+                self._get_snapshot_prices(
+                    [product_id for product_id in product_ids if product_id not in latest_prices], store_id
+                )
+            )
+        missing_product_ids = [product_id for product_id in product_ids if product_id not in latest_prices]
+        self.metrics_util.increment("snapshot_misses", len(missing_product_ids))
+        if missing_product_ids:
+            with self.metrics_util.timer("latest_price_read"):
+                latest_prices.update(self.get_latest_prices(missing_product_ids, store_id))
+
         # Determine which price documents actually need to be saved
-        operations = []
+        changed_price_documents = []
+        price_events = []
+        new_prices = []
+        num_new = 0
+        num_unchanged = 0
         for price_container in price_containers:
             price_document = price_container.price_document
             product_id = price_document.product_id
 
-            # To save space in the database, we only want to insert documents when the price changes
-            most_recent_price_document = self.prices_collection.find_one(
-                filter={"product_id": product_id}, sort=[("start_date", pymongo.DESCENDING)]
-            )
-            if most_recent_price_document:
-                most_recent_price = most_recent_price_document["price_cents"]
+            if product_id in latest_prices:
+                most_recent_price = latest_prices[product_id]
                 if most_recent_price == price_document.price_cents:
-                    self.logger_util.write(f"Skipping update for product {product_id} as the price is unchanged")
+                    self.logger_util.debug(f"Skipping update for product {product_id} as the price is unchanged")
+                    num_unchanged += 1
                     continue
                 else:
-                    self.logger_util.write(f"Updating price for product {product_id}")
+                    self.logger_util.debug(f"Updating price for product {product_id}")
+                    # The old price is at hand here, so the change is recorded without reading the history again
+                    price_events.append(
+                        PriceChangeEvent(
+                            product_id=product_id,
+                            store_id=store_id,
+                            old_price_cents=most_recent_price,
+                            new_price_cents=price_document.price_cents,
+                            change_percent=get_change_percent(most_recent_price, price_document.price_cents),
+                            time=price_document.start_date,
+                        )
+                    )
             else:
-                self.logger_util.write(f"New product found: {product_id}")
+                self.logger_util.debug(f"New product found: {product_id}")
+                num_new += 1
+                new_prices.append(dataclasses.replace(price_document, store_id=store_id))
 
-            operation = InsertOne(dataclasses.asdict(price_document))
-            operations.append(operation)
+            changed_price_documents.append(price_document)
 
-        if operations:
-            result = self.prices_collection.bulk_write(operations)
-            self.logger_util.write(f"Inserted {result.inserted_count} price documents")
-        else:
-            self.logger_util.write("Inserted 0 price documents")
+        num_changed = len(changed_price_documents) - num_new
+        if any(
+            (store_id, document.product_id) in self.pending_price_product_ids for document in changed_price_documents
+        ):
+            # A product's prices have to be written in order, so get its earlier price in before queueing this one
+            self.write_buffer.flush()
+
+        collection = (
+            self.price_buckets_collection if self.price_layout == PRICE_LAYOUT_BUCKETS else self.prices_collection
+        )
+        for operation in self._build_price_operations(changed_price_documents):
+            self.write_buffer.add(collection, operation)
+        self.logger_util.write(
+            f"Queued {len(changed_price_documents)} prices "
+            f"({num_new} new, {num_changed} changed, {num_unchanged} unchanged)"
+        )
+
+        # Every price on this page is now the latest price for its product. We want to wait until the database update
+        # happens before we unset the cache entries for any new products or products that changed prices.
+        self.pending_price_product_ids.update((store_id, document.product_id) for document in changed_price_documents)
+        self.pending_latest_prices.update(
+            {
+                (store_id, price_container.price_document.product_id): price_container.price_document.price_cents
+                for price_container in price_containers
+            }
+        )
+        self.pending_cache_keys.update(
+            self.get_price_history_cache_key(document.product_id, store_id) for document in changed_price_documents
+        )
+        self.pending_price_events.extend(price_events)
+        self.pending_new_prices.extend(new_prices)
 
-        # We want to wait until the database update happens before we unset the cache entries for any new products or
-        # products that changed prices.
-        for operation in operations:
-            product_id = operation._doc["product_id"]
-            cache_key = f"{PRODUCT_PRICE_HISTORY_CACHE_PREFIX}_{product_id}"
-            self.cache.delete(cache_key)
+        return PriceSaveResult(num_new=num_new, num_changed=num_changed, num_unchanged=num_unchanged)
 
     def _ensure_category_exists(self, category_document: CategoryDocument):
+        # Every page of a category carries the same category document, so it only needs writing once per run
+        if self.saved_categories.get(category_document.id) == category_document.display_name:
+            return
+
         update_result = self.categories_collection.update_one(
             filter={"id": category_document.id}, update={"$set": dataclasses.asdict(category_document)}, upsert=True
         )
 
         if update_result.modified_count > 0:
-            cache_key = f"{CATEGORY_NAME_CACHE_KEY}_{category_document.id}"
-            self.cache.delete(cache_key)
+            self.cache_invalidator.add(f"{CATEGORY_NAME_CACHE_KEY}_{category_document.id}")
+        if update_result.modified_count > 0 or update_result.upserted_id is not None:
+            # The category list includes display names, so it is stale for new and renamed categories alike
+            self.cache_invalidator.add(CATEGORIES_CACHE_KEY)
+        self.saved_categories[category_document.id] = category_document.display_name
+
+    def flush_cache_invalidations(self):
+        """
+        Drops every cache entry still waiting to be invalidated, e.g. at the end of a category when invalidation is
+        deferred.
+        """
+        with self.metrics_util.timer("cache_invalidate"):
+            self.cache_invalidator.flush(force=True)
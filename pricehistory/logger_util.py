@@ -1,34 +1,148 @@
+import atexit
+import json
+import logging
 import os
+import queue
+import sys
+import threading
+import time
+import traceback
 from datetime import datetime
-from typing import IO, Optional
+from typing import IO, List, Optional
+
+from pricehistory.constants import LOG_FLUSH_INTERVAL_SECONDS, LOG_FLUSH_SIZE_BYTES
+
+_STOP = object()
 
 
 class LoggerUtil:
-    def __init__(self):
+    """
+    Writes log messages to the console, logs/latest.txt and a dated log file.
+
+    Messages below the configured level are dropped. While the logger is open, messages are handed to a background
+    thread that writes them in batches once enough bytes are buffered or enough time has passed, and everything left
+    is written when the logger is closed or the program exits.
+    """
+
+    def __init__(
+        self,
+        level: int = logging.INFO,
+        dump_responses: bool = False,
+        flush_size_bytes: int = LOG_FLUSH_SIZE_BYTES,
+        flush_interval_seconds: float = LOG_FLUSH_INTERVAL_SECONDS,
+    ):
+        self.level = level
+        self.dump_responses = dump_responses
+        self.flush_size_bytes = flush_size_bytes
+        self.flush_interval_seconds = flush_interval_seconds
+
         self.latest_log_file: Optional[IO] = None
         self.dated_log_file: Optional[IO] = None
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.writer_thread: Optional[threading.Thread] = None
 
     def __enter__(self):
         log_file_name = f"{datetime.now()}.txt".replace(":", "_")
         os.makedirs("logs", exist_ok=True)
         self.latest_log_file = open(os.path.join("logs", "latest.txt"), mode="w", encoding="utf-8")
         self.dated_log_file = open(os.path.join("logs", log_file_name), mode="w", encoding="utf-8")
+
+        self.writer_thread = threading.Thread(target=self._write_batches, name="logger-util", daemon=True)
+        self.writer_thread.start()
+        atexit.register(self.close)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.writer_thread is not None:
+            self.queue.put(_STOP)
+            self.writer_thread.join()
+            self.writer_thread = None
+            atexit.unregister(self.close)
+
         if self.latest_log_file:
             self.latest_log_file.close()
+            self.latest_log_file = None
 
         if self.dated_log_file:
             self.dated_log_file.close()
+            self.dated_log_file = None
+
+    def configure(self, level: Optional[int] = None, dump_responses: Optional[bool] = None):
+        if level is not None:
+            self.level = level
+        if dump_responses is not None:
+            self.dump_responses = dump_responses
+
+    def _write_lines(self, lines: List[str]):
+        text = "".join(lines)
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+        for log_file in (self.latest_log_file, self.dated_log_file):
+            if log_file:
+                log_file.write(text)
+                log_file.flush()
+
+    def _write_batches(self):
+        lines = []
+        buffered_bytes = 0
+        last_flush_time = time.monotonic()
+        stopping = False
+
+        while not stopping:
+            timeout = max(0.0, last_flush_time + self.flush_interval_seconds - time.monotonic())
+            try:
+                line = self.queue.get(timeout=timeout)
+                if line is _STOP:
+                    stopping = True
+                else:
+                    lines.append(line)
+                    buffered_bytes += len(line)
+            except queue.Empty:
+                pass
+
+            interval_elapsed = time.monotonic() - last_flush_time >= self.flush_interval_seconds
+            if lines and (stopping or interval_elapsed or buffered_bytes >= self.flush_size_bytes):
+                self._write_lines(lines)
+                lines = []
+                buffered_bytes = 0
+            if interval_elapsed:
+                last_flush_time = time.monotonic()
+
+    def write(self, message: str, level: int = logging.INFO):
+        if level < self.level:
+            return
+
+        line = f"{message}\n"
+        if self.writer_thread is not None:
+            self.queue.put(line)
+        else:
+            # Not opened as a context manager, so there is no writer thread or files to write to
+            self._write_lines([line])
+
+    def debug(self, message: str):
+        self.write(message, level=logging.DEBUG)
+
+    def info(self, message: str):
+        self.write(message, level=logging.INFO)
+
+    def warning(self, message: str):
+        self.write(message, level=logging.WARNING)
+
+    def error(self, message: str):
+        self.write(message, level=logging.ERROR)
 
-    def write(self, message: str):
-        print(message)
+    def exception(self, message: str):
+        self.write(f"{message}\n{traceback.format_exc().rstrip()}", level=logging.ERROR)
 
-        self.latest_log_file.write(message)
-        self.latest_log_file.write("\n")
-        self.latest_log_file.flush()
+    def dump_response(self, label: str, response: dict):
+        """
+        Writes a raw API response to the log. Responses are large, so this only happens when dumps are turned on.
+        """
+        if not self.dump_responses:
+            return
 
-        self.dated_log_file.write(message)
-        self.dated_log_file.write("\n")
-        self.dated_log_file.flush()
+        self.write(f"Response for {label}: {json.dumps(response, default=str)}")
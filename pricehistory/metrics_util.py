@@ -0,0 +1,161 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from atomicwrites import atomic_write
+
+from pricehistory.constants import METRICS_LATENCY_BUCKETS_SECONDS, METRICS_PREFIX
+
+MetricKey = Tuple[str, Optional[str]]
+
+
+class _Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(METRICS_LATENCY_BUCKETS_SECONDS)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        for i, upper_bound in enumerate(METRICS_LATENCY_BUCKETS_SECONDS):
+            if value <= upper_bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def quantile(self, quantile: float) -> Optional[float]:
+        # Estimated as the upper bound of the bucket the quantile falls in, capped at the largest value seen
+        if self.count == 0:
+            return None
+
+        target = quantile * self.count
+        seen = 0
+        for upper_bound, bucket_count in zip(METRICS_LATENCY_BUCKETS_SECONDS, self.bucket_counts):
+            seen += bucket_count
+            if seen >= target:
+                return min(upper_bound, self.max)
+        return self.max
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_seconds": self.total,
+            "mean_seconds": self.total / self.count if self.count else None,
+            "min_seconds": self.min,
+            "max_seconds": self.max,
+            "p50_seconds": self.quantile(0.5),
+            "p95_seconds": self.quantile(0.95),
+        }
+
+
+class MetricsUtil:
+    """
+    Collects counters and latency histograms for each stage of a crawl, optionally broken down by category.
+    """
+
+    def __init__(self):
+        self.counters: Dict[MetricKey, float] = {}
+        self.histograms: Dict[MetricKey, _Histogram] = {}
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def reset(self):
+        """
+        Drops every metric collected so far, so a long-running process can report each crawl on its own.
+        """
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.start_time = time.time()
+
+    @staticmethod
+    def _key(name: str, category: Optional[int]) -> MetricKey:
+        return name, None if category is None else str(category)
+
+    def increment(self, name: str, amount: float = 1, category: Optional[int] = None):
+        key = self._key(name, category)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, stage: str, seconds: float, category: Optional[int] = None):
+        key = self._key(stage, category)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = _Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str, category: Optional[int] = None):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time, category)
+
+    def summary(self) -> dict:
+        with self.lock:
+            counters = {}
+            for (name, category), value in sorted(
+                self.counters.items(), key=lambda item: (item[0][0], item[0][1] or "")
+            ):
+                counters.setdefault(name, {})["total" if category is None else category] = value
+
+            stages = {}
+            for (stage, category), histogram in sorted(
+                self.histograms.items(), key=lambda item: (item[0][0], item[0][1] or "")
+            ):
+                stages.setdefault(stage, {})["total" if category is None else category] = histogram.as_dict()
+
+        return {
+            "started_at": self.start_time,
+            "duration_seconds": time.time() - self.start_time,
+            "counters": counters,
+            "stages": stages,
+        }
+
+    def write_summary(self, file_path: str):
+        with atomic_write(file_path, mode="w", encoding="utf-8", overwrite=True) as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
+
+    @staticmethod
+    def _labels(**labels) -> str:
+        label_strings = [f'{name}="{value}"' for name, value in labels.items() if value is not None]
+        return "{" + ",".join(label_strings) + "}" if label_strings else ""
+
+    def write_prometheus(self, file_path: str):
+        """
+        Writes every metric in the Prometheus text exposition format, e.g. for the node exporter textfile collector.
+        """
+        lines = []
+        with self.lock:
+            counter_names = sorted({name for name, _ in self.counters})
+            for name in counter_names:
+                metric_name = f"{METRICS_PREFIX}_{name}_total"
+                lines.append(f"# TYPE {metric_name} counter")
+                for (counter_name, category), value in self.counters.items():
+                    if counter_name == name:
+                        lines.append(f"{metric_name}{self._labels(category=category)} {value}")
+
+            metric_name = f"{METRICS_PREFIX}_stage_seconds"
+            lines.append(f"# TYPE {metric_name} histogram")
+            for (stage, category), histogram in self.histograms.items():
+                cumulative_count = 0
+                for upper_bound, bucket_count in zip(METRICS_LATENCY_BUCKETS_SECONDS, histogram.bucket_counts):
+                    cumulative_count += bucket_count
+                    labels = self._labels(stage=stage, category=category, le=upper_bound)
+                    lines.append(f"{metric_name}_bucket{labels} {cumulative_count}")
+                labels = self._labels(stage=stage, category=category, le="+Inf")
+                lines.append(f"{metric_name}_bucket{labels} {histogram.count}")
+                labels = self._labels(stage=stage, category=category)
+                lines.append(f"{metric_name}_sum{labels} {histogram.total}")
+                lines.append(f"{metric_name}_count{labels} {histogram.count}")
+
+        with atomic_write(file_path, mode="w", encoding="utf-8", overwrite=True) as prometheus_file:
+            prometheus_file.write("\n".join(lines) + "\n")
@@ -0,0 +1,100 @@
+from datetime import datetime
+from typing import Dict, Optional
+
+import numpy as np
+
+from pricehistory.constants import MISSING_PRICE_CENTS
+from pricehistory.data.price_columns import PriceColumns
+
+
+def _filter(columns: PriceColumns, mask: np.ndarray) -> PriceColumns:
+    return PriceColumns(
+        product_id=columns.product_id[mask],
+        store_id=columns.store_id[mask],
+        price_cents=columns.price_cents[mask],
+        start_date=columns.start_date[mask],
+    )
+
+
+def compute_price_stats(
+    columns: PriceColumns, window_start: Optional[datetime] = None, window_end: Optional[datetime] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Computes price statistics for every product at every store in one vectorized pass over the exported prices.
+
+    Only prices that start inside the window count as changes. The price a product already had when the window opened
+    is included as its starting price, so products whose price did not move in the window still show it.
+
+    Args:
+        columns: The prices to analyze, e.g. from `price_export_util.load_prices`
+        window_start: Ignore price changes before this time, if given
+        window_end: Ignore price changes from this time on, if given
+
+    Returns:
+        Columns with one row per product and store, sorted by product ID then store ID: `product_id`, `store_id`,
+        `min_price_cents`, `max_price_cents` and `mean_price_cents` of the recorded prices, `num_changes` and
+        `largest_drop_cents` between consecutive prices. Prices are MISSING_PRICE_CENTS, or NaN for the mean, when the
+        product had no online price in the window.
+    """
+    order = np.lexsort((columns.start_date, columns.store_id, columns.product_id))
+    columns = _filter(columns, order)
+
+    if window_end is not None:
+        columns = _filter(columns, columns.start_date < np.datetime64(window_end, "ms"))
+    if window_start is not None:
+        before = columns.start_date < np.datetime64(window_start, "ms")
+        same_group_as_next = (columns.product_id[1:] == columns.product_id[:-1]) & (
+            columns.store_id[1:] == columns.store_id[:-1]
+        )
+        # The last price before the window is the one in effect when it opens
+        next_also_before = np.append(same_group_as_next & before[1:], False)
+        columns = _filter(columns, ~before | ~next_also_before)
+
+    num_rows = len(columns)
+    if num_rows == 0:
+        empty_ints = np.empty(0, dtype=np.int64)
+        return {
+            "product_id": empty_ints,
+            "store_id": empty_ints,
+            "min_price_cents": empty_ints,
+            "max_price_cents": empty_ints,
+            "mean_price_cents": np.empty(0, dtype=np.float64),
+            "num_changes": empty_ints,
+            "largest_drop_cents": empty_ints,
+        }
+
+    same_group_as_previous = np.empty(num_rows, dtype=bool)
+    same_group_as_previous[0] = False
+    same_group_as_previous[1:] = (columns.product_id[1:] == columns.product_id[:-1]) & (
+        columns.store_id[1:] == columns.store_id[:-1]
+    )
+    group_starts = np.flatnonzero(~same_group_as_previous)
+    group_sizes = np.diff(np.append(group_starts, num_rows))
+
+    prices = columns.price_cents
+    available = prices != MISSING_PRICE_CENTS
+    num_available = np.add.reduceat(available.astype(np.int64), group_starts)
+    min_prices = np.minimum.reduceat(np.where(available, prices, np.iinfo(np.int64).max), group_starts)
+    max_prices = np.maximum.reduceat(np.where(available, prices, MISSING_PRICE_CENTS), group_starts)
+    price_sums = np.add.reduceat(np.where(available, prices, 0), group_starts)
+
+    # A drop is only counted between two consecutive known prices of the same product and store
+    drops = np.zeros(num_rows, dtype=np.int64)
+    drops[1:] = prices[:-1] - prices[1:]
+    drops[~(same_group_as_previous & available & np.roll(available, 1))] = 0
+    largest_drops = np.maximum.reduceat(np.maximum(drops, 0), group_starts)
+
+    no_prices = num_available == 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_prices = np.where(no_prices, np.nan, price_sums / num_available)
+
+    return {
+        "product_id": columns.product_id[group_starts],
+        "store_id": columns.store_id[group_starts],
+        "min_price_cents": np.where(no_prices, MISSING_PRICE_CENTS, min_prices),
+        "max_price_cents": max_prices,
+        "mean_price_cents": mean_prices,
+        # Every price after the first one of a product is a change
+        "num_changes": group_sizes - 1,
+        "largest_drop_cents": largest_drops,
+    }
@@ -0,0 +1,200 @@
+import json
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import redis
+
+from pricehistory.constants import (
+    PRICE_CHANGE_STREAM_KEY,
+    PRICE_CHANGE_STREAM_MAX_LENGTH,
+    PRICE_STATS_CACHE_KEY,
+    PRICE_STATS_WINDOW_DAYS,
+)
+from pricehistory.data.price_change_event import PriceChangeEvent
+from pricehistory.data.price_document import PriceDocument
+from pricehistory.data.price_stats import PriceStats
+
+
+def get_change_percent(old_price_cents: Optional[int], new_price_cents: Optional[int]) -> Optional[float]:
+    if old_price_cents is None or new_price_cents is None or old_price_cents <= 0:
+        return None
+    return round((new_price_cents - old_price_cents) * 100 / old_price_cents, 2)
+
+
+def _encode_optional_int(value: Optional[int]) -> str:
+    return "" if value is None else str(value)
+
+
+def _decode_optional_int(value: str) -> Optional[int]:
+    return int(value) if value else None
+
+
+class PriceChangeFeed:
+    """
+    Feed of price changes and rolling price statistics of every product, kept in Redis as prices are saved so deal
+    queries and alerts never have to scan the price history.
+
+    Every change of a known product's price is added to a capped stream. Each product at each store also has its
+    current price, its all-time low and a monotonic deque of the prices in effect during the last `window_days` days:
+    every entry is cheaper than the ones after it, so the front is the window low. A new price ends the one before it
+    and drops the entries at the back it undercuts, and entries that ended before the window are dropped from the front,
+    so each change costs amortized O(1). Statistics start at the first price seen after the feed was added.
+    """
+
+    def __init__(
+        self,
+        cache: redis.Redis,
+        window_days: int = PRICE_STATS_WINDOW_DAYS,
+        max_events: int = PRICE_CHANGE_STREAM_MAX_LENGTH,
+    ):
+        self.cache = cache
+        self.window = timedelta(days=window_days)
+        self.max_events = max_events
+
+    @staticmethod
+    def _get_stats_key(store_id: Optional[int]) -> str:
+        return PRICE_STATS_CACHE_KEY if store_id is None else f"{PRICE_STATS_CACHE_KEY}_{store_id}"
+
+    def _add_price(self, stats: Optional[dict], price_cents: Optional[int], time: datetime) -> dict:
+        timestamp = time.timestamp()
+        if stats is None:
+            stats = {"price": None, "low": None, "low_time": None, "window": []}
+
+        # Entries are [start, price, end], and only the newest entry can still be in effect
+        window = stats["window"]
+        if window and window[-1][2] is None:
+            window[-1][2] = timestamp
+        if price_cents is not None:
+            while window and window[-1][1] >= price_cents:
+                window.pop()
+            window.append([timestamp, price_cents, None])
+            if stats["low"] is None or price_cents < stats["low"]:
+                stats["low"] = price_cents
+                stats["low_time"] = timestamp
+
+        window_start = (time - self.window).timestamp()
+        while window and window[0][2] is not None and window[0][2] < window_start:
+            window.pop(0)
+
+        stats["price"] = price_cents
+        return stats
+
+    def record(self, events: List[PriceChangeEvent], new_prices: List[PriceDocument]):
+        """
+        Adds the price changes of known products to the feed and the statistics, and starts the statistics of new
+        products. Several crawlers can record at once, a batch is retried if another one changed the same store's
+        statistics in the meantime.
+
+        Args:
+            events: Price changes in the order they were saved
+            new_prices: The first prices of products that had none
+        """
+        if not events and not new_prices:
+            return
+
+        products_by_key: Dict[str, Dict[int, None]] = {}
+        for price in new_prices:
+            products_by_key.setdefault(self._get_stats_key(price.store_id), {})[price.product_id] = None
+        for event in events:
+            products_by_key.setdefault(self._get_stats_key(event.store_id), {})[event.product_id] = None
+
+        def update(pipeline):
+            stats_by_key = {}
+            for key, product_ids in products_by_key.items():
+                product_ids = list(product_ids)
+                values = pipeline.hmget(key, product_ids)
+                stats_by_key[key] = {
+                    product_id: json.loads(value) for product_id, value in zip(product_ids, values) if value is not None
+                }
+
+            for price in new_prices:
+                stats = stats_by_key[self._get_stats_key(price.store_id)]
+                stats[price.product_id] = self._add_price(
+                    stats.get(price.product_id), price.price_cents, price.start_date
+                )
+            for event in events:
+                stats = stats_by_key[self._get_stats_key(event.store_id)]
+                product_stats = stats.get(event.product_id)
+                if product_stats is None:
+                    # The old price was in effect until this change, though it is not known since when
+                    product_stats = self._add_price(None, event.old_price_cents, event.time)
+                stats[event.product_id] = self._add_price(product_stats, event.new_price_cents, event.time)
+
+            pipeline.multi()
+            for key, stats in stats_by_key.items():
+                pipeline.hset(key, mapping={product_id: json.dumps(value) for product_id, value in stats.items()})
+            for event in events:
+                pipeline.xadd(
+                    PRICE_CHANGE_STREAM_KEY,
+                    {
+                        "product_id": event.product_id,
+                        "store_id": _encode_optional_int(event.store_id),
+                        "old_price_cents": _encode_optional_int(event.old_price_cents),
+                        "new_price_cents": _encode_optional_int(event.new_price_cents),
+                        "change_percent": "" if event.change_percent is None else event.change_percent,
+                        "time": event.time.isoformat(),
+                    },
+                    maxlen=self.max_events,
+                    approximate=True,
+                )
+
+        self.cache.transaction(update, *products_by_key)
+
+    @staticmethod
+    def _decode_event(fields: dict) -> PriceChangeEvent:
+        fields = {key.decode("utf-8"): value.decode("utf-8") for key, value in fields.items()}
+        return PriceChangeEvent(
+            product_id=int(fields["product_id"]),
+            store_id=_decode_optional_int(fields["store_id"]),
+            old_price_cents=_decode_optional_int(fields["old_price_cents"]),
+            new_price_cents=_decode_optional_int(fields["new_price_cents"]),
+            change_percent=float(fields["change_percent"]) if fields["change_percent"] else None,
+            time=datetime.fromisoformat(fields["time"]),
+        )
+
+    def get_recent_events(self, count: int) -> List[PriceChangeEvent]:
+        """
+        Fetches the newest price changes, newest first.
+        """
+        return [self._decode_event(fields) for _, fields in self.cache.xrevrange(PRICE_CHANGE_STREAM_KEY, count=count)]
+
+    def read_events(self, after_event_id: str = "0", count: int = 1000) -> List[Tuple[str, PriceChangeEvent]]:
+        """
+        Fetches price changes in the order they happened, e.g. to send alerts.
+
+        Args:
+            after_event_id: The ID of the last event already read, or "0" to start from the oldest event kept
+            count: The most events to return
+
+        Returns:
+            Event IDs with their events. The last ID is where the next read should continue.
+        """
+        response = self.cache.xread({PRICE_CHANGE_STREAM_KEY: after_event_id}, count=count)
+        if not response:
+            return []
+        return [(event_id.decode("utf-8"), self._decode_event(fields)) for event_id, fields in response[0][1]]
+
+    def get_stats(self, product_ids: List[int], store_id: Optional[int]) -> Dict[int, PriceStats]:
+        """
+        Fetches the price statistics of products at a store. Products without statistics are left out.
+        """
+        if not product_ids:
+            return {}
+
+        window_start = (datetime.now() - self.window).timestamp()
+        price_stats = {}
+        for product_id, value in zip(product_ids, self.cache.hmget(self._get_stats_key(store_id), product_ids)):
+            if value is None:
+                continue
+
+            stats = json.loads(value)
+            # Entries only leave the window when the product's price changes, so older ones may still be there
+            window_prices = [price for _, price, end in stats["window"] if end is None or end >= window_start]
+            price_stats[product_id] = PriceStats(
+                price_cents=stats["price"],
+                all_time_low_cents=stats["low"],
+                all_time_low_date=datetime.fromtimestamp(stats["low_time"]) if stats["low_time"] is not None else None,
+                window_low_cents=window_prices[0] if window_prices else None,
+            )
+
+        return price_stats
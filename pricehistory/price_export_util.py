@@ -0,0 +1,211 @@
+import json
+import os
+from datetime import datetime
+from typing import Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+import pymongo
+from atomicwrites import atomic_write
+
+from pricehistory.constants import (
+    EXPORT_CURSOR_BATCH_SIZE,
+    EXPORT_PART_ROWS,
+    EXPORT_STATE_FILE_NAME,
+    MISSING_PRICE_CENTS,
+    MISSING_STORE_ID,
+    PRICE_LAYOUT_BUCKETS,
+)
+from pricehistory.data.price_columns import PriceColumns
+from pricehistory.db_client import DBClient
+from pricehistory.logger_util import LoggerUtil
+
+PRODUCTS_FILE_NAME = "products.npz"
+
+
+class PriceExporter:
+    """
+    Exports the price history to compressed NumPy files in a directory so it can be analyzed without querying the
+    live database.
+
+    Prices are streamed from the database in batches and written as columnar part files of up to `part_rows` rows.
+    Each export only adds the prices saved since the newest price of the last export. Every price of a crawl shares the
+    crawl's start time, so prices at exactly that time are looked at again next time and only the ones not already
+    exported are kept, which also picks up prices of a crawl that was still running. Products are small enough to be
+    rewritten in full every time.
+    """
+
+    def __init__(
+        self, db_client: DBClient, export_dir: str, logger_util: LoggerUtil, part_rows: int = EXPORT_PART_ROWS
+    ):
+        self.db_client = db_client
+        self.export_dir = export_dir
+        self.logger_util = logger_util
+        self.part_rows = part_rows
+        self.state_file_path = os.path.join(export_dir, EXPORT_STATE_FILE_NAME)
+
+    def _load_state(self) -> dict:
+        if not os.path.exists(self.state_file_path):
+            return {"watermark": None, "boundary_keys": [], "price_files": []}
+        with open(self.state_file_path, mode="r", encoding="utf-8") as state_file:
+            return json.load(state_file)
+
+    def _save_state(self, state: dict):
+        with atomic_write(self.state_file_path, mode="w", encoding="utf-8", overwrite=True) as state_file:
+            json.dump(state, state_file)
+
+    def _iter_prices(self, since: Optional[datetime]) -> Iterator[dict]:
+        if self.db_client.price_layout == PRICE_LAYOUT_BUCKETS:
+            pipeline = []
+            if since is not None:
+                pipeline.append({"$match": {"last_date": {"$gte": since}}})
+            pipeline.append({"$unwind": "$prices"})
+            if since is not None:
+                pipeline.append({"$match": {"prices.start_date": {"$gte": since}}})
+            pipeline.append(
+                {
+                    "$project": {
+                        "_id": False,
+                        "product_id": True,
+                        "store_id": True,
+                        "price_cents": "$prices.price_cents",
+                        "start_date": "$prices.start_date",
+                    }
+                }
+            )
+            return self.db_client.price_buckets_collection.aggregate(
+                pipeline, allowDiskUse=True, batchSize=EXPORT_CURSOR_BATCH_SIZE
+            )
+
+        return self.db_client.prices_collection.find(
+            filter={} if since is None else {"start_date": {"$gte": since}},
+            projection={"_id": False, "product_id": True, "store_id": True, "price_cents": True, "start_date": True},
+            batch_size=EXPORT_CURSOR_BATCH_SIZE,
+        )
+
+    def _write_price_part(self, file_name: str, rows: List[Tuple[int, int, int, datetime]]):
+        product_ids, store_ids, prices_cents, start_dates = zip(*rows)
+        self._write_npz(
+            file_name,
+            product_id=np.array(product_ids, dtype=np.int64),
+            store_id=np.array(store_ids, dtype=np.int64),
+            price_cents=np.array(prices_cents, dtype=np.int64),
+            start_date=np.array(start_dates, dtype="datetime64[ms]"),
+        )
+
+    def _write_npz(self, file_name: str, **arrays: np.ndarray):
+        # Written under a temporary name first so a crashed export never leaves a truncated file behind
+        file_path = os.path.join(self.export_dir, file_name)
+        temp_file_path = f"{file_path}.tmp.npz"
+        np.savez_compressed(temp_file_path, **arrays)
+        os.replace(temp_file_path, file_path)
+
+    def export(self) -> int:
+        """
+        Exports every price saved since the last export, and all products.
+
+        Returns:
+            The number of prices exported
+        """
+        os.makedirs(self.export_dir, exist_ok=True)
+        state = self._load_state()
+        watermark = datetime.fromisoformat(state["watermark"]) if state["watermark"] else None
+        boundary_keys: Set[Tuple[int, int]] = {tuple(key) for key in state["boundary_keys"]}
+        default_store_id = (
+            MISSING_STORE_ID if self.db_client.default_store_id is None else self.db_client.default_store_id
+        )
+
+        new_files = []
+        rows = []
+        num_prices = 0
+        newest_date = watermark
+        newest_keys: Set[Tuple[int, int]] = set(boundary_keys)
+        for document in self._iter_prices(watermark):
+            store_id = document.get("store_id")
+            key = (document["product_id"], default_store_id if store_id is None else store_id)
+            start_date = document["start_date"]
+            if start_date == watermark and key in boundary_keys:
+                continue
+
+            price_cents = document["price_cents"]
+            rows.append((*key, MISSING_PRICE_CENTS if price_cents is None else price_cents, start_date))
+            if newest_date is None or start_date > newest_date:
+                newest_date = start_date
+                newest_keys = set()
+            if start_date == newest_date:
+                newest_keys.add(key)
+
+            if len(rows) >= self.part_rows:
+                new_files.append(f"prices-{len(state['price_files']) + len(new_files):06d}.npz")
+                self._write_price_part(new_files[-1], rows)
+                num_prices += len(rows)
+                rows = []
+
+        if rows:
+            new_files.append(f"prices-{len(state['price_files']) + len(new_files):06d}.npz")
+            self._write_price_part(new_files[-1], rows)
+            num_prices += len(rows)
+
+        num_products = self._export_products()
+
+        # Only files named in the state are part of the export, so a crash before this point exports them again
+        self._save_state(
+            {
+                "watermark": newest_date.isoformat() if newest_date else None,
+                "boundary_keys": sorted(newest_keys),
+                "price_files": state["price_files"] + new_files,
+            }
+        )
+        self.logger_util.write(f"Exported {num_prices} prices and {num_products} products to {self.export_dir}")
+        return num_prices
+
+    def _export_products(self) -> int:
+        product_ids = []
+        categories = []
+        display_names = []
+        documents = self.db_client.products_collection.find(
+            projection={"_id": False, "id": True, "category": True, "display_name": True},
+            sort=[("id", pymongo.ASCENDING)],
+            batch_size=EXPORT_CURSOR_BATCH_SIZE,
+        )
+        for document in documents:
+            product_ids.append(document["id"])
+            categories.append(document["category"])
+            display_names.append(document["display_name"])
+
+        self._write_npz(
+            PRODUCTS_FILE_NAME,
+            id=np.array(product_ids, dtype=np.int64),
+            category=np.array(categories, dtype=np.int64),
+            display_name=np.array(display_names, dtype=np.str_),
+        )
+        return len(product_ids)
+
+
+def load_prices(export_dir: str) -> PriceColumns:
+    """
+    Loads every exported price into memory as columns, in no particular order.
+    """
+    with open(os.path.join(export_dir, EXPORT_STATE_FILE_NAME), mode="r", encoding="utf-8") as state_file:
+        price_files = json.load(state_file)["price_files"]
+
+    parts = []
+    for file_name in price_files:
+        with np.load(os.path.join(export_dir, file_name)) as part:
+            parts.append({name: part[name] for name in part.files})
+
+    if not parts:
+        return PriceColumns(
+            product_id=np.empty(0, dtype=np.int64),
+            store_id=np.empty(0, dtype=np.int64),
+            price_cents=np.empty(0, dtype=np.int64),
+            start_date=np.empty(0, dtype="datetime64[ms]"),
+        )
+    return PriceColumns(**{name: np.concatenate([part[name] for part in parts]) for name in parts[0]})
+
+
+def load_products(export_dir: str) -> dict:
+    """
+    Loads the exported products as a mapping of column name to array, sorted by product ID.
+    """
+    with np.load(os.path.join(export_dir, PRODUCTS_FILE_NAME)) as products:
+        return {name: products[name] for name in products.files}
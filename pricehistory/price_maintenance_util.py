@@ -0,0 +1,223 @@
+import dataclasses
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import bson
+import pymongo
+from atomicwrites import atomic_write
+from pymongo.operations import DeleteOne
+
+from pricehistory.constants import (
+    MAINTENANCE_BATCH_DOCUMENTS,
+    MAINTENANCE_PAUSE_SECONDS,
+    MAINTENANCE_STATE_FILE_NAME,
+    PRICE_LAYOUT_BUCKETS,
+)
+from pricehistory.data.price_maintenance_report import PriceMaintenanceReport
+from pricehistory.db_client import DBClient
+from pricehistory.logger_util import LoggerUtil
+
+
+class PriceCompactor:
+    """
+    Finds and removes price documents that carry no information, in small resumable batches.
+
+    The prices collection is streamed in product order with each product's prices in date order. For every product at
+    every store, a price equal to the one before it is redundant, and of several prices with the same start date only
+    the last one is kept. Prices without an online price are collapsed like any other, or dropped altogether with
+    `drop_missing_prices`. Non-positive prices and prices without a store are only reported.
+
+    After every batch the progress is saved and the run pauses, so an interrupted run picks up where it stopped and a
+    run against production leaves room for crawls. A dry run only reports what would be removed and the space that
+    would free up. The bucketed price layout is not supported.
+    """
+
+    def __init__(
+        self,
+        db_client: DBClient,
+        logger_util: LoggerUtil,
+        drop_missing_prices: bool = False,
+        state_file_path: str = MAINTENANCE_STATE_FILE_NAME,
+        batch_documents: int = MAINTENANCE_BATCH_DOCUMENTS,
+        pause_seconds: float = MAINTENANCE_PAUSE_SECONDS,
+    ):
+        self.db_client = db_client
+        self.logger_util = logger_util
+        self.drop_missing_prices = drop_missing_prices
+        self.state_file_path = state_file_path
+        self.batch_documents = batch_documents
+        self.pause_seconds = pause_seconds
+
+    def _load_state(self, dry_run: bool) -> Tuple[Optional[int], PriceMaintenanceReport]:
+        if os.path.exists(self.state_file_path):
+            with open(self.state_file_path, mode="r", encoding="utf-8") as state_file:
+                state = json.load(state_file)
+            # Progress from a run with other settings would skip products this run has not looked at
+            if state["dry_run"] == dry_run and state["drop_missing_prices"] == self.drop_missing_prices:
+                return state["last_product_id"], PriceMaintenanceReport(**state["report"])
+
+        return None, PriceMaintenanceReport()
+
+    def _save_state(self, dry_run: bool, last_product_id: Optional[int], report: PriceMaintenanceReport):
+        state = {
+            "dry_run": dry_run,
+            "drop_missing_prices": self.drop_missing_prices,
+            "last_product_id": last_product_id,
+            "report": dataclasses.asdict(report),
+        }
+        with atomic_write(self.state_file_path, mode="w", encoding="utf-8", overwrite=True) as state_file:
+            json.dump(state, state_file)
+
+    def _get_index_bytes_per_document(self) -> float:
+        # Every deleted document also frees its entry in each index of the collection
+        try:
+            stats = self.db_client.database.command("collStats", self.db_client.prices_collection.name)
+        except Exception:
+            return 0.0
+        return stats.get("totalIndexSize", 0) / stats["count"] if stats.get("count") else 0.0
+
+    def _check_product(
+        self, documents: List[dict], report: PriceMaintenanceReport
+    ) -> Tuple[List[dict], Dict[Optional[int], Optional[int]]]:
+        """
+        Checks the prices of one product, in date order.
+
+        Returns:
+            The documents to delete, and the new latest price at each store whose latest price document is deleted
+        """
+        documents_by_store: Dict[Optional[int], List[dict]] = {}
+        for document in documents:
+            if document.get("store_id") is None:
+                report.missing_store_ids += 1
+            store_id = self.db_client.default_store_id if document.get("store_id") is None else document["store_id"]
+            documents_by_store.setdefault(store_id, []).append(document)
+
+        deleted_documents = []
+        latest_prices = {}
+        for store_id, store_documents in documents_by_store.items():
+            # The index walk leaves prices with the same start date in no defined order, and the later save has the
+            # larger id
+            store_documents.sort(key=lambda document: (document["start_date"], document["_id"]))
+            kept_documents = []
+            num_deleted = len(deleted_documents)
+            for document in store_documents:
+                price_cents = document["price_cents"]
+                if price_cents is None:
+                    report.missing_prices += 1
+                    if self.drop_missing_prices:
+                        deleted_documents.append(document)
+                        continue
+                elif price_cents <= 0:
+                    report.non_positive_prices += 1
+
+                # Of several saves with the same start date, the later one wins
+                if kept_documents and kept_documents[-1]["start_date"] == document["start_date"]:
+                    report.duplicate_dates += 1
+                    deleted_documents.append(kept_documents.pop())
+
+                if kept_documents and kept_documents[-1]["price_cents"] == price_cents:
+                    report.redundant_prices += 1
+                    deleted_documents.append(document)
+                    continue
+
+                kept_documents.append(document)
+
+            # Collapsing a run keeps its first document, so the latest price only changes when prices are dropped
+            latest_price_cents = kept_documents[-1]["price_cents"] if kept_documents else None
+            if len(deleted_documents) > num_deleted and latest_price_cents != store_documents[-1]["price_cents"]:
+                latest_prices[store_id] = latest_price_cents
+
+        return deleted_documents, latest_prices
+
+    def _apply_batch(self, deleted_documents: List[dict], latest_prices: Dict[Optional[int], Dict[int, Optional[int]]]):
+        if deleted_documents:
+            with self.db_client.metrics_util.timer("maintenance_delete"):
+                self.db_client.prices_collection.bulk_write(
+                    [DeleteOne({"_id": document["_id"]}) for document in deleted_documents], ordered=False
+                )
+        for store_id, store_latest_prices in latest_prices.items():
+            self.db_client.update_snapshot_prices(store_latest_prices, store_id)
+
+        self.db_client.cache_invalidator.add(
+            *{
+                self.db_client.get_price_history_cache_key(document["product_id"], document.get("store_id"))
+                for document in deleted_documents
+            }
+        )
+        self.db_client.flush_cache_invalidations()
+
+    def run(self, dry_run: bool = True) -> PriceMaintenanceReport:
+        """
+        Checks the whole prices collection, resuming an earlier run with the same settings if there is one.
+
+        Args:
+            dry_run: Only report what would be deleted without changing anything
+
+        Returns:
+            The report for the whole collection, including the batches of earlier runs that were resumed
+        """
+        if self.db_client.price_layout == PRICE_LAYOUT_BUCKETS:
+            # The buckets hold prices the prices collection does not, and compacting one would leave the other stale
+            raise ValueError("Price compaction only supports the documents price layout")
+        last_product_id, report = self._load_state(dry_run)
+        if last_product_id is not None:
+            self.logger_util.write(f"Resuming price maintenance below product {last_product_id}")
+        index_bytes_per_document = self._get_index_bytes_per_document()
+
+        # Walking the (product_id, start_date) index backwards gives each product's prices in date order
+        documents = self.db_client.prices_collection.find(
+            filter={} if last_product_id is None else {"product_id": {"$lt": last_product_id}},
+            sort=[("product_id", pymongo.DESCENDING), ("start_date", pymongo.ASCENDING)],
+        )
+
+        product_documents: List[dict] = []
+        batch_deleted_documents: List[dict] = []
+        batch_latest_prices: Dict[Optional[int], Dict[int, Optional[int]]] = {}
+        num_batch_documents = 0
+
+        def finish_product():
+            deleted_documents, latest_prices = self._check_product(product_documents, report)
+            report.products_scanned += 1
+            report.reclaimable_bytes += int(
+                sum(len(bson.encode(document)) + index_bytes_per_document for document in deleted_documents)
+            )
+            batch_deleted_documents.extend(deleted_documents)
+            for store_id, price_cents in latest_prices.items():
+                batch_latest_prices.setdefault(store_id, {})[product_documents[0]["product_id"]] = price_cents
+
+        def finish_batch(batch_last_product_id: Optional[int]):
+            if not dry_run:
+                self._apply_batch(batch_deleted_documents, batch_latest_prices)
+                report.documents_deleted += len(batch_deleted_documents)
+            self._save_state(dry_run, batch_last_product_id, report)
+            self.logger_util.write(
+                f"Checked {report.products_scanned} products and {report.documents_scanned} prices, "
+                f"{len(batch_deleted_documents)} {'deletable' if dry_run else 'deleted'} in this batch"
+            )
+            batch_deleted_documents.clear()
+            batch_latest_prices.clear()
+
+        for document in documents:
+            if product_documents and document["product_id"] != product_documents[0]["product_id"]:
+                finish_product()
+                # Batches only end between products so a resumed run never sees part of a product
+                if num_batch_documents >= self.batch_documents:
+                    finish_batch(product_documents[0]["product_id"])
+                    num_batch_documents = 0
+                    time.sleep(self.pause_seconds)
+                product_documents = []
+
+            product_documents.append(document)
+            report.documents_scanned += 1
+            num_batch_documents += 1
+
+        if product_documents:
+            finish_product()
+        finish_batch(product_documents[0]["product_id"] if product_documents else last_product_id)
+        # The next run starts over
+        os.remove(self.state_file_path)
+
+        self.logger_util.write(f"Price maintenance {'dry run ' if dry_run else ''}finished: {report}")
+        return report
@@ -0,0 +1,68 @@
+from typing import Dict, List
+
+
+def _get_bit(indexes: Dict[int, int], keys: List[int], key: int) -> int:
+    index = indexes.get(key)
+    if index is None:
+        index = indexes[key] = len(keys)
+        keys.append(key)
+    return 1 << index
+
+
+class ProductRegistry:
+    """
+    Remembers what one crawl has seen of every product, so a product listed in several categories gets all of them
+    and its price is only saved once per store.
+
+    A crawl can see hundreds of thousands of products, so instead of keeping their documents each product only costs
+    two integers: a bit mask of the categories it was seen in and a bit mask of the stores whose price was saved. Bits
+    are handed out to categories and stores in the order they are first seen. Products are only added once their page
+    is saved, so a price that failed to save is saved again when the product is seen next.
+    """
+
+    def __init__(self):
+        self.category_ids: List[int] = []
+        self.category_indexes: Dict[int, int] = {}
+        self.store_ids: List[int] = []
+        self.store_indexes: Dict[int, int] = {}
+        self.product_categories: Dict[int, int] = {}
+        self.product_stores: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.product_categories)
+
+    def add(self, product_id: int, category_id: int, store_id: int) -> bool:
+        """
+        Records that a product was seen in a category at a store.
+
+        Returns:
+            Whether this is the first time the product was seen at the store, so its price still has to be saved
+        """
+        category_bit = _get_bit(self.category_indexes, self.category_ids, category_id)
+        self.product_categories[product_id] = self.product_categories.get(product_id, 0) | category_bit
+
+        store_bit = _get_bit(self.store_indexes, self.store_ids, store_id)
+        stores = self.product_stores.get(product_id, 0)
+        if stores & store_bit:
+            return False
+        self.product_stores[product_id] = stores | store_bit
+        return True
+
+    def has_store(self, product_id: int, store_id: int) -> bool:
+        """
+        Returns whether the product's price was already saved for the store.
+        """
+        store_index = self.store_indexes.get(store_id)
+        return store_index is not None and bool(self.product_stores.get(product_id, 0) >> store_index & 1)
+
+    def get_categories(self, product_id: int) -> List[int]:
+        """
+        Returns the IDs of every category the product was seen in so far, in ascending order.
+        """
+        categories = self.product_categories.get(product_id, 0)
+        category_ids = []
+        while categories:
+            lowest_bit = categories & -categories
+            category_ids.append(self.category_ids[lowest_bit.bit_length() - 1])
+            categories ^= lowest_bit
+        return sorted(category_ids)
@@ -0,0 +1,269 @@
+import dataclasses
+import json
+import time
+from datetime import datetime
+from typing import Callable, Dict, Hashable, List, Optional, TypeVar
+
+import pymongo
+
+from pricehistory.constants import (
+    CACHE_LOCK_POLL_SECONDS,
+    CACHE_LOCK_PREFIX,
+    CACHE_LOCK_TIMEOUT_SECONDS,
+    CACHE_TTL_SECONDS,
+    CATEGORIES_CACHE_KEY,
+    CATEGORY_NAME_CACHE_KEY,
+    CATEGORY_PRODUCTS_CACHE_KEY,
+    PRODUCT_DISPLAY_NAME_CACHE_PREFIX,
+    PRODUCT_IDS_SEARCH_CACHE_PREFIX,
+    PRODUCT_SEARCH_CACHE_PREFIX,
+    SEARCH_CACHE_TTL_SECONDS,
+)
+from pricehistory.data.category_document import CategoryDocument
+from pricehistory.data.price_change_event import PriceChangeEvent
+from pricehistory.data.price_document import PriceDocument
+from pricehistory.data.price_stats import PriceStats
+from pricehistory.data.product_document import ProductDocument
+from pricehistory.db_client import DBClient
+from pricehistory.search_index import fold_text
+
+K = TypeVar("K", bound=Hashable)
+
+
+class QueryClient:
+    """
+    Serves reads of the price history data through the Redis cache.
+
+    Cache keys are the same ones DBClient invalidates when it writes, so a cached entry is dropped as soon as the data
+    behind it changes and the TTL only bounds how long a value can survive a missed invalidation. When an entry is
+    missing, one reader takes a short lock and loads it from the database while the other readers wait for the result
+    instead of all hitting the database at once.
+    """
+
+    def __init__(
+        self,
+        db_client: DBClient,
+        ttl_seconds: int = CACHE_TTL_SECONDS,
+        search_ttl_seconds: int = SEARCH_CACHE_TTL_SECONDS,
+        lock_timeout_seconds: float = CACHE_LOCK_TIMEOUT_SECONDS,
+    ):
+        self.db_client = db_client
+        self.cache = db_client.cache
+        self.search_index = db_client.search_index
+        self.ttl_seconds = ttl_seconds
+        self.search_ttl_seconds = search_ttl_seconds
+        self.lock_timeout_seconds = lock_timeout_seconds
+
+    def _get_many(
+        self,
+        keys: Dict[K, str],
+        loader: Callable[[List[K]], Dict[K, object]],
+        ttl_seconds: int,
+    ) -> Dict[K, object]:
+        """
+        Reads many cache entries at once, loading and caching the ones that are missing.
+
+        Args:
+            keys: A mapping from each ID to its cache key
+            loader: Loads the values for a list of IDs from the database. Values must be JSON serializable.
+            ttl_seconds: How long newly cached values live
+
+        Returns:
+            A mapping from each ID to its value
+        """
+        values = {}
+        missing_ids = self._read_cached(keys, list(keys), values)
+
+        deadline = time.monotonic() + self.lock_timeout_seconds
+        while missing_ids and time.monotonic() < deadline:
+            pipeline = self.cache.pipeline(transaction=False)
+            for id_ in missing_ids:
+                pipeline.set(self._lock_key(keys[id_]), 1, nx=True, px=int(self.lock_timeout_seconds * 1000))
+            lock_results = pipeline.execute()
+            locked_ids = [id_ for id_, acquired in zip(missing_ids, lock_results) if acquired]
+            waiting_ids = [id_ for id_, acquired in zip(missing_ids, lock_results) if not acquired]
+
+            if locked_ids:
+                loaded_values = loader(locked_ids)
+                pipeline = self.cache.pipeline(transaction=False)
+                for id_ in locked_ids:
+                    values[id_] = loaded_values.get(id_)
+                    pipeline.set(keys[id_], json.dumps(values[id_]), ex=ttl_seconds)
+                    pipeline.delete(self._lock_key(keys[id_]))
+                pipeline.execute()
+
+            # Another reader is already loading these, so wait for it to fill the cache. If its lock goes away
+            # without the entry showing up, it failed and the next pass tries to take the lock again. Entries still
+            # missing at the deadline are read from the database below.
+            while waiting_ids and time.monotonic() < deadline:
+                time.sleep(CACHE_LOCK_POLL_SECONDS)
+                waiting_ids = self._read_cached(keys, waiting_ids, values)
+                lock_exists = (
+                    self.cache.exists(*(self._lock_key(keys[id_]) for id_ in waiting_ids)) if waiting_ids else 0
+                )
+                if lock_exists < len(waiting_ids):
+                    break
+            missing_ids = waiting_ids
+
+        # Give up on the cache and read straight from the database
+        if missing_ids:
+            loaded_values = loader(missing_ids)
+            for id_ in missing_ids:
+                values[id_] = loaded_values.get(id_)
+
+        return values
+
+    def _read_cached(self, keys: Dict[K, str], ids: List[K], values: Dict[K, object]) -> List[K]:
+        # Fills in values for the cached IDs and returns the ones that are missing
+        if not ids:
+            return []
+
+        missing_ids = []
+        for id_, cached_value in zip(ids, self.cache.mget([keys[id_] for id_ in ids])):
+            if cached_value is None:
+                missing_ids.append(id_)
+            else:
+                values[id_] = json.loads(cached_value)
+        return missing_ids
+
+    @staticmethod
+    def _lock_key(key: str) -> str:
+        return f"{CACHE_LOCK_PREFIX}{key}"
+
+    def _get_one(self, key: str, loader: Callable[[], object], ttl_seconds: int):
+        return self._get_many({key: key}, lambda _: {key: loader()}, ttl_seconds)[key]
+
+    def get_price_histories(
+        self, product_ids: List[int], store_id: Optional[int] = None
+    ) -> Dict[int, List[PriceDocument]]:
+        """
+        Fetches the price history of each product at a store, the default store if not given, oldest first. Products
+        without prices map to an empty list.
+        """
+        store_id = self.db_client.default_store_id if store_id is None else store_id
+
+        def load(missing_ids: List[int]) -> Dict[int, list]:
+            price_histories = self.db_client.get_price_histories(missing_ids, store_id)
+            return {
+                product_id: [
+                    {"price_cents": price.price_cents, "start_date": price.start_date.isoformat()} for price in prices
+                ]
+                for product_id, prices in price_histories.items()
+            }
+
+        keys = {
+            product_id: self.db_client.get_price_history_cache_key(product_id, store_id) for product_id in product_ids
+        }
+        values = self._get_many(keys, load, self.ttl_seconds)
+        return {
+            product_id: [
+                PriceDocument(
+                    product_id=product_id,
+                    price_cents=price["price_cents"],
+                    start_date=datetime.fromisoformat(price["start_date"]),
+                    store_id=store_id,
+                )
+                for price in values[product_id] or []
+            ]
+            for product_id in keys
+        }
+
+    def get_price_history(self, product_id: int, store_id: Optional[int] = None) -> List[PriceDocument]:
+        return self.get_price_histories([product_id], store_id)[product_id]
+
+    def get_price_stats(self, product_ids: List[int], store_id: Optional[int] = None) -> Dict[int, PriceStats]:
+        """
+        Fetches the current price, all-time low and recent low of each product at a store, the default store if not
+        given. These are kept up to date as prices are saved, so they are read straight from Redis. Products without
+        statistics are left out.
+        """
+        store_id = self.db_client.default_store_id if store_id is None else store_id
+        return self.db_client.price_change_feed.get_stats(product_ids, store_id)
+
+    def get_recent_price_changes(self, count: int = 100) -> List[PriceChangeEvent]:
+        """
+        Fetches the newest price changes at every store, newest first.
+        """
+        return self.db_client.price_change_feed.get_recent_events(count)
+
+    def get_display_names(self, product_ids: List[int]) -> Dict[int, Optional[str]]:
+        """
+        Fetches the display name of each product. Unknown products map to None.
+        """
+
+        def load(missing_ids: List[int]) -> Dict[int, str]:
+            documents = self.db_client.products_collection.find(
+                filter={"id": {"$in": missing_ids}}, projection={"_id": False, "id": True, "display_name": True}
+            )
+            return {document["id"]: document["display_name"] for document in documents}
+
+        keys = {product_id: f"{PRODUCT_DISPLAY_NAME_CACHE_PREFIX}_{product_id}" for product_id in product_ids}
+        return self._get_many(keys, load, self.ttl_seconds)
+
+    def get_display_name(self, product_id: int) -> Optional[str]:
+        return self.get_display_names([product_id])[product_id]
+
+    def get_category_products(self, category_id: int) -> List[ProductDocument]:
+        def load() -> list:
+            documents = self.db_client.products_collection.find(
+                # Products last written before they had several categories only have the one
+                filter={
+                    "$or": [{"categories": category_id}, {"categories": {"$exists": False}, "category": category_id}]
+                },
+                projection={"_id": False, "id": True, "display_name": True, "category": True, "categories": True},
+                sort=[("display_name", pymongo.ASCENDING)],
+            )
+            return list(documents)
+
+        value = self._get_one(f"{CATEGORY_PRODUCTS_CACHE_KEY}_{category_id}", load, self.ttl_seconds)
+        return [ProductDocument(**document) for document in value]
+
+    def get_category_name(self, category_id: int) -> Optional[str]:
+        def load() -> Optional[str]:
+            document = self.db_client.categories_collection.find_one({"id": category_id})
+            return None if document is None else document["display_name"]
+
+        return self._get_one(f"{CATEGORY_NAME_CACHE_KEY}_{category_id}", load, self.ttl_seconds)
+
+    def get_categories(self) -> List[CategoryDocument]:
+        def load() -> list:
+            documents = self.db_client.categories_collection.find(
+                projection={"_id": False, "id": True, "display_name": True},
+                sort=[("display_name", pymongo.ASCENDING)],
+            )
+            return list(documents)
+
+        return [
+            CategoryDocument(**document) for document in self._get_one(CATEGORIES_CACHE_KEY, load, self.ttl_seconds)
+        ]
+
+    def _get_search_cache_key(self, prefix: str, search_text: str) -> str:
+        # Keys include the index generation, so results from before the last index update are never served
+        return f"{prefix}_{self.search_index.get_generation()}_{fold_text(search_text)}"
+
+    def search_products(self, search_text: str) -> List[ProductDocument]:
+        """
+        Finds products whose display name matches the search text, best matches first. The last word can be partly
+        typed and small typos are tolerated.
+        """
+        if not fold_text(search_text):
+            return []
+
+        def load() -> list:
+            return [dataclasses.asdict(product_document) for product_document in self.search_index.search(search_text)]
+
+        key = self._get_search_cache_key(PRODUCT_SEARCH_CACHE_PREFIX, search_text)
+        return [ProductDocument(**document) for document in self._get_one(key, load, self.search_ttl_seconds)]
+
+    def search_product_ids(self, search_text: str) -> List[int]:
+        """
+        Finds the IDs of the products whose display name matches the search text, best matches first.
+        """
+        if not fold_text(search_text):
+            return []
+
+        def load() -> list:
+            return [product_document.id for product_document in self.search_index.search(search_text)]
+
+        key = self._get_search_cache_key(PRODUCT_IDS_SEARCH_CACHE_PREFIX, search_text)
+        return self._get_one(key, load, self.search_ttl_seconds)
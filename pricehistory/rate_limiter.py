@@ -0,0 +1,121 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Optional
+
+from pricehistory.constants import (
+    BACKOFF_BASE_SECONDS,
+    BACKOFF_MAX_SECONDS,
+    DEFAULT_REQUESTS_PER_MINUTE,
+    LATENCY_SLOWDOWN_FACTOR,
+    MIN_RATE_FRACTION,
+    RATE_LIMIT_JITTER_SECONDS,
+    THROTTLED_STATUS_CODES,
+)
+
+
+class RateLimiter:
+    """
+    Token bucket that spaces out requests to the upstream API.
+
+    The rate drops when upstream latency rises or the API throttles us, and creeps back up to the configured
+    budget while the API is healthy. Failures are retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = DEFAULT_REQUESTS_PER_MINUTE,
+        jitter_seconds: float = RATE_LIMIT_JITTER_SECONDS,
+        burst: int = 1,
+    ):
+        # A budget of None means requests are never delayed, which is only useful against local stand-ins
+        self.max_rate = requests_per_minute / 60 if requests_per_minute else None
+        self.min_rate = self.max_rate * MIN_RATE_FRACTION if self.max_rate else None
+        self.rate = self.max_rate
+        self.jitter_seconds = jitter_seconds
+        self.capacity = burst
+
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.latency_average: Optional[float] = None
+        self.latency_baseline: Optional[float] = None
+        self.consecutive_failures = 0
+        self.lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        if self.rate is None:
+            return 0
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+
+            # Tokens may go negative, which reserves a slot in the future for each concurrent caller
+            self.tokens -= 1
+            wait_seconds = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        return wait_seconds + random.uniform(0, self.jitter_seconds)
+
+    def acquire(self):
+        time.sleep(self._reserve())
+
+    async def acquire_async(self):
+        await asyncio.sleep(self._reserve())
+
+    def record_success(self, latency_seconds: float):
+        with self.lock:
+            self.consecutive_failures = 0
+
+            if self.latency_average is None:
+                self.latency_average = latency_seconds
+                self.latency_baseline = latency_seconds
+            else:
+                self.latency_average = 0.8 * self.latency_average + 0.2 * latency_seconds
+                self.latency_baseline = 0.99 * self.latency_baseline + 0.01 * latency_seconds
+
+            if self.rate is None:
+                return
+
+            # Back off multiplicatively while upstream is slow and recover additively once it is healthy again
+            if self.latency_average > self.latency_baseline * LATENCY_SLOWDOWN_FACTOR:
+                self.rate = max(self.min_rate, self.rate * 0.8)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def record_failure(self, status_code: Optional[int] = None) -> float:
+        """
+        Records a failed request.
+
+        Args:
+            status_code: The HTTP status code of the failure, if there was one
+
+        Returns:
+            The number of seconds to wait before retrying
+        """
+        with self.lock:
+            self.consecutive_failures += 1
+
+            if status_code in THROTTLED_STATUS_CODES and self.rate is not None:
+                self.rate = max(self.min_rate, self.rate / 2)
+
+            backoff_seconds = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (self.consecutive_failures - 1))
+
+        return random.uniform(backoff_seconds / 2, backoff_seconds)
+
+    @property
+    def requests_per_minute(self) -> Optional[float]:
+        return self.rate * 60 if self.rate is not None else None
+
+    def set_requests_per_minute(self, requests_per_minute: Optional[float]):
+        """
+        Changes the request budget, keeping what has been learned about upstream latency.
+        """
+        with self.lock:
+            self.max_rate = requests_per_minute / 60 if requests_per_minute else None
+            self.min_rate = self.max_rate * MIN_RATE_FRACTION if self.max_rate else None
+            if self.max_rate is None or self.rate is None:
+                self.rate = self.max_rate
+            else:
+                self.rate = min(self.max_rate, max(self.min_rate, self.rate))
@@ -1,46 +1,158 @@
+import contextlib
+import fcntl
+import json
 import os
 import pickle
+import threading
 from datetime import datetime
 from typing import Dict, Tuple, Optional
 
 from atomicwrites import atomic_write
 
-from pricehistory.constants import RECENCY_FILE_NAME, RECENCY_MINIMUM_AGE_HOURS
+from pricehistory.constants import (
+    LEGACY_RECENCY_FILE_NAME,
+    RECENCY_COMPACTION_FACTOR,
+    RECENCY_COMPACTION_MIN_ENTRIES,
+    RECENCY_FILE_NAME,
+    RECENCY_MINIMUM_AGE_HOURS,
+)
+from pricehistory.metrics_util import MetricsUtil
 
 
 class RecencyUtil:
-    def __init__(self, recency_file_path=RECENCY_FILE_NAME):
-        self.recency_dict = dict()
+    """
+    Keeps track of the last cursor processed for each category so that an interrupted crawl can resume.
+
+    Checkpoints are appended to a journal file, one JSON line per page, and the journal is periodically compacted
+    down to the latest entry for each category. Several processes can share a journal: appends and compactions hold an
+    exclusive lock on a file next to it, and a compaction merges in what the others appended before rewriting it.
+    """
+
+    def __init__(
+        self,
+        recency_file_path=RECENCY_FILE_NAME,
+        legacy_recency_file_path=LEGACY_RECENCY_FILE_NAME,
+        metrics_util: Optional[MetricsUtil] = None,
+    ):
+        self.recency_dict: Dict[str, Tuple[datetime, str]] = dict()
+        self.metrics_util = metrics_util if metrics_util is not None else MetricsUtil()
         self.recency_file_path = recency_file_path
+        # The journal is replaced when compacted, so the lock is taken on a file that stays put
+        self.lock_file_path = f"{recency_file_path}.lock"
+        self.num_journal_entries = 0
+        self.lock = threading.Lock()
 
         if os.path.exists(self.recency_file_path):
-            with open(self.recency_file_path, mode="rb") as recency_file:
-                self.recency_dict: Dict[str, Tuple] = pickle.load(recency_file)
+            self._load_journal()
+        elif legacy_recency_file_path and os.path.exists(legacy_recency_file_path):
+            self._migrate_pickle(legacy_recency_file_path)
+
+    @staticmethod
+    def _encode_entry(category_id: str, information_tuple: Tuple[datetime, str]) -> str:
+        entry = {"category": category_id, "time": information_tuple[0].isoformat(), "after": information_tuple[1]}
+        return json.dumps(entry) + "\n"
+
+    @contextlib.contextmanager
+    def _journal_lock(self):
+        with open(self.lock_file_path, mode="a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_journal(self) -> Dict[str, Tuple[datetime, str]]:
+        entries = {}
+        with open(self.recency_file_path, mode="r", encoding="utf-8") as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash in the middle of an append can leave a partial last line behind
+                    continue
+
+                entries[entry["category"]] = (datetime.fromisoformat(entry["time"]), entry["after"])
+                self.num_journal_entries += 1
+        return entries
+
+    def _load_journal(self):
+        self.recency_dict.update(self._read_journal())
+
+    def _merge_journal(self):
+        # Other processes may have appended checkpoints since this one loaded the journal, keep the newest of each
+        if not os.path.exists(self.recency_file_path):
+            return
+        for key, information_tuple in self._read_journal().items():
+            current = self.recency_dict.get(key)
+            if current is None or information_tuple[0] > current[0]:
+                self.recency_dict[key] = information_tuple
+
+    def _migrate_pickle(self, legacy_recency_file_path: str):
+        with open(legacy_recency_file_path, mode="rb") as recency_file:
+            self.recency_dict = pickle.load(recency_file)
+
+        with self._journal_lock():
+            self._compact()
+        os.remove(legacy_recency_file_path)
+
+    def _compact(self):
+        # Callers hold the journal lock and have merged the journal, so nothing appended is lost by rewriting it
+        with self.metrics_util.timer("recency_compact"):
+            with atomic_write(self.recency_file_path, mode="w", encoding="utf-8", overwrite=True) as journal_file:
+                for category_id, information_tuple in self.recency_dict.items():
+                    journal_file.write(self._encode_entry(category_id, information_tuple))
+
+        self.num_journal_entries = len(self.recency_dict)
+
+    @staticmethod
+    def get_key(category_id: int, store_id: Optional[int]) -> str:
+        """
+        Returns the key a category's checkpoint is stored under. Checkpoints without a store keep the plain category
+        key that journals were written with before stores.
+        """
+        return str(category_id) if store_id is None else f"{store_id}_{category_id}"
+
+    def record_category_page_success(self, category_id: int, after: str, store_id: Optional[int] = None):
+        with self.lock, self.metrics_util.timer("recency_write", category_id):
+            information_tuple = (datetime.now(), after)
+            key = self.get_key(category_id, store_id)
+            self.recency_dict[key] = information_tuple
 
-    def _save_pickle(self):
-        with atomic_write(self.recency_file_path, mode="wb", overwrite=True) as recency_file:
-            recency_file.write(pickle.dumps(self.recency_dict, protocol=pickle.HIGHEST_PROTOCOL))
+            with self._journal_lock():
+                journal_fd = os.open(self.recency_file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(journal_fd, self._encode_entry(key, information_tuple).encode("utf-8"))
+                finally:
+                    os.close(journal_fd)
+                self.num_journal_entries += 1
 
-    def record_category_page_success(self, category_id: int, after: str):
-        self.recency_dict[str(category_id)] = (datetime.now(), after)
-        self._save_pickle()
+                compaction_threshold = max(
+                    RECENCY_COMPACTION_MIN_ENTRIES, len(self.recency_dict) * RECENCY_COMPACTION_FACTOR
+                )
+                if self.num_journal_entries > compaction_threshold:
+                    self.num_journal_entries = 0
+                    self._merge_journal()
+                    self._compact()
 
-    def get_category_after_cursor(self, category_id: int) -> Optional[str]:
-        result = self.recency_dict.get(str(category_id))
+    def get_category_after_cursor(self, category_id: int, store_id: Optional[int] = None) -> Optional[str]:
+        result = self.recency_dict.get(self.get_key(category_id, store_id))
         if result:
             return result[1]
         else:
             return None
 
     def clean_records(self, age_in_hours_to_clean=RECENCY_MINIMUM_AGE_HOURS):
-        categories_to_remove = []
+        with self.lock, self._journal_lock():
+            self.num_journal_entries = 0
+            self._merge_journal()
+            categories_to_remove = []
 
-        for category_id, information_tuple in self.recency_dict.items():
-            hours_since_record = (datetime.now() - information_tuple[0]).seconds / 3600
-            if hours_since_record >= age_in_hours_to_clean:
-                categories_to_remove.append(category_id)
+            for category_id, information_tuple in self.recency_dict.items():
+                hours_since_record = (datetime.now() - information_tuple[0]).total_seconds() / 3600
+                if hours_since_record >= age_in_hours_to_clean:
+                    categories_to_remove.append(category_id)
 
-        for category_id in categories_to_remove:
-            self.recency_dict.pop(category_id)
+            for category_id in categories_to_remove:
+                self.recency_dict.pop(category_id)
 
-        self._save_pickle()
+            self._compact()
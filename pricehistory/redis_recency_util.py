@@ -0,0 +1,46 @@
+import json
+from datetime import datetime
+from typing import Optional
+
+import redis
+
+from pricehistory.constants import RECENCY_CACHE_KEY, RECENCY_MINIMUM_AGE_HOURS
+from pricehistory.metrics_util import MetricsUtil
+from pricehistory.receny_util import RecencyUtil
+
+
+class RedisRecencyUtil:
+    """
+    Keeps the last cursor processed for each category in a Redis hash instead of a local journal, so every crawl worker
+    sees the same checkpoints and a category can be resumed by a different worker than the one that started it.
+
+    Has the same interface as RecencyUtil.
+    """
+
+    def __init__(self, cache: redis.Redis, metrics_util: Optional[MetricsUtil] = None, key: str = RECENCY_CACHE_KEY):
+        self.cache = cache
+        self.metrics_util = metrics_util if metrics_util is not None else MetricsUtil()
+        self.key = key
+
+    def record_category_page_success(self, category_id: int, after: str, store_id: Optional[int] = None):
+        with self.metrics_util.timer("recency_write", category_id):
+            entry = {"time": datetime.now().isoformat(), "after": after}
+            self.cache.hset(self.key, RecencyUtil.get_key(category_id, store_id), json.dumps(entry))
+
+    def get_category_after_cursor(self, category_id: int, store_id: Optional[int] = None) -> Optional[str]:
+        entry = self.cache.hget(self.key, RecencyUtil.get_key(category_id, store_id))
+        if entry is None:
+            return None
+        return json.loads(entry)["after"]
+
+    def clean_records(self, age_in_hours_to_clean=RECENCY_MINIMUM_AGE_HOURS):
+        categories_to_remove = []
+        for category_id, entry in self.cache.hgetall(self.key).items():
+            hours_since_record = (
+                datetime.now() - datetime.fromisoformat(json.loads(entry)["time"])
+            ).total_seconds() / 3600
+            if hours_since_record >= age_in_hours_to_clean:
+                categories_to_remove.append(category_id)
+
+        if categories_to_remove:
+            self.cache.hdel(self.key, *categories_to_remove)
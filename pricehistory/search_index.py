@@ -0,0 +1,173 @@
+import json
+import math
+import re
+import unicodedata
+import uuid
+from typing import Dict, List, Set, Tuple
+
+import redis
+from pymongo.collection import Collection
+
+from pricehistory.constants import (
+    PRODUCT_SEARCH_DOCUMENTS_KEY,
+    PRODUCT_SEARCH_GENERATION_KEY,
+    PRODUCT_SEARCH_TRIGRAM_PREFIX,
+    SEARCH_CANDIDATES_PER_RESULT,
+    SEARCH_INDEX_BATCH_SIZE,
+    SEARCH_MIN_MATCH_FRACTION,
+    SEARCH_RESULT_LIMIT,
+)
+from pricehistory.data.product_document import ProductDocument
+
+_NON_ALPHANUMERIC_PATTERN = re.compile(r"[^0-9a-z]+")
+
+
+def fold_text(text: str) -> str:
+    """
+    Lowercases text, strips diacritics and punctuation and collapses whitespace, so "Jalapeño-Lime" becomes
+    "jalapeno lime".
+    """
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    stripped = "".join(character for character in decomposed if not unicodedata.combining(character))
+    return " ".join(_NON_ALPHANUMERIC_PATTERN.sub(" ", stripped).split())
+
+
+def get_trigrams(text: str, partial_last_word: bool = False) -> Set[str]:
+    """
+    Splits folded text into the trigrams of each word. Words are padded so their first letters form trigrams of their
+    own, which lets one or two typed letters match the start of a word.
+
+    Args:
+        text: The text to split
+        partial_last_word: The last word is still being typed, so it should only match the start of words
+    """
+    words = fold_text(text).split()
+    trigrams = set()
+    for i, word in enumerate(words):
+        padded_word = f"  {word}" if partial_last_word and i == len(words) - 1 else f"  {word} "
+        trigrams.update(a + b + c for a, b, c in zip(padded_word, padded_word[1:], padded_word[2:]))
+    return trigrams
+
+
+class SearchIndex:
+    """
+    Trigram index over product display names, kept in Redis so the crawler can update it and any reader can search it.
+
+    Every trigram has a set of the IDs of the products whose folded display name contains it. A search adds up the
+    sets of the search text's trigrams on the server, keeps the products that contain enough of them to allow for a
+    typo or two, and ranks the best of those by matches, then by whether the name starts with the search text, then
+    by name length. The generation counter changes on every update, so cached results from before it are not reused.
+    """
+
+    def __init__(self, cache: redis.Redis):
+        self.cache = cache
+
+    @staticmethod
+    def _trigram_key(trigram: str) -> str:
+        return f"{PRODUCT_SEARCH_TRIGRAM_PREFIX}{trigram}"
+
+    def _get_documents(self, product_ids: List[int]) -> Dict[int, Tuple[str, int]]:
+        if not product_ids:
+            return {}
+
+        values = self.cache.hmget(PRODUCT_SEARCH_DOCUMENTS_KEY, product_ids)
+        return {
+            product_id: tuple(json.loads(value)) for product_id, value in zip(product_ids, values) if value is not None
+        }
+
+    def get_generation(self) -> int:
+        return int(self.cache.get(PRODUCT_SEARCH_GENERATION_KEY) or 0)
+
+    def update(self, product_documents: List[ProductDocument]) -> int:
+        """
+        Indexes new products and re-indexes products whose display name or category changed.
+
+        Returns:
+            The number of products whose index entries changed
+        """
+        num_changed = 0
+        for i in range(0, len(product_documents), SEARCH_INDEX_BATCH_SIZE):
+            batch_end = i + SEARCH_INDEX_BATCH_SIZE
+            batch = product_documents[i:batch_end]
+            old_documents = self._get_documents([product_document.id for product_document in batch])
+
+            pipeline = self.cache.pipeline(transaction=False)
+            num_batch_changed = 0
+            for product_document in batch:
+                document = (product_document.display_name, product_document.category)
+                old_document = old_documents.get(product_document.id)
+                if old_document == document:
+                    continue
+
+                trigrams = get_trigrams(product_document.display_name)
+                old_trigrams = get_trigrams(old_document[0]) if old_document is not None else set()
+                for trigram in old_trigrams - trigrams:
+                    pipeline.srem(self._trigram_key(trigram), product_document.id)
+                for trigram in trigrams - old_trigrams:
+                    pipeline.sadd(self._trigram_key(trigram), product_document.id)
+                pipeline.hset(PRODUCT_SEARCH_DOCUMENTS_KEY, product_document.id, json.dumps(document))
+                num_batch_changed += 1
+
+            if num_batch_changed:
+                pipeline.incr(PRODUCT_SEARCH_GENERATION_KEY)
+                pipeline.execute()
+                num_changed += num_batch_changed
+
+        return num_changed
+
+    def rebuild(self, products_collection: Collection) -> int:
+        """
+        Drops the index and builds it again from every product in the database.
+
+        Returns:
+            The number of products indexed
+        """
+        self.cache.delete(PRODUCT_SEARCH_DOCUMENTS_KEY, *self.cache.scan_iter(f"{PRODUCT_SEARCH_TRIGRAM_PREFIX}*"))
+
+        num_products = 0
+        batch = []
+        documents = products_collection.find(
+            projection={"_id": False, "id": True, "display_name": True, "category": True}
+        )
+        for document in documents:
+            batch.append(ProductDocument(**document))
+            if len(batch) >= SEARCH_INDEX_BATCH_SIZE:
+                num_products += self.update(batch)
+                batch = []
+        num_products += self.update(batch)
+        # Even an empty index is a change from what was cached before
+        self.cache.incr(PRODUCT_SEARCH_GENERATION_KEY)
+        return num_products
+
+    def search(self, search_text: str, limit: int = SEARCH_RESULT_LIMIT) -> List[ProductDocument]:
+        """
+        Finds the products whose display names best match the search text. The last word of the search text is
+        treated as a prefix, so results can be shown while it is being typed.
+        """
+        trigrams = get_trigrams(search_text, partial_last_word=True)
+        if not trigrams:
+            return []
+
+        min_matches = max(1, math.ceil(SEARCH_MIN_MATCH_FRACTION * len(trigrams)))
+        # Sets are counted with a score of 1, so the union scores each product by the trigrams it contains
+        temp_key = f"{PRODUCT_SEARCH_TRIGRAM_PREFIX}query_{uuid.uuid4().hex}"
+        pipeline = self.cache.pipeline(transaction=False)
+        pipeline.zunionstore(temp_key, [self._trigram_key(trigram) for trigram in trigrams])
+        pipeline.zrevrangebyscore(
+            temp_key, "+inf", min_matches, start=0, num=limit * SEARCH_CANDIDATES_PER_RESULT, withscores=True
+        )
+        pipeline.delete(temp_key)
+        candidates = {int(product_id): score for product_id, score in pipeline.execute()[1]}
+
+        documents = self._get_documents(list(candidates))
+        folded_search_text = fold_text(search_text)
+
+        def rank(product_id: int) -> Tuple[float, bool, int, int]:
+            folded_name = fold_text(documents[product_id][0])
+            return -candidates[product_id], not folded_name.startswith(folded_search_text), len(folded_name), product_id
+
+        ranked_product_ids = sorted((product_id for product_id in candidates if product_id in documents), key=rank)
+        return [
+            ProductDocument(id=product_id, display_name=documents[product_id][0], category=documents[product_id][1])
+            for product_id in ranked_product_ids[:limit]
+        ]
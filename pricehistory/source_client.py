@@ -1,43 +1,112 @@
+import asyncio
 import datetime
-import random
-from time import sleep
-from typing import Optional, List
+import functools
+import time
+from typing import Callable, Dict, Optional, List, Tuple
 
 from gql import Client, gql
-from gql.transport.aiohttp import AIOHTTPTransport
+from gql.transport import AsyncTransport
+from graphql import ExecutionResult
 
+from .category_scheduler import CategoryScheduler
+from .cookie_util import CookieManager
 from .data.category_document import CategoryDocument
 from .data.price_container import PriceContainer
 from .data.price_document import PriceDocument
-from pricehistory.constants import PRODUCTS_QUERY, MAX_SLEEP_SECONDS, MIN_SLEEP_SECONDS, RECENCY_CATEGORY_COMPLETE
+from .data.price_save_result import PriceSaveResult
+from pricehistory.constants import (
+    BACKOFF_BASE_SECONDS,
+    BACKOFF_MAX_SECONDS,
+    DEFAULT_CRAWL_CONCURRENCY,
+    FETCH_ATTEMPTS,
+    PIPELINE_QUEUE_SIZE,
+    PRODUCTS_QUERIES,
+    QUERY_PROFILE_PRICES,
+    RECENCY_CATEGORY_COMPLETE,
+    REJECTED_STATUS_CODES,
+    RESPONSE_BYTES_EXTENSION,
+)
 from pricehistory.db_client import DBClient
 from .data.product_document import ProductDocument
 from .logger_util import LoggerUtil
+from .metrics_util import MetricsUtil
+from .product_registry import ProductRegistry
+from .rate_limiter import RateLimiter
 from .receny_util import RecencyUtil
+from .transport_util import MeteredAIOHTTPTransport
 
 
 class SourceClient:
     def __init__(
         self,
         api_url: str,
-        store_id: str,
+        store_ids: List[int],
         categories: List[int],
         cookies: dict,
         db_client: DBClient,
         recency_util: RecencyUtil,
         logger_util: LoggerUtil,
+        rate_limiter: RateLimiter = None,
+        cookie_manager: Optional[CookieManager] = None,
+        transport: Optional[AsyncTransport] = None,
+        metrics_util: Optional[MetricsUtil] = None,
+        category_scheduler: Optional[CategoryScheduler] = None,
+        query_profile: str = QUERY_PROFILE_PRICES,
     ):
+        if query_profile not in PRODUCTS_QUERIES:
+            raise ValueError(f"Unknown query profile {query_profile}")
         self.api_url = api_url
-        self.store_id = store_id
+        # Every store shares the session, cookies and product writes. The first one is the default store, whose
+        # checkpoints are not scoped by store so that existing journals keep resuming.
+        self.store_ids = store_ids
         self.categories = categories
         self.db_client = db_client
         self.recency_util = recency_util
         self.logger_util = logger_util
-
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.metrics_util = metrics_util if metrics_util is not None else MetricsUtil()
+        self.category_scheduler = category_scheduler
+        # Which fields each page asks for, see PRODUCTS_QUERIES
+        self.query_profile = query_profile
+        # Prices seen, prices new or changed and pages fetched so far for each (store ID, category ID) this run
+        self.crawl_stats: Dict[Tuple[int, int], List[int]] = {}
+        self.product_registry = ProductRegistry()
+        # The crawl of each (store ID, category ID) whose pages still record checkpoints once saved, see
+        # abandon_category
+        self.category_crawls: Dict[Tuple[int, int], object] = {}
         self.today = datetime.datetime.today()
 
-        transport = AIOHTTPTransport(url=self.api_url, cookies=cookies)
-        self.client = Client(transport=transport)
+        self.cookies = cookies
+        self.pending_cookies: Optional[dict] = None
+        self.cookie_manager = cookie_manager
+        if self.cookie_manager is not None:
+            self.cookie_manager.add_listener(self._on_cookies_refreshed)
+
+        # A different transport can be given to record or replay responses instead of only talking to the API
+        if transport is None:
+            transport = MeteredAIOHTTPTransport(url=self.api_url, cookies=cookies)
+        self.transport = transport
+        self.client = Client(transport=self.transport)
+
+    def _on_cookies_refreshed(self, cookies: dict):
+        # This can be called from any thread, so the cookies are only applied right before the next request
+        self.pending_cookies = cookies
+
+    def _apply_pending_cookies(self):
+        cookies = self.pending_cookies
+        if cookies is None:
+            return
+
+        self.pending_cookies = None
+        self.cookies = cookies
+        self.transport.cookies = cookies
+        session = getattr(self.transport, "session", None)
+        if session is not None:
+            session.cookie_jar.update_cookies(cookies)
+        self.logger_util.write("Using refreshed cookies")
+
+    def _should_refresh_cookies(self, exception: Exception) -> bool:
+        return self.cookie_manager is not None and self._get_status_code(exception) in REJECTED_STATUS_CODES
 
     @staticmethod
     def _parse_price_string(price_string: str) -> int:
@@ -72,12 +141,34 @@ class SourceClient:
 
         return ""
 
-    def _process_records(self, records: dict, category_id: int, category_display_name: str):
+    def start_run(self, today: Optional[datetime.datetime] = None):
+        """
+        Starts a new crawl: prices are saved with a new date, and products seen in an earlier crawl get their prices
+        saved again.
+
+        Args:
+            today: The date to save the crawl's prices with, now if not given
+        """
+        self.today = today if today is not None else datetime.datetime.today()
+        self.crawl_stats = {}
+        self.product_registry = ProductRegistry()
+
+    def _parse_records(self, records: dict, category_id: int, store_id: int) -> List[PriceContainer]:
         price_containers = []
+        num_already_saved = 0
         for record in records:
-            price_cents = self._get_price_cents(record)
             product_id = int(record["id"])
-            price_document = PriceDocument(product_id=product_id, price_cents=price_cents, start_date=self.today)
+            # A product listed in several categories only needs its price saved for the first one
+            price_document = None
+            if not self.product_registry.has_store(product_id, store_id):
+                price_document = PriceDocument(
+                    product_id=product_id,
+                    price_cents=self._get_price_cents(record),
+                    start_date=self.today,
+                    store_id=store_id,
+                )
+            else:
+                num_already_saved += 1
 
             product_display_name = record["displayName"]
 
@@ -86,80 +177,338 @@ class SourceClient:
             if product_size and product_size.lower() != "each":
                 product_display_name += f" ({product_size})"
 
-            product_document = ProductDocument(id=product_id, display_name=product_display_name, category=category_id)
+            categories = sorted({category_id, *self.product_registry.get_categories(product_id)})
+            product_document = ProductDocument(
+                id=product_id, display_name=product_display_name, category=categories[0], categories=categories
+            )
 
             price_container = PriceContainer(product_document=product_document, price_document=price_document)
             price_containers.append(price_container)
 
-        category_document = CategoryDocument(id=category_id, display_name=category_display_name)
-        self.db_client.save_product_prices(price_containers=price_containers, category_document=category_document)
-
-    def _fetch_category_page(self, category_id: int, after: str = None) -> Optional[str]:
-        """
-        Fetches a single page for a given category.
+        self.metrics_util.increment("prices_already_saved", num_already_saved, category_id)
+        return price_containers
 
-        Args:
-            category_id: The ID of the category
-            after: The cursor to use for pagination
+    def _on_page_saved(
+        self,
+        product_registry: ProductRegistry,
+        price_containers: List[PriceContainer],
+        category_id: int,
+        next_cursor: Optional[str],
+        store_id: int,
+        category_crawl: object,
+    ):
+        # The registry is the one of the crawl the page was parsed in, a new crawl may have started since
+        for price_container in price_containers:
+            product_registry.add(price_container.product_document.id, category_id, store_id)
+        if self.category_crawls.get((store_id, category_id)) is category_crawl:
+            self._record_category_checkpoint(category_id, next_cursor, store_id)
 
-        Returns:
-            The 'after' cursor if there is at least one more page to process
+    def abandon_category(self, category_id: int, store_id: int):
         """
+        Stops the pages of a category that are still waiting in the write buffer from recording their checkpoints, e.g.
+        once another worker has taken the category over and records its own.
+        """
+        self.category_crawls.pop((store_id, category_id), None)
+
+    def _build_category_page_query(self, category_id: int, after: Optional[str], store_id: int):
         if after is None:
             after = "null"
         else:
             after = f'"{after}"'
 
-        query = gql(PRODUCTS_QUERY % (category_id, self.store_id, after))
-        result = self.client.execute(query)
+        return gql(PRODUCTS_QUERIES[self.query_profile] % (category_id, store_id, after))
 
-        print(result)
-        category_display_name = result["browseCategory"]["pageTitle"]
-        self._process_records(result["browseCategory"]["records"], category_id, category_display_name)
+    def _record_response(self, execution_result: ExecutionResult, category_id: int) -> dict:
+        # Transports that cannot tell the size of a response leave it out
+        response_bytes = (execution_result.extensions or {}).get(RESPONSE_BYTES_EXTENSION)
+        if response_bytes is not None:
+            self.metrics_util.increment("response_bytes", response_bytes, category_id)
+        return execution_result.data
 
+    @staticmethod
+    def _get_next_cursor(result: dict) -> Optional[str]:
         if result["browseCategory"]["hasMoreRecords"]:
+            return result["browseCategory"]["nextCursor"]
+        else:
+            return None
+
+    def _record_page_stats(self, category_id: int, store_id: int, price_save_result: PriceSaveResult):
+        stats = self.crawl_stats.setdefault((store_id, category_id), [0, 0, 0])
+        stats[0] += price_save_result.num_new + price_save_result.num_changed + price_save_result.num_unchanged
+        stats[1] += price_save_result.num_new + price_save_result.num_changed
+        stats[2] += 1
+
+    def _finish_category(self, category_id: int, store_id: int):
+        num_prices, num_changed, num_pages = self.crawl_stats.pop((store_id, category_id), [0, 0, 0])
+        if self.category_scheduler is not None and num_pages:
+            self.category_scheduler.record_crawl(store_id, category_id, num_prices, num_changed, num_pages)
+
+    def _get_crawl_targets(self) -> List[Tuple[int, int]]:
+        crawl_targets = [(store_id, category_id) for store_id in self.store_ids for category_id in self.categories]
+        if self.category_scheduler is None:
+            return crawl_targets
+
+        in_progress = set()
+        for store_id, category_id in crawl_targets:
+            cursor = self.recency_util.get_category_after_cursor(category_id, self._get_checkpoint_store_id(store_id))
+            if cursor is not None and cursor != RECENCY_CATEGORY_COMPLETE:
+                in_progress.add((store_id, category_id))
+        return self.category_scheduler.select(crawl_targets, in_progress)
+
+    def _get_checkpoint_store_id(self, store_id: int) -> Optional[int]:
+        return None if store_id == self.store_ids[0] else store_id
+
+    def _record_category_checkpoint(self, category_id: int, next_cursor: Optional[str], store_id: int):
+        checkpoint_store_id = self._get_checkpoint_store_id(store_id)
+        if next_cursor is not None:
             # Save the cursor so that if the program crashes we can skip pages we already have done
-            next_cursor = result["browseCategory"]["nextCursor"]
-            self.recency_util.record_category_page_success(category_id, next_cursor)
-            return next_cursor
+            self.recency_util.record_category_page_success(category_id, next_cursor, checkpoint_store_id)
         else:
             # No more pages, so log that the category is complete
-            self.recency_util.record_category_page_success(category_id, RECENCY_CATEGORY_COMPLETE)
-            return None
+            self.recency_util.record_category_page_success(category_id, RECENCY_CATEGORY_COMPLETE, checkpoint_store_id)
 
-    def _fetch_category_page_with_retry(self, category_id: int, after: str = None) -> Optional[str]:
-        for i in range(5):
+    @staticmethod
+    def _get_status_code(exception: Exception) -> Optional[int]:
+        # gql reports HTTP errors with 'code' while aiohttp uses 'status'
+        for attribute in ("code", "status"):
+            status_code = getattr(exception, attribute, None)
+            if isinstance(status_code, int):
+                return status_code
+
+        return None
+
+    def _handle_fetch_failure(self, exception: Exception, is_last_attempt: bool) -> float:
+        status_code = self._get_status_code(exception)
+        self.metrics_util.increment("fetch_failures")
+        backoff_seconds = self.rate_limiter.record_failure(status_code)
+        message = f"Exception fetching category page (status {status_code}): {exception}"
+        if is_last_attempt:
+            self.logger_util.write(message)
+        else:
+            self.logger_util.write(f"{message}. Retrying in {backoff_seconds:.1f} second(s)")
+        return backoff_seconds
+
+    async def _execute_category_page_query_async(
+        self, session, category_id: int, store_id: int, after: str = None
+    ) -> dict:
+        query = self._build_category_page_query(category_id, after, store_id)
+        with self.metrics_util.timer("rate_limit_wait", category_id):
+            await self.rate_limiter.acquire_async()
+        self._apply_pending_cookies()
+        start_time = time.monotonic()
+        execution_result = await session.execute(query, get_execution_result=True)
+        latency_seconds = time.monotonic() - start_time
+        self.rate_limiter.record_success(latency_seconds)
+        self.metrics_util.observe("fetch", latency_seconds, category_id)
+        self.metrics_util.increment("pages_fetched", category=category_id)
+        result = self._record_response(execution_result, category_id)
+
+        self.logger_util.dump_response(f"store {store_id} category {category_id} page {after}", result)
+        return result
+
+    async def _execute_category_page_query_with_retry_async(
+        self, session, category_id: int, store_id: int, after: str = None
+    ) -> dict:
+        for i in range(FETCH_ATTEMPTS):
             try:
-                return self._fetch_category_page(category_id, after)
+                return await self._execute_category_page_query_async(session, category_id, store_id, after)
             except Exception as e:
-                self.logger_util.write(f"Exception fetching category page: {e}")
+                is_last_attempt = i == FETCH_ATTEMPTS - 1
+                backoff_seconds = self._handle_fetch_failure(e, is_last_attempt)
+                if self._should_refresh_cookies(e):
+                    # The browser API is synchronous, so it has to run outside the event loop
+                    await asyncio.to_thread(self.cookie_manager.refresh, rejected_cookies=self.cookies)
+                # Nothing is left to wait for after the last attempt
+                if not is_last_attempt:
+                    await asyncio.sleep(backoff_seconds)
 
         raise ValueError("Failed to fetch page")
 
-    def process_category(self, category_id: int):
+    async def _save_page_with_retry_async(
+        self, price_containers: List[PriceContainer], category_document, on_saved: Callable[[], None]
+    ):
+        price_save_result = None
+        for i in range(FETCH_ATTEMPTS):
+            try:
+                # Saving to the database blocks, so do it off the event loop to keep the other stages running
+                if price_save_result is None:
+                    price_save_result = await asyncio.to_thread(
+                        self.db_client.stage_product_prices,
+                        price_containers=price_containers,
+                        category_document=category_document,
+                        on_saved=on_saved,
+                    )
+                # A staged page stays in the write buffer when flushing fails, so a retry only flushes again. Staging
+                # it twice would count its prices as unchanged and record its checkpoint twice.
+                await asyncio.to_thread(self.db_client.write_buffer.flush_if_due)
+                return price_save_result
+            except Exception as e:
+                self.metrics_util.increment("save_failures")
+                backoff_seconds = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**i)
+                if i == FETCH_ATTEMPTS - 1:
+                    self.logger_util.write(f"Exception saving category page: {e}")
+                else:
+                    self.logger_util.write(
+                        f"Exception saving category page: {e}. Retrying in {backoff_seconds} second(s)"
+                    )
+                    await asyncio.sleep(backoff_seconds)
+
+        raise ValueError("Failed to save page")
+
+    async def _fetch_stage(
+        self, session, category_id: int, store_id: int, after_cursor: Optional[str], fetched_pages: asyncio.Queue
+    ):
+        # Pages within a category have to be fetched in order since each one gives us the cursor for the next
+        while True:
+            result = await self._execute_category_page_query_with_retry_async(
+                session, category_id, store_id, after_cursor
+            )
+            await fetched_pages.put(result)
+
+            after_cursor = self._get_next_cursor(result)
+            if after_cursor is None:
+                break
+
+        await fetched_pages.put(None)
+
+    async def _parse_stage(
+        self, category_id: int, store_id: int, fetched_pages: asyncio.Queue, parsed_pages: asyncio.Queue
+    ):
+        while (result := await fetched_pages.get()) is not None:
+            browse_category = result["browseCategory"]
+            with self.metrics_util.timer("parse", category_id):
+                price_containers = self._parse_records(browse_category["records"], category_id, store_id)
+            self.metrics_util.increment("records_parsed", len(price_containers), category_id)
+            category_document = CategoryDocument(id=category_id, display_name=browse_category["pageTitle"])
+            await parsed_pages.put(
+                (self.product_registry, price_containers, category_document, self._get_next_cursor(result))
+            )
+
+        await parsed_pages.put(None)
+
+    async def _persist_stage(
+        self, category_id: int, store_id: int, parsed_pages: asyncio.Queue, category_crawl: object
+    ):
+        while (page := await parsed_pages.get()) is not None:
+            product_registry, price_containers, category_document, next_cursor = page
+            # Only checkpoint and register the products once the page is written so a crash never skips a page that
+            # was not persisted. With a write buffer that can be after later pages are saved.
+            price_save_result = await self._save_page_with_retry_async(
+                price_containers,
+                category_document,
+                on_saved=functools.partial(
+                    self._on_page_saved,
+                    product_registry,
+                    price_containers,
+                    category_id,
+                    next_cursor,
+                    store_id,
+                    category_crawl,
+                ),
+            )
+            self._record_page_stats(category_id, store_id, price_save_result)
+
+    def _get_start_cursor(self, category_id: int, store_id: int) -> Optional[str]:
         # See if we have already processed some pages in this category recently
-        after_cursor = self.recency_util.get_category_after_cursor(category_id)
+        after_cursor = self.recency_util.get_category_after_cursor(category_id, self._get_checkpoint_store_id(store_id))
         if after_cursor == RECENCY_CATEGORY_COMPLETE:
-            self.logger_util.write(f"Skipping category {category_id} as it is already complete")
-            return
+            self.logger_util.write(f"Skipping category {category_id} for store {store_id} as it is already complete")
         else:
-            self.logger_util.write(f"Starting with cursor {after_cursor} for category {category_id}")
-
-        # None means we have not completed the first page so grab that first
-        if after_cursor is None:
-            after_cursor = self._fetch_category_page_with_retry(category_id)
-            self._wait_random_time()
-
-        # Keep grabbing pages until we're done
-        while after_cursor is not None:
-            after_cursor = self._fetch_category_page_with_retry(category_id, after=after_cursor)
-            self._wait_random_time()
-
-    def process_all_categories(self):
-        for category in self.categories:
-            self.process_category(category)
-
-    def _wait_random_time(self):
-        seconds_to_sleep = random.randint(MIN_SLEEP_SECONDS, MAX_SLEEP_SECONDS)
-        self.logger_util.write(f"Sleeping for {seconds_to_sleep} second(s)")
-        sleep(seconds_to_sleep)
+            self.logger_util.write(f"Starting with cursor {after_cursor} for category {category_id} store {store_id}")
+        return after_cursor
+
+    async def process_category_async(self, session, category_id: int, store_id: Optional[int] = None):
+        """
+        Processes a single category of a store as a pipeline of fetch, parse and persist stages.
+
+        The stages are connected by bounded queues, so the next page is fetched while the previous one is being
+        saved, and fetching pauses when saving falls behind.
+
+        Args:
+            session: The async gql session shared by every category in the crawl
+            category_id: The ID of the category
+            store_id: The ID of the store to get prices for, the first store if not given
+        """
+        if store_id is None:
+            store_id = self.store_ids[0]
+        after_cursor = self._get_start_cursor(category_id, store_id)
+        if after_cursor == RECENCY_CATEGORY_COMPLETE:
+            return
+
+        category_crawl = self.category_crawls[(store_id, category_id)] = object()
+        fetched_pages = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        parsed_pages = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        tasks = [
+            asyncio.create_task(self._fetch_stage(session, category_id, store_id, after_cursor, fetched_pages)),
+            asyncio.create_task(self._parse_stage(category_id, store_id, fetched_pages, parsed_pages)),
+            asyncio.create_task(self._persist_stage(category_id, store_id, parsed_pages, category_crawl)),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+            self._finish_category(category_id, store_id)
+        except BaseException:
+            # A failed stage would leave the others blocked on their queues, so stop them too
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            # Anything saved so far has to be visible to readers even if the category failed part way
+            await asyncio.to_thread(self.db_client.flush_cache_invalidations)
+
+    async def process_all_categories_async(self, concurrency: int = DEFAULT_CRAWL_CONCURRENCY):
+        """
+        Processes every category of every store, crawling up to `concurrency` categories at the same time.
+
+        All stores and categories share a single HTTP session. A failing category does not stop the others, but the
+        first failure is raised once every category has finished.
+
+        Args:
+            concurrency: The maximum number of categories to crawl at once
+        """
+        async with self.client as session:
+            await self.process_all_categories_in_session_async(session, concurrency)
+
+    async def process_all_categories_in_session_async(self, session, concurrency: int = DEFAULT_CRAWL_CONCURRENCY):
+        """
+        Processes every category of every store like `process_all_categories_async`, but over a session that is
+        already open, so a long-running process can keep one connection pool and cookie jar across crawls.
+
+        Args:
+            session: The async gql session to crawl with
+            concurrency: The maximum number of categories to crawl at once
+        """
+        # Prices are saved with the date of the crawl they were seen in, which moves on between crawls of a daemon
+        self.start_run()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def process_category_with_limit(session, category_id: int, store_id: int):
+            async with semaphore:
+                await self.process_category_async(session, category_id, store_id)
+
+        # Categories start in store order, so later stores mostly find their products already written and unchanged
+        crawl_targets = self._get_crawl_targets()
+        results = await asyncio.gather(
+            *(process_category_with_limit(session, category_id, store_id) for store_id, category_id in crawl_targets),
+            return_exceptions=True,
+        )
+        # Write out anything still buffered, which also records the checkpoints waiting on it
+        await asyncio.to_thread(self.db_client.flush_writes)
+        if self.category_scheduler is not None:
+            self.category_scheduler.save()
+
+        # Only categories that were crawled without failing can tell which products left them
+        failed_categories = {
+            category_id for (_, category_id), result in zip(crawl_targets, results) if isinstance(result, Exception)
+        }
+        crawled_categories = sorted({category_id for _, category_id in crawl_targets} - failed_categories)
+        await asyncio.to_thread(self.db_client.prune_category_products, crawled_categories)
+
+        errors = []
+        for (store_id, category_id), result in zip(crawl_targets, results):
+            if isinstance(result, Exception):
+                self.logger_util.write(f"Failed to process category {category_id} for store {store_id}: {result}")
+                errors.append(result)
+
+        if errors:
+            raise errors[0]
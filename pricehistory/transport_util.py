@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import re
+from typing import Any, Optional, Tuple
+
+from aiohttp import ClientResponse
+from atomicwrites import atomic_write
+from gql.transport import AsyncTransport
+from gql.transport.aiohttp import AIOHTTPTransport
+from graphql import ExecutionResult, SelectionSetNode, print_ast
+
+from pricehistory.constants import RESPONSE_BYTES_EXTENSION
+
+_CATEGORY_PATTERN = re.compile(r'categoryId:\s*"([^"]+)"')
+_STORE_PATTERN = re.compile(r"storeId:\s*(\d+)")
+_CURSOR_PATTERN = re.compile(r'cursor:\s*(null|"([^"]*)")')
+
+
+def parse_browse_category_request(request) -> Tuple[str, str, Optional[str]]:
+    """
+    Pulls the category ID, store ID and cursor out of a browseCategory request.
+
+    Args:
+        request: The gql request (or document for older gql versions) sent to the transport
+
+    Returns:
+        A tuple of (category ID, store ID, cursor). The cursor is None for the first page of a category.
+    """
+    query = print_ast(getattr(request, "document", request))
+    category_match = _CATEGORY_PATTERN.search(query)
+    store_match = _STORE_PATTERN.search(query)
+    cursor_match = _CURSOR_PATTERN.search(query)
+    if not category_match or not store_match or not cursor_match:
+        raise ValueError("Request is not a browseCategory query")
+
+    return category_match.group(1), store_match.group(1), cursor_match.group(2)
+
+
+def select_fields(value, selection_set: Optional[SelectionSetNode]):
+    """
+    Keeps only the fields a query selects from a response, like the API would have sent them.
+    """
+    if selection_set is None:
+        return value
+    if isinstance(value, list):
+        return [select_fields(item, selection_set) for item in value]
+    if not isinstance(value, dict):
+        return value
+
+    selected = {}
+    for field in selection_set.selections:
+        name = field.name.value
+        if name in value:
+            selected[field.alias.value if field.alias else name] = select_fields(value[name], field.selection_set)
+    return selected
+
+
+def get_fixture_file_name(category_id: str, store_id: str, cursor: Optional[str]) -> str:
+    # Cursors are opaque strings from the API, so hash them to get a safe file name
+    cursor_key = "first" if cursor is None else hashlib.sha1(cursor.encode("utf-8")).hexdigest()[:16]
+    return f"{category_id}_{store_id}_{cursor_key}.json"
+
+
+class MeteredAIOHTTPTransport(AIOHTTPTransport):
+    """
+    Talks to the API like AIOHTTPTransport and adds the size in bytes of every response body, as it arrived before
+    being decoded, to the result's extensions. The size travels with each page's result to whoever executed it.
+    """
+
+    async def _get_json_result(self, response: ClientResponse) -> Any:
+        result = await super()._get_json_result(response)
+        if isinstance(result, dict):
+            # aiohttp keeps the body it already read for decoding, so this does not wait on the server again
+            body = await response.read()
+            result["extensions"] = {**(result.get("extensions") or {}), RESPONSE_BYTES_EXTENSION: len(body)}
+        return result
+
+
+class RecordingAIOHTTPTransport(MeteredAIOHTTPTransport):
+    """
+    Talks to the API like MeteredAIOHTTPTransport and also saves every browseCategory response as a fixture file.
+    """
+
+    def __init__(self, fixtures_dir: str, **kwargs):
+        super().__init__(**kwargs)
+        self.fixtures_dir = fixtures_dir
+        os.makedirs(self.fixtures_dir, exist_ok=True)
+
+    async def execute(self, request, *args, **kwargs) -> ExecutionResult:
+        result = await super().execute(request, *args, **kwargs)
+
+        if result.errors is None:
+            fixture_path = os.path.join(
+                self.fixtures_dir, get_fixture_file_name(*parse_browse_category_request(request))
+            )
+            with atomic_write(fixture_path, mode="w", encoding="utf-8", overwrite=True) as fixture_file:
+                json.dump(result.data, fixture_file)
+
+        return result
+
+
+class ReplayTransport(AsyncTransport):
+    """
+    Stands in for the API by answering browseCategory requests from recorded fixture files.
+
+    Responses are cut down to the fields the request selects, so fixtures recorded with the full query profile also
+    replay the smaller price-only one, and their size is reported like MeteredAIOHTTPTransport does.
+    """
+
+    def __init__(self, fixtures_dir: str):
+        self.fixtures_dir = fixtures_dir
+        self.cookies = None
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def load_response(self, category_id: str, store_id: str, cursor: Optional[str]) -> dict:
+        fixture_path = os.path.join(self.fixtures_dir, get_fixture_file_name(category_id, store_id, cursor))
+        with open(fixture_path, mode="r", encoding="utf-8") as fixture_file:
+            return json.load(fixture_file)
+
+    async def execute(self, request, *args, **kwargs) -> ExecutionResult:
+        document = getattr(request, "document", request)
+        data = select_fields(
+            self.load_response(*parse_browse_category_request(request)), document.definitions[0].selection_set
+        )
+        return ExecutionResult(data=data, extensions={RESPONSE_BYTES_EXTENSION: len(json.dumps(data).encode("utf-8"))})
+
+    def subscribe(self, request, *args, **kwargs):
+        raise NotImplementedError("Subscriptions cannot be replayed")
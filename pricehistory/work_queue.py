@@ -0,0 +1,195 @@
+import time
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import redis
+
+from pricehistory.constants import WORK_LEASE_SECONDS, WORK_MAX_ATTEMPTS, WORK_QUEUE_NAME
+from pricehistory.data.work_lease import WorkLease
+
+
+def _as_str(value) -> Optional[str]:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class WorkQueue:
+    """
+    Hands out (store ID, category ID) crawl targets to workers through Redis, one lease at a time.
+
+    Every queued target is a member of a sorted set scored by the time it can next be leased. Waiting targets are scored
+    in the past, and leasing one moves its score to when the lease runs out, so a target whose worker stops renewing
+    its lease goes to the next worker that asks for work. Leases are taken with WATCH and MULTI, so two workers never
+    hold the same target, and a worker can only renew, complete or release a target it still owns.
+
+    Every batch the coordinator queues with `start_cycle` gets a new cycle ID and start date, which are handed out with
+    each lease so workers know when a new crawl has started and all save its prices with the same date.
+
+    A target whose crawl fails `max_attempts` times in a cycle is moved to a set of failed targets instead of being
+    queued again, so a category that always fails cannot keep the queue from ever draining.
+    """
+
+    def __init__(
+        self,
+        cache: redis.Redis,
+        lease_seconds: float = WORK_LEASE_SECONDS,
+        name: str = WORK_QUEUE_NAME,
+        max_attempts: int = WORK_MAX_ATTEMPTS,
+    ):
+        self.cache = cache
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.items_key = f"{name}_items"
+        self.owners_key = f"{name}_owners"
+        self.cycle_key = f"{name}_cycle"
+        self.cycle_start_key = f"{name}_cycle_start"
+        self.attempts_key = f"{name}_attempts"
+        self.failed_key = f"{name}_failed"
+
+    @staticmethod
+    def _encode(store_id: int, category_id: int) -> str:
+        return f"{store_id}_{category_id}"
+
+    @staticmethod
+    def _decode(item: str) -> Tuple[int, int]:
+        store_id, category_id = item.split("_")
+        return int(store_id), int(category_id)
+
+    def enqueue(self, crawl_targets: List[Tuple[int, int]]) -> int:
+        """
+        Queues crawl targets in order. Targets that are already queued or leased are left alone.
+
+        Returns:
+            The number of targets that were added
+        """
+        if not crawl_targets:
+            return 0
+
+        # Scores far in the past keep the targets in the given order ahead of expired leases
+        items = {self._encode(*crawl_target): i for i, crawl_target in enumerate(crawl_targets)}
+        return self.cache.zadd(self.items_key, items, nx=True)
+
+    def start_cycle(self, crawl_targets: List[Tuple[int, int]], start_date: Optional[datetime] = None) -> int:
+        """
+        Starts a new crawl cycle and queues its targets like `enqueue`. Targets still queued from the last cycle are
+        crawled as part of the new one, and targets that failed in the last cycle get their attempts back.
+
+        Returns:
+            The number of targets that were added
+        """
+        items = {self._encode(*crawl_target): i for i, crawl_target in enumerate(crawl_targets)}
+        pipeline = self.cache.pipeline()
+        pipeline.incr(self.cycle_key)
+        pipeline.set(self.cycle_start_key, (start_date or datetime.today()).isoformat())
+        pipeline.delete(self.attempts_key, self.failed_key)
+        if items:
+            pipeline.zadd(self.items_key, items, nx=True)
+        results = pipeline.execute()
+        return results[-1] if items else 0
+
+    def num_items(self) -> int:
+        return self.cache.zcard(self.items_key)
+
+    def get_failed(self) -> List[Tuple[int, int]]:
+        """
+        Returns the (store ID, category ID) targets that ran out of attempts this cycle.
+        """
+        return sorted(self._decode(_as_str(item)) for item in self.cache.smembers(self.failed_key))
+
+    def lease(self, worker_id: str) -> Optional[WorkLease]:
+        """
+        Leases the next target that is waiting or whose lease has run out.
+
+        Returns:
+            The lease, or None if every queued target is leased
+        """
+
+        def claim(pipeline) -> Optional[WorkLease]:
+            now = time.time()
+            items = pipeline.zrangebyscore(self.items_key, "-inf", now, start=0, num=1)
+            if not items:
+                return None
+
+            item = _as_str(items[0])
+            previous_owner = _as_str(pipeline.hget(self.owners_key, item))
+            cycle_id, cycle_start = pipeline.mget(self.cycle_key, self.cycle_start_key)
+            attempts = pipeline.hget(self.attempts_key, item)
+            pipeline.multi()
+            pipeline.zadd(self.items_key, {item: now + self.lease_seconds})
+            pipeline.hset(self.owners_key, item, worker_id)
+            return WorkLease(
+                *self._decode(item),
+                previous_owner=previous_owner,
+                cycle_id=int(cycle_id) if cycle_id is not None else None,
+                cycle_start=datetime.fromisoformat(_as_str(cycle_start)) if cycle_start is not None else None,
+                attempts=int(attempts) if attempts is not None else 0,
+            )
+
+        return self.cache.transaction(claim, self.items_key, value_from_callable=True)
+
+    def _update_owned(self, lease: WorkLease, worker_id: str, update) -> bool:
+        item = self._encode(lease.store_id, lease.category_id)
+
+        def update_if_owned(pipeline) -> bool:
+            if _as_str(pipeline.hget(self.owners_key, item)) != worker_id:
+                return False
+            pipeline.multi()
+            update(pipeline, item)
+            return True
+
+        return self.cache.transaction(update_if_owned, self.owners_key, value_from_callable=True)
+
+    def renew(self, lease: WorkLease, worker_id: str) -> bool:
+        """
+        Extends a lease. Returns False if another worker has taken the target over, in which case it should be dropped.
+        """
+        return self._update_owned(
+            lease,
+            worker_id,
+            lambda pipeline, item: pipeline.zadd(self.items_key, {item: time.time() + self.lease_seconds}, xx=True),
+        )
+
+    def complete(self, lease: WorkLease, worker_id: str) -> bool:
+        def remove(pipeline, item: str):
+            pipeline.zrem(self.items_key, item)
+            pipeline.hdel(self.owners_key, item)
+            pipeline.hdel(self.attempts_key, item)
+
+        return self._update_owned(lease, worker_id, remove)
+
+    def release(self, lease: WorkLease, worker_id: str, delay_seconds: float = 0) -> bool:
+        """
+        Gives a target back so any worker can lease it again after `delay_seconds`.
+        """
+
+        def requeue(pipeline, item: str):
+            pipeline.zadd(self.items_key, {item: time.time() + delay_seconds}, xx=True)
+            pipeline.hdel(self.owners_key, item)
+
+        return self._update_owned(lease, worker_id, requeue)
+
+    def fail(self, lease: WorkLease, worker_id: str, delay_seconds: float = 0) -> bool:
+        """
+        Gives a target back after a failed crawl like `release`, or moves it to the failed targets once it has failed
+        `max_attempts` times.
+
+        Returns:
+            Whether the target will be retried
+        """
+        if lease.attempts + 1 < self.max_attempts:
+
+            def requeue(pipeline, item: str):
+                pipeline.zadd(self.items_key, {item: time.time() + delay_seconds}, xx=True)
+                pipeline.hdel(self.owners_key, item)
+                pipeline.hincrby(self.attempts_key, item)
+
+            self._update_owned(lease, worker_id, requeue)
+            return True
+
+        def give_up(pipeline, item: str):
+            pipeline.zrem(self.items_key, item)
+            pipeline.hdel(self.owners_key, item)
+            pipeline.hdel(self.attempts_key, item)
+            pipeline.sadd(self.failed_key, item)
+
+        self._update_owned(lease, worker_id, give_up)
+        return False
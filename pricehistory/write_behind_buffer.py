@@ -0,0 +1,127 @@
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
+
+from pricehistory.constants import WRITE_BUFFER_MAX_AGE_SECONDS
+from pricehistory.metrics_util import MetricsUtil
+
+
+class WriteBehindBuffer:
+    """
+    Holds database writes from many pages and categories and sends them as large unordered bulk writes.
+
+    The buffer is flushed once it holds `max_operations` operations or its oldest operation is `max_age_seconds` old.
+    A `max_operations` of 0 flushes on every check, which writes each page through as before.
+
+    Work that must only happen once the writes are in the database, like recency checkpoints, is registered with
+    `add_after_flush` and runs in order after the flush that covers it. Flush listeners run before those callbacks on
+    every successful flush.
+    """
+
+    def __init__(
+        self,
+        max_operations: int = 0,
+        max_age_seconds: float = WRITE_BUFFER_MAX_AGE_SECONDS,
+        metrics_util: Optional[MetricsUtil] = None,
+    ):
+        self.max_operations = max_operations
+        self.max_age_seconds = max_age_seconds
+        self.metrics_util = metrics_util if metrics_util is not None else MetricsUtil()
+
+        self.collections: Dict[str, Collection] = {}
+        self.operations: Dict[str, list] = {}
+        # Lets a later write to the same document replace the earlier one instead of being sent as well
+        self.keyed_operations: Dict[Tuple[str, Hashable], int] = {}
+        self.after_flush_callbacks: List[Callable[[], None]] = []
+        self.flush_listeners: List[Callable[[], None]] = []
+        self.oldest_operation_time: Optional[float] = None
+
+        # Reentrant so callers can hold the lock across staging several writes and the flush check
+        self.lock = threading.RLock()
+
+    @property
+    def num_operations(self) -> int:
+        with self.lock:
+            return sum(len(operations) for operations in self.operations.values())
+
+    def add(self, collection: Collection, operation, key: Optional[Hashable] = None):
+        with self.lock:
+            operations = self.operations.setdefault(collection.name, [])
+            self.collections[collection.name] = collection
+            if self.oldest_operation_time is None:
+                self.oldest_operation_time = time.monotonic()
+
+            if key is not None and (collection.name, key) in self.keyed_operations:
+                operations[self.keyed_operations[(collection.name, key)]] = operation
+                return
+
+            if key is not None:
+                self.keyed_operations[(collection.name, key)] = len(operations)
+            operations.append(operation)
+
+    def add_after_flush(self, callback: Callable[[], None]):
+        with self.lock:
+            self.after_flush_callbacks.append(callback)
+
+    def add_flush_listener(self, listener: Callable[[], None]):
+        self.flush_listeners.append(listener)
+
+    def flush_if_due(self) -> bool:
+        """
+        Flushes the buffer if it is full or old enough, or if it has no writes holding back its callbacks.
+
+        Returns:
+            Whether the buffer was flushed
+        """
+        with self.lock:
+            num_operations = self.num_operations
+            is_due = (
+                num_operations == 0
+                or num_operations >= self.max_operations
+                or time.monotonic() - self.oldest_operation_time >= self.max_age_seconds
+            )
+            if is_due:
+                self.flush()
+            return is_due
+
+    def flush(self):
+        with self.lock:
+            num_operations = self.num_operations
+            if num_operations:
+                with self.metrics_util.timer("write_buffer_flush"):
+                    for collection_name in list(self.operations):
+                        self._flush_collection(collection_name)
+                self.metrics_util.increment("write_buffer_operations", num_operations)
+            self.oldest_operation_time = None
+
+            for listener in self.flush_listeners:
+                listener()
+
+            callbacks = self.after_flush_callbacks
+            self.after_flush_callbacks = []
+            for callback in callbacks:
+                callback()
+
+    def _flush_collection(self, collection_name: str):
+        operations = self.operations[collection_name]
+        try:
+            # Nothing in the buffer depends on the order of the writes, so let the server apply them in parallel
+            with self.metrics_util.timer(f"{collection_name}_bulk_write"):
+                self.collections[collection_name].bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Only keep the writes that failed so retrying the flush does not apply the others twice
+            failed_indexes = {error["index"] for error in e.details.get("writeErrors", [])}
+            self.operations[collection_name] = [operations[i] for i in sorted(failed_indexes)]
+            self._forget_keys(collection_name)
+            raise
+
+        del self.operations[collection_name]
+        self._forget_keys(collection_name)
+
+    def _forget_keys(self, collection_name: str):
+        self.keyed_operations = {
+            key: index for key, index in self.keyed_operations.items() if key[0] != collection_name
+        }
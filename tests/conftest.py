@@ -0,0 +1,66 @@
+import logging
+
+import fakeredis
+import pytest
+
+from benchmarks.local_mongo import LocalMongoClient
+from pricehistory.constants import REDIS_VERSION
+from pricehistory.db_client import DBClient
+from pricehistory.logger_util import LoggerUtil
+from pricehistory.rate_limiter import RateLimiter
+from pricehistory.receny_util import RecencyUtil
+from pricehistory.source_client import SourceClient
+
+
+@pytest.fixture(autouse=True)
+def working_dir(tmp_path, monkeypatch):
+    # LoggerUtil and the journals write next to the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def logger_util():
+    return LoggerUtil(level=logging.WARNING)
+
+
+@pytest.fixture
+def cache():
+    return fakeredis.FakeStrictRedis(version=REDIS_VERSION)
+
+
+@pytest.fixture
+def make_db_client(logger_util, cache):
+    def make(**kwargs) -> DBClient:
+        return DBClient("", logger_util, cache=cache, mongo_client=LocalMongoClient(), **kwargs)
+
+    return make
+
+
+@pytest.fixture
+def db_client(make_db_client):
+    return make_db_client()
+
+
+@pytest.fixture
+def make_source_client(working_dir, logger_util):
+    def make(db_client: DBClient, transport, store_ids=(1,), recency_util=None, **kwargs) -> SourceClient:
+        if recency_util is None:
+            recency_util = RecencyUtil(
+                recency_file_path=str(working_dir / "recency.journal"), legacy_recency_file_path=None
+            )
+        return SourceClient(
+            api_url="http://localhost",
+            store_ids=list(store_ids),
+            categories=transport.categories,
+            cookies={},
+            db_client=db_client,
+            recency_util=recency_util,
+            logger_util=logger_util,
+            rate_limiter=RateLimiter(requests_per_minute=None, jitter_seconds=0),
+            transport=transport,
+            metrics_util=db_client.metrics_util,
+            **kwargs,
+        )
+
+    return make
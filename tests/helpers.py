@@ -0,0 +1,47 @@
+import asyncio
+from datetime import datetime
+
+from benchmarks.synthetic_catalog import SyntheticCatalogTransport
+from pricehistory.data.price_container import PriceContainer
+from pricehistory.data.price_document import PriceDocument
+from pricehistory.data.product_document import ProductDocument
+
+
+def build_page(product_ids, category_id=1, store_id=1, price_cents=100, start_date=datetime(2024, 1, 1)):
+    return [
+        PriceContainer(
+            product_document=ProductDocument(
+                id=product_id, display_name=f"Product {product_id}", category=category_id, categories=[category_id]
+            ),
+            price_document=PriceDocument(
+                product_id=product_id, price_cents=price_cents, start_date=start_date, store_id=store_id
+            ),
+        )
+        for product_id in product_ids
+    ]
+
+
+class SlowCatalogTransport(SyntheticCatalogTransport):
+    """
+    Takes a moment to answer each page and keeps track of how many pages were requested at the same time.
+    """
+
+    def __init__(self, *args, failing_categories=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failing_categories = {str(category_id) for category_id in failing_categories}
+        self.num_in_flight = 0
+        self.max_in_flight = 0
+
+    async def execute(self, request, *args, **kwargs):
+        self.num_in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.num_in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            return await super().execute(request, *args, **kwargs)
+        finally:
+            self.num_in_flight -= 1
+
+    def load_response(self, category_id, store_id, cursor):
+        if category_id in self.failing_categories:
+            raise ConnectionError("connection reset")
+        return super().load_response(category_id, store_id, cursor)
@@ -0,0 +1,56 @@
+import pytest
+from redis.exceptions import ConnectionError
+
+from benchmarks.round_trip_counter import RoundTripCounter
+from pricehistory.cache_invalidator import CacheInvalidator
+
+
+def test_pending_keys_are_dropped_in_one_round_trip(db_client, cache):
+    cache.mset({f"key_{i}": i for i in range(5)})
+    round_trip_counter = RoundTripCounter()
+    round_trip_counter.instrument(db_client)
+    cache_invalidator = db_client.cache_invalidator
+
+    cache_invalidator.add("key_0", "key_1")
+    cache_invalidator.add("key_1", "key_2", "missing")
+
+    assert cache_invalidator.flush() == 4
+    assert round_trip_counter.redis == 1
+    assert sorted(cache.keys()) == [b"key_3", b"key_4"]
+    assert cache_invalidator.flush() == 0
+
+
+def test_deferred_keys_wait_for_a_full_batch_or_a_forced_flush(cache):
+    cache.mset({f"key_{i}": i for i in range(3)})
+    cache_invalidator = CacheInvalidator(cache, deferred=True, max_pending_keys=2)
+
+    cache_invalidator.add("key_0")
+    assert cache_invalidator.flush() == 0
+    assert cache_invalidator.flush(force=True) == 1
+
+    cache_invalidator.add("key_1", "key_2")
+    assert cache_invalidator.flush() == 2
+    assert cache.keys() == []
+
+
+def test_keys_are_kept_when_the_flush_fails(cache, monkeypatch):
+    cache.set("key_0", 0)
+    cache_invalidator = CacheInvalidator(cache)
+    cache_invalidator.add("key_0")
+    pipeline = cache.pipeline
+
+    def failing_execute(*args, **kwargs):
+        raise ConnectionError("connection reset")
+
+    def failing_pipeline(*args, **kwargs):
+        failing = pipeline(*args, **kwargs)
+        failing.execute = failing_execute
+        return failing
+
+    monkeypatch.setattr(cache, "pipeline", failing_pipeline)
+    with pytest.raises(ConnectionError):
+        cache_invalidator.flush()
+    monkeypatch.undo()
+
+    assert cache_invalidator.flush() == 1
+    assert cache.get("key_0") is None
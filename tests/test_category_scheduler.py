@@ -0,0 +1,86 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from benchmarks.synthetic_catalog import SyntheticCatalogTransport
+from pricehistory.category_scheduler import CategoryScheduler
+
+
+@pytest.fixture
+def make_scheduler(working_dir, logger_util):
+    def make(schedule=None, **kwargs) -> CategoryScheduler:
+        category_scheduler = CategoryScheduler(
+            logger_util, schedule_file_path=str(working_dir / "schedule.json"), **kwargs
+        )
+        category_scheduler.schedule.update(schedule or {})
+        return category_scheduler
+
+    return make
+
+
+def entry(change_rate: float, hours_ago: float, pages: float = 10) -> dict:
+    return {
+        "change_rate": change_rate,
+        "pages": pages,
+        "last_crawled": (datetime.now() - timedelta(hours=hours_ago)).isoformat(),
+    }
+
+
+def test_volatile_and_unknown_categories_are_due_before_stable_ones(make_scheduler):
+    category_scheduler = make_scheduler(
+        {"1_1": entry(change_rate=0.0001, hours_ago=24), "1_2": entry(change_rate=0.01, hours_ago=24)}
+    )
+
+    assert category_scheduler.select([(1, 1), (1, 2), (1, 3)], in_progress=set()) == [(1, 3), (1, 2)]
+
+
+def test_categories_are_crawled_at_least_every_max_interval(make_scheduler):
+    category_scheduler = make_scheduler({"1_1": entry(change_rate=0, hours_ago=25)}, max_interval_hours=24)
+
+    assert category_scheduler.select([(1, 1)], in_progress=set()) == [(1, 1)]
+
+
+def test_request_budget_goes_to_the_most_changed_categories(make_scheduler):
+    category_scheduler = make_scheduler(
+        {
+            "1_1": entry(change_rate=0.01, hours_ago=10, pages=20),
+            "1_2": entry(change_rate=0.02, hours_ago=10, pages=20),
+            "1_3": entry(change_rate=0.03, hours_ago=10, pages=20),
+            "1_4": entry(change_rate=0.0001, hours_ago=10, pages=20),
+        },
+        request_budget=45,
+    )
+
+    assert category_scheduler.select([(1, 1), (1, 2), (1, 3)], in_progress=set()) == [(1, 3), (1, 2)]
+    # Unfinished categories are finished first, even over the budget
+    assert category_scheduler.select([(1, 1), (1, 2), (1, 3), (1, 4)], in_progress={(1, 4)}) == [(1, 4), (1, 3)]
+
+
+def test_at_least_one_category_is_crawled_over_the_budget(make_scheduler):
+    category_scheduler = make_scheduler({"1_1": entry(change_rate=0.01, hours_ago=10, pages=50)}, request_budget=10)
+
+    assert category_scheduler.select([(1, 1)], in_progress=set()) == [(1, 1)]
+
+
+def test_crawls_are_learned_from_and_saved(make_scheduler):
+    category_scheduler = make_scheduler()
+    category_scheduler.record_crawl(1, 1, num_prices=100, num_changed=24, num_pages=2)
+    category_scheduler.schedule["1_1"]["last_crawled"] = (datetime.now() - timedelta(hours=2)).isoformat()
+    category_scheduler.record_crawl(1, 1, num_prices=100, num_changed=0, num_pages=4)
+    category_scheduler.save()
+
+    schedule_entry = make_scheduler().schedule["1_1"]
+    assert schedule_entry["change_rate"] == pytest.approx(0.7 * 0.01)
+    assert schedule_entry["pages"] == pytest.approx(0.3 * 4 + 0.7 * 2)
+
+
+def test_crawl_skips_categories_that_are_not_due(db_client, make_source_client, make_scheduler):
+    transport = SyntheticCatalogTransport(num_products=300, num_categories=3, price_change_rate=0)
+    category_scheduler = make_scheduler({"1_2": entry(change_rate=0, hours_ago=1)})
+    source_client = make_source_client(db_client, transport, category_scheduler=category_scheduler)
+
+    asyncio.run(source_client.process_all_categories_async())
+
+    assert db_client.prices_collection.count_documents({}) == 200
+    assert sorted(make_scheduler().schedule) == ["1_1", "1_2", "1_3"]
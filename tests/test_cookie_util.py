@@ -0,0 +1,66 @@
+import json
+import time
+
+import pytest
+
+from pricehistory import cookie_util as cookie_util_module
+from pricehistory.constants import COOKIE_MIN_REFRESH_INTERVAL_SECONDS, COOKIE_SESSION_TTL_HOURS
+from pricehistory.cookie_util import CookieManager
+
+
+@pytest.fixture
+def harvests(monkeypatch):
+    harvests = []
+
+    def harvest_cookies(cookie_url):
+        harvests.append(cookie_url)
+        return [{"name": "incap_ses_1", "value": f"session {len(harvests)}", "expires": -1}]
+
+    monkeypatch.setattr(cookie_util_module, "_harvest_cookies", harvest_cookies)
+    return harvests
+
+
+def test_cached_cookies_are_used_without_launching_the_browser(harvests, logger_util):
+    cookies = CookieManager("https://example.com", logger_util).get_cookies()
+
+    assert CookieManager("https://example.com", logger_util).get_cookies() == cookies == {"incap_ses_1": "session 1"}
+    assert len(harvests) == 1
+
+
+def test_expired_session_cookies_are_harvested_again(harvests, logger_util, working_dir):
+    with open(working_dir / "cookies.json", mode="w", encoding="utf-8") as cookie_file:
+        json.dump(
+            {
+                "harvested_at": time.time() - COOKIE_SESSION_TTL_HOURS * 3600 - 1,
+                "cookies": [{"name": "incap_ses_1", "value": "stale", "expires": -1}],
+            },
+            cookie_file,
+        )
+
+    assert CookieManager("https://example.com", logger_util).get_cookies() == {"incap_ses_1": "session 1"}
+    assert len(harvests) == 1
+
+
+def test_rejected_cookies_are_only_refreshed_once(harvests, logger_util, monkeypatch):
+    cookie_manager = CookieManager("https://example.com", logger_util)
+    rejected_cookies = cookie_manager.get_cookies()
+    refreshed_cookies = []
+    cookie_manager.add_listener(refreshed_cookies.append)
+    monkeypatch.setattr(
+        cookie_util_module.time, "time", lambda: cookie_manager.harvested_at + COOKIE_MIN_REFRESH_INTERVAL_SECONDS
+    )
+
+    # Every request that was rejected with the same cookies asks for a refresh
+    assert cookie_manager.refresh(rejected_cookies=rejected_cookies) == {"incap_ses_1": "session 2"}
+    assert cookie_manager.refresh(rejected_cookies=rejected_cookies) == {"incap_ses_1": "session 2"}
+
+    assert len(harvests) == 2
+    assert refreshed_cookies == [{"incap_ses_1": "session 2"}]
+
+
+def test_cookies_are_not_refreshed_again_right_after_a_refresh(harvests, logger_util):
+    cookie_manager = CookieManager("https://example.com", logger_util)
+    rejected_cookies = cookie_manager.get_cookies()
+
+    assert cookie_manager.refresh(rejected_cookies=rejected_cookies) == rejected_cookies
+    assert len(harvests) == 1
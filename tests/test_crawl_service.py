@@ -0,0 +1,142 @@
+import asyncio
+import functools
+import json
+
+import pytest
+
+from benchmarks.local_mongo import LocalMongoClient
+from benchmarks.synthetic_catalog import SyntheticCatalogTransport
+from pricehistory import cookie_util as cookie_util_module
+from pricehistory import crawl_service as crawl_service_module
+from pricehistory.config_util import load_config
+from pricehistory.constants import QUERY_PROFILE_FULL, QUERY_PROFILE_PRICES
+from pricehistory.crawl_service import CrawlService
+from pricehistory.db_client import DBClient
+
+CONFIG = {
+    "apiUrl": "http://localhost/graphql",
+    "categories": [1, 2],
+    "cookieUrl": "http://localhost",
+    "storeId": 1,
+    "db_username": "user",
+    "db_password": "password",
+    "db_host": "localhost",
+    "healthcheck_url": "http://localhost/ping",
+    "data_cache_url": None,
+    "replayFixturesDir": "fixtures",
+    "requestsPerMinute": None,
+    "crawlIntervalMinutes": 0,
+}
+
+
+def write_config(working_dir, **settings):
+    with open(working_dir / "config.json", mode="w", encoding="utf-8") as config_file:
+        json.dump({**CONFIG, **settings}, config_file)
+
+
+@pytest.fixture
+def transport(monkeypatch):
+    transport = SyntheticCatalogTransport(num_products=200, num_categories=2)
+    monkeypatch.setattr(crawl_service_module, "ReplayTransport", lambda fixtures_dir: transport)
+    return transport
+
+
+@pytest.fixture
+def make_crawl_service(working_dir, logger_util, cache, transport, monkeypatch):
+    monkeypatch.setattr(cookie_util_module, "_harvest_cookies", lambda cookie_url: [])
+    monkeypatch.setattr(crawl_service_module, "DBClient", functools.partial(DBClient, mongo_client=LocalMongoClient()))
+    monkeypatch.setattr(crawl_service_module.redis.Redis, "from_url", lambda url: cache)
+
+    def make(**settings) -> CrawlService:
+        write_config(working_dir, **settings)
+        crawl_service = CrawlService(
+            load_config(str(working_dir / "config.json")), logger_util, str(working_dir / "config.json")
+        )
+        crawl_service.pings = []
+        crawl_service._ping_healthcheck = lambda: crawl_service.pings.append(True)
+        return crawl_service
+
+    return make
+
+
+def stop_after_cycles(crawl_service: CrawlService, num_cycles: int, monkeypatch):
+    stop_event = asyncio.Event()
+    run_cycle_async = crawl_service._run_cycle_async
+    cycles = []
+
+    async def counted_run_cycle_async(session):
+        cycles.append(session)
+        try:
+            await run_cycle_async(session)
+        finally:
+            if len(cycles) == num_cycles:
+                stop_event.set()
+
+    monkeypatch.setattr(crawl_service, "_create_stop_event", lambda: stop_event)
+    monkeypatch.setattr(crawl_service, "_run_cycle_async", counted_run_cycle_async)
+    return cycles
+
+
+def test_daemon_keeps_one_session_across_cycles(make_crawl_service, monkeypatch):
+    crawl_service = make_crawl_service()
+    cycles = stop_after_cycles(crawl_service, 2, monkeypatch)
+
+    crawl_service.run_forever()
+
+    assert len(cycles) == 2
+    assert cycles[0] is cycles[1]
+    assert crawl_service.pings == [True, True]
+    assert crawl_service.db_client.prices_collection.count_documents({}) == 200
+
+
+def test_failed_cycle_skips_its_ping_and_the_next_cycle_still_runs(make_crawl_service, transport, monkeypatch):
+    crawl_service = make_crawl_service()
+    cycles = stop_after_cycles(crawl_service, 2, monkeypatch)
+    load_response = transport.load_response
+    failures = [ConnectionError("connection reset")] * 5
+
+    def flaky_load_response(*args):
+        if failures:
+            raise failures.pop()
+        return load_response(*args)
+
+    monkeypatch.setattr(crawl_service_module.RateLimiter, "record_failure", lambda self, status_code=None: 0)
+    monkeypatch.setattr(transport, "load_response", flaky_load_response)
+
+    crawl_service.run_forever()
+
+    assert len(cycles) == 2
+    assert crawl_service.pings == [True]
+    assert crawl_service.db_client.prices_collection.count_documents({}) == 200
+
+
+def test_changed_config_is_applied_between_cycles(make_crawl_service, working_dir):
+    crawl_service = make_crawl_service()
+    crawl_service._build_source_client()
+    assert not crawl_service.reload_config()
+
+    write_config(working_dir, requestsPerMinute=30, writeBufferSize=50, db_host="elsewhere", storeIds=[2, 1])
+    assert crawl_service.reload_config()
+
+    assert crawl_service.source_client.rate_limiter.requests_per_minute == 30
+    assert crawl_service.db_client.write_buffer.max_operations == 50
+    # Connections and the first store only change with a restart
+    assert crawl_service.config.db_host == "localhost"
+    assert crawl_service.config.store_ids == [1]
+
+
+def test_query_profile_can_change_but_an_unknown_one_keeps_the_config(make_crawl_service, working_dir):
+    crawl_service = make_crawl_service()
+    crawl_service._build_source_client()
+    assert crawl_service.source_client.query_profile == QUERY_PROFILE_PRICES
+
+    write_config(working_dir, queryProfile=QUERY_PROFILE_FULL)
+    assert crawl_service.reload_config()
+    assert crawl_service.source_client.query_profile == QUERY_PROFILE_FULL
+
+    write_config(working_dir, queryProfile="all", requestsPerMinute=30)
+    with pytest.raises(ValueError, match="Unknown query profile"):
+        load_config(str(working_dir / "config.json"))
+    assert not crawl_service.reload_config()
+    assert crawl_service.source_client.query_profile == QUERY_PROFILE_FULL
+    assert crawl_service.source_client.rate_limiter.requests_per_minute is None
@@ -0,0 +1,91 @@
+import asyncio
+from datetime import datetime
+
+from gql import Client
+
+from pricehistory import crawl_worker as crawl_worker_module
+from pricehistory import rate_limiter as rate_limiter_module
+from pricehistory.constants import RECENCY_CATEGORY_COMPLETE
+from pricehistory.crawl_worker import CrawlWorker
+from pricehistory.redis_recency_util import RedisRecencyUtil
+from pricehistory.work_queue import WorkQueue
+from tests.helpers import SlowCatalogTransport
+
+
+def make_worker(db_client, make_source_client, transport, cache, work_queue, worker_id="worker") -> CrawlWorker:
+    source_client = make_source_client(db_client, transport, recency_util=RedisRecencyUtil(cache))
+    return CrawlWorker(source_client, work_queue, source_client.logger_util, worker_id=worker_id, concurrency=2)
+
+
+def test_workers_share_the_queued_categories(make_db_client, make_source_client, cache):
+    db_client = make_db_client(write_buffer_size=1000, default_store_id=1)
+    transport = SlowCatalogTransport(num_products=400, num_categories=4)
+    work_queue = WorkQueue(cache)
+    work_queue.start_cycle([(1, category_id) for category_id in transport.categories], start_date=datetime(2024, 1, 1))
+    crawl_workers = [
+        make_worker(db_client, make_source_client, transport, cache, work_queue, worker_id)
+        for worker_id in ("first", "second")
+    ]
+
+    async def run_workers():
+        async with Client(transport=transport) as session:
+            await asyncio.gather(
+                *(crawl_worker.run_async(session, exit_when_idle=True) for crawl_worker in crawl_workers)
+            )
+
+    asyncio.run(run_workers())
+
+    assert work_queue.num_items() == 0
+    assert db_client.prices_collection.count_documents({}) == 400
+    assert db_client.prices_collection.distinct("start_date") == [datetime(2024, 1, 1)]
+    assert db_client.metrics_util.summary()["counters"]["work_items_completed"]["total"] == 4
+    recency_util = RedisRecencyUtil(cache)
+    for category_id in transport.categories:
+        assert recency_util.get_category_after_cursor(category_id) == RECENCY_CATEGORY_COMPLETE
+
+
+def test_worker_that_lost_its_lease_leaves_the_checkpoints_to_the_new_owner(make_db_client, make_source_client, cache):
+    db_client = make_db_client(write_buffer_size=100_000, default_store_id=1)
+    transport = SlowCatalogTransport(num_products=5000, num_categories=1)
+    work_queue = WorkQueue(cache, lease_seconds=0.3)
+    work_queue.start_cycle([(1, 1)])
+    crawl_worker = make_worker(db_client, make_source_client, transport, cache, work_queue)
+    lease = work_queue.lease("worker")
+
+    async def take_over():
+        await asyncio.sleep(0.2)
+        cache.hset(work_queue.owners_key, "1_1", "other")
+
+    async def process_lease():
+        async with Client(transport=transport) as session:
+            await asyncio.gather(crawl_worker._process_lease_async(session, lease), take_over())
+
+    asyncio.run(process_lease())
+    db_client.flush_writes()
+
+    assert db_client.metrics_util.summary()["counters"]["work_leases_lost"]["total"] == 1
+    assert 0 < db_client.prices_collection.count_documents({}) < 5000
+    # The pages this worker saved must not move the new owner's cursor
+    assert RedisRecencyUtil(cache).get_category_after_cursor(1) is None
+
+
+def test_worker_gives_up_on_a_category_that_keeps_failing(make_db_client, make_source_client, cache, monkeypatch):
+    monkeypatch.setattr(crawl_worker_module, "WORK_RETRY_DELAY_SECONDS", 0)
+    monkeypatch.setattr(rate_limiter_module, "BACKOFF_BASE_SECONDS", 0)
+    db_client = make_db_client(default_store_id=1)
+    transport = SlowCatalogTransport(num_products=200, num_categories=2, failing_categories=[2])
+    work_queue = WorkQueue(cache, max_attempts=2)
+    work_queue.start_cycle([(1, 1), (1, 2)])
+    crawl_worker = make_worker(db_client, make_source_client, transport, cache, work_queue)
+
+    async def run_worker():
+        async with Client(transport=transport) as session:
+            await crawl_worker.run_async(session, exit_when_idle=True)
+
+    asyncio.run(run_worker())
+
+    assert work_queue.num_items() == 0
+    assert work_queue.get_failed() == [(1, 2)]
+    counters = db_client.metrics_util.summary()["counters"]
+    assert counters["work_items_completed"]["total"] == 1
+    assert counters["work_items_failed"]["total"] == 1
@@ -0,0 +1,254 @@
+import time
+from datetime import datetime
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+from benchmarks.round_trip_counter import RoundTripCounter
+from pricehistory import db_client as db_client_module
+from pricehistory.constants import (
+    CATEGORY_LAST_SEEN_CACHE_KEY,
+    LAST_PRICE_SNAPSHOT_CACHE_KEY,
+    PRICE_LAYOUT_BUCKETS,
+    PRICE_LAYOUT_DOCUMENTS,
+)
+from pricehistory.data.category_document import CategoryDocument
+from pricehistory.data.price_document import PriceDocument
+from pricehistory.data.price_save_result import PriceSaveResult
+from pricehistory.db_client import DBClient
+from pricehistory.query_client import QueryClient
+from tests.helpers import build_page
+
+
+@pytest.mark.parametrize("price_layout", [PRICE_LAYOUT_DOCUMENTS, PRICE_LAYOUT_BUCKETS])
+def test_retried_flush_after_partial_write_does_not_duplicate_prices(make_db_client, monkeypatch, price_layout):
+    db_client = make_db_client(price_layout=price_layout, write_buffer_size=1000, default_store_id=1)
+    collection = (
+        db_client.price_buckets_collection if price_layout == PRICE_LAYOUT_BUCKETS else db_client.prices_collection
+    )
+    db_client.save_product_prices(build_page(range(10)), CategoryDocument(id=1, display_name="Fruit"))
+
+    # The server applies the writes but the connection drops before it acknowledges them
+    bulk_write = collection.bulk_write
+    failures = [AutoReconnect("connection dropped")]
+
+    def lost_acknowledgement(*args, **kwargs):
+        result = bulk_write(*args, **kwargs)
+        if failures:
+            raise failures.pop()
+        return result
+
+    monkeypatch.setattr(collection, "bulk_write", lost_acknowledgement)
+    with pytest.raises(AutoReconnect):
+        db_client.flush_writes()
+    db_client.flush_writes()
+
+    for product_id in range(10):
+        assert db_client.get_price_history(product_id, 1) == [
+            PriceDocument(product_id=product_id, price_cents=100, start_date=datetime(2024, 1, 1), store_id=1)
+        ]
+
+
+def test_flushed_writes_never_move_last_seen_back(db_client, cache):
+    last_seen_key = f"{CATEGORY_LAST_SEEN_CACHE_KEY}_1"
+    # Another worker saw product 1 after this one staged its page
+    later = time.time() + 60
+    db_client.stage_product_prices(build_page([1, 2]), CategoryDocument(id=1, display_name="Fruit"))
+    cache.zadd(last_seen_key, {1: later})
+    db_client.flush_writes()
+
+    assert cache.zscore(last_seen_key, 1) == later
+    assert cache.zscore(last_seen_key, 2) < later
+    assert cache.keys(f"{last_seen_key}_flush_*") == []
+
+
+def test_latest_prices_come_from_one_aggregation_per_batch(db_client, monkeypatch):
+    monkeypatch.setattr(db_client_module, "LATEST_PRICE_BATCH_SIZE", 2)
+    for product_id, price_cents, start_date in [
+        (1, 100, datetime(2024, 1, 1)),
+        (1, 150, datetime(2024, 1, 3)),
+        (2, 200, datetime(2024, 1, 2)),
+        (3, 300, datetime(2024, 1, 1)),
+        (3, 250, datetime(2023, 12, 1)),
+    ]:
+        db_client.prices_collection.insert_one(
+            {"product_id": product_id, "price_cents": price_cents, "start_date": start_date, "store_id": None}
+        )
+    aggregate = db_client.prices_collection.aggregate
+    aggregations = []
+
+    def counted_aggregate(*args, **kwargs):
+        aggregations.append(args)
+        return aggregate(*args, **kwargs)
+
+    monkeypatch.setattr(db_client.prices_collection, "aggregate", counted_aggregate)
+
+    assert db_client.get_latest_prices([1, 2, 2, 3, 4]) == {1: 150, 2: 200, 3: 300}
+    assert len(aggregations) == 2
+
+
+def test_prices_missing_from_the_snapshot_are_compared_with_the_database(make_db_client, cache):
+    db_client = make_db_client(default_store_id=1)
+    category_document = CategoryDocument(id=1, display_name="Fruit")
+    db_client.save_product_prices(build_page([1, 2, 3]), category_document)
+    cache.delete(LAST_PRICE_SNAPSHOT_CACHE_KEY)
+
+    page = build_page([1, 2, 3], start_date=datetime(2024, 1, 2))
+    page[0].price_document.price_cents = 90
+    price_save_result = db_client.save_product_prices(page, category_document)
+
+    assert price_save_result == PriceSaveResult(num_new=0, num_changed=1, num_unchanged=2)
+    assert db_client.metrics_util.summary()["counters"]["snapshot_misses"]["total"] == 6
+    assert [price.price_cents for price in db_client.get_price_history(1)] == [100, 90]
+    assert len(db_client.get_price_history(2)) == 1
+
+
+def test_unchanged_prices_are_answered_by_the_snapshot(make_db_client):
+    db_client = make_db_client(default_store_id=1)
+    category_document = CategoryDocument(id=1, display_name="Fruit")
+    db_client.save_product_prices(build_page(range(5)), category_document)
+    round_trip_counter = RoundTripCounter()
+    round_trip_counter.instrument(db_client)
+
+    price_save_result = db_client.save_product_prices(
+        build_page(range(5), start_date=datetime(2024, 1, 2)), category_document
+    )
+
+    assert price_save_result == PriceSaveResult(num_new=0, num_changed=0, num_unchanged=5)
+    assert round_trip_counter.mongo == 0
+
+
+def test_rebuilt_snapshot_holds_the_latest_price_at_each_store(make_db_client, cache):
+    db_client = make_db_client(default_store_id=1)
+    for product_id, price_cents, start_date, store_id in [
+        (1, 100, datetime(2024, 1, 1), None),
+        (1, 120, datetime(2024, 1, 2), 1),
+        (1, 300, datetime(2024, 1, 1), 2),
+        (2, None, datetime(2024, 1, 1), 2),
+    ]:
+        db_client.prices_collection.insert_one(
+            {"product_id": product_id, "price_cents": price_cents, "start_date": start_date, "store_id": store_id}
+        )
+    cache.hset(f"{LAST_PRICE_SNAPSHOT_CACHE_KEY}_3", mapping={1: 999})
+
+    assert db_client.rebuild_price_snapshot() == 3
+    assert db_client._get_snapshot_prices([1, 2], 1) == {1: 120}
+    assert db_client._get_snapshot_prices([1, 2], 2) == {1: 300, 2: None}
+    assert db_client._get_snapshot_prices([1], 3) == {}
+
+
+def test_bucketed_prices_are_kept_in_one_document_per_month(make_db_client):
+    db_client = make_db_client(price_layout=PRICE_LAYOUT_BUCKETS, default_store_id=1)
+    category_document = CategoryDocument(id=1, display_name="Fruit")
+    for price_cents, start_date in [
+        (100, datetime(2024, 1, 1)),
+        (120, datetime(2024, 1, 15)),
+        (90, datetime(2024, 2, 1)),
+    ]:
+        db_client.save_product_prices(
+            build_page([1], price_cents=price_cents, start_date=start_date), category_document
+        )
+
+    buckets = list(db_client.price_buckets_collection.find(sort=[("bucket_start", 1)]))
+    assert [(bucket["bucket_start"], len(bucket["prices"]), bucket["last_price_cents"]) for bucket in buckets] == [
+        (datetime(2024, 1, 1), 2, 120),
+        (datetime(2024, 2, 1), 1, 90),
+    ]
+    assert db_client.prices_collection.count_documents({}) == 0
+    assert [price.price_cents for price in db_client.get_price_history(1)] == [100, 120, 90]
+    assert db_client.get_latest_prices([1]) == {1: 90}
+
+
+def test_backfilled_buckets_hold_the_same_history(make_db_client):
+    db_client = make_db_client(default_store_id=1)
+    category_document = CategoryDocument(id=1, display_name="Fruit")
+    for price_cents, start_date in [
+        (100, datetime(2024, 1, 1)),
+        (120, datetime(2024, 1, 15)),
+        (90, datetime(2024, 2, 1)),
+    ]:
+        db_client.save_product_prices(
+            build_page([1, 2], price_cents=price_cents, start_date=start_date), category_document
+        )
+    bucket_db_client = DBClient(
+        "",
+        db_client.logger_util,
+        cache=db_client.cache,
+        mongo_client=db_client.client,
+        price_layout=PRICE_LAYOUT_BUCKETS,
+        default_store_id=1,
+    )
+
+    assert bucket_db_client.backfill_price_buckets() == 4
+    assert bucket_db_client.backfill_price_buckets() == 4
+    assert bucket_db_client.price_buckets_collection.count_documents({}) == 4
+    assert bucket_db_client.get_price_histories([1, 2]) == db_client.get_price_histories([1, 2])
+
+
+def test_unknown_price_layout_is_rejected(make_db_client):
+    with pytest.raises(ValueError):
+        make_db_client(price_layout="columns")
+
+
+def test_only_changed_products_are_written_again(make_db_client):
+    db_client = make_db_client(default_store_id=1)
+    db_client.save_product_prices(build_page([1, 2, 3]), CategoryDocument(id=1, display_name="Fruit"))
+    page = build_page([1, 2, 3], start_date=datetime(2024, 1, 2))
+    page[0].product_document.display_name = "Renamed"
+    page[1].product_document.categories = [2]
+    page[1].product_document.category = 2
+
+    db_client.save_product_prices(page[:1], CategoryDocument(id=1, display_name="Fruit"))
+    db_client.save_product_prices(page[1:], CategoryDocument(id=2, display_name="Vegetables"))
+
+    counters = db_client.metrics_util.summary()["counters"]
+    assert counters["products_changed"] == {"1": 4, "2": 1}
+    assert counters["products_unchanged"] == {"1": 0, "2": 1}
+    products = {document["id"]: document for document in db_client.products_collection.find()}
+    assert products[1]["display_name"] == "Renamed"
+    assert products[2]["categories"] == [1, 2]
+    assert products[3]["categories"] == [1]
+
+
+def test_product_writes_that_failed_are_sent_again_by_the_next_crawl(make_db_client, monkeypatch):
+    db_client = make_db_client(default_store_id=1)
+    category_document = CategoryDocument(id=1, display_name="Fruit")
+
+    def failing_bulk_write(*args, **kwargs):
+        raise AutoReconnect("connection dropped")
+
+    monkeypatch.setattr(db_client.products_collection, "bulk_write", failing_bulk_write)
+    with pytest.raises(AutoReconnect):
+        db_client.save_product_prices(build_page([1]), category_document)
+    monkeypatch.undo()
+
+    # The fingerprints are only stored once the writes are in, so the next crawl does not take them as unchanged
+    next_db_client = DBClient(
+        "", db_client.logger_util, cache=db_client.cache, mongo_client=db_client.client, default_store_id=1
+    )
+    next_db_client.save_product_prices(build_page([1]), category_document)
+
+    assert next_db_client.products_collection.count_documents({"id": 1}) == 1
+    assert next_db_client.metrics_util.summary()["counters"]["products_changed"] == {"1": 1}
+
+
+def test_products_no_longer_listed_are_pruned_from_the_category(make_db_client, cache):
+    db_client = make_db_client(default_store_id=1)
+    page = build_page([1, 2])
+    page[0].product_document.categories = [1, 2]
+    db_client.save_product_prices(page, CategoryDocument(id=1, display_name="Fruit"))
+    db_client.save_product_prices(build_page([1], category_id=2), CategoryDocument(id=2, display_name="Produce"))
+    db_client.flush_writes()
+    query_client = QueryClient(db_client)
+    assert [product.id for product in query_client.get_category_products(1)] == [1, 2]
+
+    # Product 1 was last listed in the first category long ago
+    cache.zadd(f"{CATEGORY_LAST_SEEN_CACHE_KEY}_1", {1: 0})
+    assert db_client.prune_category_products([1, 2], expiry_days=1) == 1
+
+    product = db_client.products_collection.find_one({"id": 1})
+    assert (product["category"], product["categories"]) == (2, [2])
+    assert [product.id for product in query_client.get_category_products(1)] == [2]
+    assert [product.id for product in query_client.get_category_products(2)] == [1]
+    assert db_client.search_index.search("product 1")[0].category == 2
+    assert db_client.prune_category_products([1, 2], expiry_days=1) == 0
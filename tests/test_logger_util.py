@@ -0,0 +1,51 @@
+import logging
+import time
+
+from pricehistory.logger_util import LoggerUtil
+
+
+def read_log(working_dir) -> str:
+    return (working_dir / "logs" / "latest.txt").read_text(encoding="utf-8")
+
+
+def test_messages_below_the_level_are_dropped(capsys):
+    logger_util = LoggerUtil(level=logging.WARNING)
+
+    logger_util.debug("debug")
+    logger_util.info("info")
+    logger_util.warning("warning")
+    logger_util.error("error")
+
+    assert capsys.readouterr().out == "warning\nerror\n"
+
+
+def test_buffered_messages_are_written_when_the_logger_closes(working_dir, capsys):
+    with LoggerUtil(flush_interval_seconds=60) as logger_util:
+        for i in range(3):
+            logger_util.write(f"message {i}")
+        assert read_log(working_dir) == ""
+
+    assert read_log(working_dir) == "message 0\nmessage 1\nmessage 2\n"
+    assert capsys.readouterr().out == "message 0\nmessage 1\nmessage 2\n"
+    dated_logs = [path for path in (working_dir / "logs").iterdir() if path.name != "latest.txt"]
+    assert [path.read_text(encoding="utf-8") for path in dated_logs] == [read_log(working_dir)]
+
+
+def test_batch_is_written_once_enough_bytes_are_buffered(working_dir):
+    with LoggerUtil(flush_size_bytes=20, flush_interval_seconds=60) as logger_util:
+        logger_util.write("short")
+        logger_util.write("a" * 30)
+        deadline = time.monotonic() + 5
+        while not read_log(working_dir) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert read_log(working_dir) == "short\n" + "a" * 30 + "\n"
+
+
+def test_responses_are_only_dumped_when_turned_on(capsys):
+    logger_util = LoggerUtil()
+    logger_util.dump_response("page 1", {"records": []})
+    logger_util.configure(dump_responses=True)
+    logger_util.dump_response("page 2", {"records": []})
+
+    assert capsys.readouterr().out == 'Response for page 2: {"records": []}\n'
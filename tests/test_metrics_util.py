@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from pricehistory.metrics_util import MetricsUtil
+
+
+def test_summary_breaks_metrics_down_by_category(working_dir):
+    metrics_util = MetricsUtil()
+    metrics_util.increment("pages_fetched", category=1)
+    metrics_util.increment("pages_fetched", 2, category=2)
+    metrics_util.increment("fetch_failures")
+    for seconds in (0.004, 0.02, 0.02, 3.0):
+        metrics_util.observe("fetch", seconds, category=1)
+
+    metrics_util.write_summary(str(working_dir / "metrics.json"))
+    with open(working_dir / "metrics.json", encoding="utf-8") as summary_file:
+        summary = json.load(summary_file)
+
+    assert summary["counters"] == {"fetch_failures": {"total": 1}, "pages_fetched": {"1": 1, "2": 2}}
+    fetch = summary["stages"]["fetch"]["1"]
+    assert fetch["count"] == 4
+    assert fetch["total_seconds"] == pytest.approx(3.044)
+    assert fetch["min_seconds"] == 0.004
+    assert fetch["max_seconds"] == 3.0
+    assert fetch["p50_seconds"] == 0.025
+    assert fetch["p95_seconds"] == 3.0
+
+
+def test_timer_observes_even_when_the_stage_fails():
+    metrics_util = MetricsUtil()
+
+    with pytest.raises(RuntimeError):
+        with metrics_util.timer("save", category=1):
+            raise RuntimeError("failed")
+
+    assert metrics_util.summary()["stages"]["save"]["1"]["count"] == 1
+
+
+def test_reset_drops_everything_collected():
+    metrics_util = MetricsUtil()
+    metrics_util.increment("pages_fetched")
+    metrics_util.observe("fetch", 0.1)
+
+    metrics_util.reset()
+
+    summary = metrics_util.summary()
+    assert summary["counters"] == {}
+    assert summary["stages"] == {}
+
+
+def test_prometheus_output_has_cumulative_buckets(working_dir):
+    metrics_util = MetricsUtil()
+    metrics_util.increment("pages_fetched", 3, category=1)
+    metrics_util.observe("fetch", 0.02)
+    metrics_util.observe("fetch", 0.2)
+
+    metrics_util.write_prometheus(str(working_dir / "metrics.prom"))
+    lines = (working_dir / "metrics.prom").read_text(encoding="utf-8").splitlines()
+
+    assert "# TYPE pricehistory_pages_fetched_total counter" in lines
+    assert 'pricehistory_pages_fetched_total{category="1"} 3' in lines
+    assert 'pricehistory_stage_seconds_bucket{stage="fetch",le="0.01"} 0' in lines
+    assert 'pricehistory_stage_seconds_bucket{stage="fetch",le="0.025"} 1' in lines
+    assert 'pricehistory_stage_seconds_bucket{stage="fetch",le="0.25"} 2' in lines
+    assert 'pricehistory_stage_seconds_bucket{stage="fetch",le="+Inf"} 2' in lines
+    assert 'pricehistory_stage_seconds_count{stage="fetch"} 2' in lines
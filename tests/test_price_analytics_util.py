@@ -0,0 +1,65 @@
+from datetime import datetime
+
+import numpy as np
+
+from pricehistory.constants import MISSING_PRICE_CENTS
+from pricehistory.data.price_columns import PriceColumns
+from pricehistory.price_analytics_util import compute_price_stats
+
+
+def make_columns(rows):
+    product_ids, store_ids, prices_cents, start_dates = zip(*rows)
+    return PriceColumns(
+        product_id=np.array(product_ids, dtype=np.int64),
+        store_id=np.array(store_ids, dtype=np.int64),
+        price_cents=np.array(prices_cents, dtype=np.int64),
+        start_date=np.array(start_dates, dtype="datetime64[ms]"),
+    )
+
+
+COLUMNS = make_columns(
+    [
+        (2, 1, 300, datetime(2024, 1, 1)),
+        (1, 1, 250, datetime(2024, 1, 3)),
+        (1, 1, 100, datetime(2024, 1, 1)),
+        (1, 1, 200, datetime(2024, 1, 2)),
+        (1, 2, MISSING_PRICE_CENTS, datetime(2024, 1, 1)),
+        (1, 2, 150, datetime(2024, 1, 2)),
+        (1, 2, 120, datetime(2024, 1, 3)),
+    ]
+)
+
+
+def test_stats_for_every_product_and_store():
+    stats = compute_price_stats(COLUMNS)
+
+    assert stats["product_id"].tolist() == [1, 1, 2]
+    assert stats["store_id"].tolist() == [1, 2, 1]
+    assert stats["min_price_cents"].tolist() == [100, 120, 300]
+    assert stats["max_price_cents"].tolist() == [250, 150, 300]
+    assert stats["mean_price_cents"].tolist() == [550 / 3, 135, 300]
+    assert stats["num_changes"].tolist() == [2, 2, 0]
+    # The drop from a missing price to a known one does not count
+    assert stats["largest_drop_cents"].tolist() == [0, 30, 0]
+
+
+def test_window_starts_with_the_price_in_effect():
+    stats = compute_price_stats(COLUMNS, window_start=datetime(2024, 1, 2, 12), window_end=datetime(2024, 1, 3))
+
+    assert stats["product_id"].tolist() == [1, 1, 2]
+    assert stats["min_price_cents"].tolist() == [200, 150, 300]
+    assert stats["num_changes"].tolist() == [0, 0, 0]
+
+
+def test_product_without_an_online_price():
+    stats = compute_price_stats(make_columns([(1, 1, MISSING_PRICE_CENTS, datetime(2024, 1, 1))]))
+
+    assert stats["min_price_cents"].tolist() == [MISSING_PRICE_CENTS]
+    assert stats["max_price_cents"].tolist() == [MISSING_PRICE_CENTS]
+    assert np.isnan(stats["mean_price_cents"][0])
+
+
+def test_empty_window():
+    stats = compute_price_stats(COLUMNS, window_end=datetime(2023, 1, 1))
+
+    assert all(len(column) == 0 for column in stats.values())
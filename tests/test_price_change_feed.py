@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+
+from pricehistory.data.category_document import CategoryDocument
+from pricehistory.data.price_change_event import PriceChangeEvent
+from pricehistory.data.price_document import PriceDocument
+from pricehistory.price_change_feed import PriceChangeFeed, get_change_percent
+from pricehistory.query_client import QueryClient
+from tests.helpers import build_page
+
+
+def make_event(product_id, old_price_cents, new_price_cents, time, store_id=1):
+    return PriceChangeEvent(
+        product_id=product_id,
+        store_id=store_id,
+        old_price_cents=old_price_cents,
+        new_price_cents=new_price_cents,
+        change_percent=get_change_percent(old_price_cents, new_price_cents),
+        time=time,
+    )
+
+
+def test_change_percent():
+    assert get_change_percent(200, 150) == -25.0
+    assert get_change_percent(300, 400) == 33.33
+    assert get_change_percent(None, 150) is None
+    assert get_change_percent(0, 150) is None
+
+
+def test_events_are_read_in_order(cache):
+    price_change_feed = PriceChangeFeed(cache)
+    time = datetime(2024, 1, 1)
+    events = [make_event(1, 200, 150, time), make_event(2, None, 300, time, store_id=None)]
+    price_change_feed.record(events, [])
+    price_change_feed.record([make_event(1, 150, 180, time + timedelta(days=1))], [])
+
+    assert price_change_feed.get_recent_events(2) == [make_event(1, 150, 180, time + timedelta(days=1)), events[1]]
+    first_read = price_change_feed.read_events(count=2)
+    assert [event for _, event in first_read] == events
+    assert [event for _, event in price_change_feed.read_events(first_read[-1][0])] == [
+        make_event(1, 150, 180, time + timedelta(days=1))
+    ]
+
+
+def test_stats_keep_the_all_time_and_window_lows(cache):
+    price_change_feed = PriceChangeFeed(cache, window_days=30)
+    now = datetime.now()
+    price_change_feed.record(
+        [], [PriceDocument(product_id=1, price_cents=100, start_date=now - timedelta(days=60), store_id=1)]
+    )
+    price_change_feed.record(
+        [
+            make_event(1, 100, 300, now - timedelta(days=40)),
+            make_event(1, 300, 250, now - timedelta(days=10)),
+            make_event(1, 250, None, now - timedelta(days=5)),
+            make_event(1, None, 280, now - timedelta(days=1)),
+            # Statistics of a product seen for the first time with a change start from its old price
+            make_event(2, 500, 450, now - timedelta(days=1)),
+        ],
+        [],
+    )
+
+    stats = price_change_feed.get_stats([1, 2, 3], 1)
+
+    assert set(stats) == {1, 2}
+    assert stats[1].price_cents == 280
+    assert stats[1].all_time_low_cents == 100
+    assert stats[1].all_time_low_date == now - timedelta(days=60)
+    # 100 had ended before the window opened
+    assert stats[1].window_low_cents == 250
+    assert stats[2].all_time_low_cents == 450
+    assert stats[2].window_low_cents == 450
+    assert price_change_feed.get_stats([1], 2) == {}
+
+
+def test_saved_price_changes_reach_the_feed(make_db_client):
+    db_client = make_db_client(default_store_id=1)
+    category_document = CategoryDocument(id=1, display_name="Fruit")
+    db_client.save_product_prices(build_page([1, 2], price_cents=200), category_document)
+    db_client.save_product_prices(
+        build_page([1], price_cents=150, start_date=datetime(2024, 1, 2)) + build_page([2], price_cents=200),
+        category_document,
+    )
+    db_client.flush_writes()
+    query_client = QueryClient(db_client)
+
+    assert query_client.get_recent_price_changes() == [make_event(1, 200, 150, datetime(2024, 1, 2))]
+    stats = query_client.get_price_stats([1, 2])
+    assert stats[1].price_cents == 150
+    assert stats[1].all_time_low_cents == 150
+    assert stats[2].price_cents == 200
@@ -0,0 +1,54 @@
+from datetime import datetime
+
+import pytest
+
+from pricehistory.constants import PRICE_LAYOUT_BUCKETS, PRICE_LAYOUT_DOCUMENTS
+from pricehistory.data.category_document import CategoryDocument
+from pricehistory.price_export_util import PriceExporter, load_prices, load_products
+from tests.helpers import build_page
+
+
+def sorted_rows(columns):
+    return sorted(
+        zip(
+            columns.product_id.tolist(),
+            columns.store_id.tolist(),
+            columns.price_cents.tolist(),
+            columns.start_date.astype(datetime).tolist(),
+        )
+    )
+
+
+@pytest.mark.parametrize("price_layout", [PRICE_LAYOUT_DOCUMENTS, PRICE_LAYOUT_BUCKETS])
+def test_export_only_adds_new_prices(make_db_client, logger_util, working_dir, price_layout):
+    db_client = make_db_client(price_layout=price_layout, default_store_id=1)
+    category = CategoryDocument(id=1, display_name="Fruit")
+    export_dir = str(working_dir / "export")
+    exporter = PriceExporter(db_client, export_dir, logger_util, part_rows=3)
+
+    db_client.save_product_prices(build_page(range(5), start_date=datetime(2024, 1, 1)), category)
+    db_client.flush_writes()
+    assert exporter.export() == 5
+
+    # More prices of the same crawl arrive after the export, then a new crawl changes some prices
+    db_client.save_product_prices(build_page(range(5, 7), start_date=datetime(2024, 1, 1)), category)
+    db_client.save_product_prices(build_page(range(2), price_cents=90, start_date=datetime(2024, 1, 2)), category)
+    db_client.flush_writes()
+    assert exporter.export() == 4
+    assert exporter.export() == 0
+
+    assert sorted_rows(load_prices(export_dir)) == sorted(
+        [(product_id, 1, 100, datetime(2024, 1, 1)) for product_id in range(7)]
+        + [(product_id, 1, 90, datetime(2024, 1, 2)) for product_id in range(2)]
+    )
+    products = load_products(export_dir)
+    assert products["id"].tolist() == list(range(7))
+    assert products["display_name"][0] == "Product 0"
+
+
+def test_export_of_an_empty_database(db_client, logger_util, working_dir):
+    export_dir = str(working_dir / "export")
+
+    assert PriceExporter(db_client, export_dir, logger_util).export() == 0
+    assert len(load_prices(export_dir)) == 0
+    assert len(load_products(export_dir)["id"]) == 0
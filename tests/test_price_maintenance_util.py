@@ -0,0 +1,137 @@
+import os
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+
+from pricehistory import price_maintenance_util as price_maintenance_util_module
+from pricehistory.constants import MAINTENANCE_STATE_FILE_NAME, PRICE_LAYOUT_BUCKETS
+from pricehistory.data.price_maintenance_report import PriceMaintenanceReport
+from pricehistory.price_maintenance_util import PriceCompactor
+
+
+def insert_prices(db_client, product_id, prices_cents, store_id=1):
+    db_client.prices_collection.insert_many(
+        [
+            {
+                "product_id": product_id,
+                "store_id": store_id,
+                "price_cents": price_cents,
+                "start_date": datetime(2024, 1, day),
+            }
+            for day, price_cents in enumerate(prices_cents, start=1)
+        ]
+    )
+
+
+def get_prices(db_client, product_id, store_id=1):
+    prices = db_client.prices_collection.find(
+        filter={"product_id": product_id, "store_id": store_id}, sort=[("start_date", 1)]
+    )
+    return [price["price_cents"] for price in prices]
+
+
+@pytest.fixture
+def db_client(make_db_client):
+    return make_db_client(default_store_id=1)
+
+
+def test_compactor_keeps_the_later_of_two_saves_on_the_same_date(db_client, logger_util):
+    earlier_id, later_id = ObjectId(), ObjectId()
+    # The later save is stored first, so only its id tells the two apart
+    for document_id, price_cents in [(later_id, 250), (earlier_id, 200)]:
+        db_client.prices_collection.insert_one(
+            {
+                "_id": document_id,
+                "product_id": 1,
+                "store_id": 1,
+                "price_cents": price_cents,
+                "start_date": datetime(2024, 1, 2),
+            }
+        )
+    db_client.prices_collection.insert_one(
+        {"product_id": 1, "store_id": 1, "price_cents": 100, "start_date": datetime(2024, 1, 1)}
+    )
+
+    report = PriceCompactor(db_client, logger_util, pause_seconds=0).run(dry_run=False)
+
+    assert report.duplicate_dates == 1
+    assert report.documents_deleted == 1
+    prices = db_client.prices_collection.find(filter={"product_id": 1}, sort=[("start_date", 1)])
+    assert [price["price_cents"] for price in prices] == [100, 250]
+    assert db_client.prices_collection.find_one({"_id": earlier_id}) is None
+
+
+def test_dry_run_only_reports(db_client, logger_util):
+    insert_prices(db_client, 1, [100, 100, None, None, 0, 0, 120])
+    insert_prices(db_client, 2, [200], store_id=None)
+
+    report = PriceCompactor(db_client, logger_util, pause_seconds=0).run()
+
+    assert report == PriceMaintenanceReport(
+        documents_scanned=8,
+        products_scanned=2,
+        redundant_prices=3,
+        missing_prices=2,
+        non_positive_prices=2,
+        missing_store_ids=1,
+        reclaimable_bytes=report.reclaimable_bytes,
+    )
+    assert report.reclaimable_bytes > 0
+    assert db_client.prices_collection.count_documents({}) == 8
+    assert not os.path.exists(MAINTENANCE_STATE_FILE_NAME)
+
+
+def test_redundant_prices_are_collapsed(db_client, logger_util):
+    insert_prices(db_client, 1, [100, 100, None, None, 120, 120])
+    insert_prices(db_client, 1, [300, 300], store_id=2)
+
+    report = PriceCompactor(db_client, logger_util, pause_seconds=0).run(dry_run=False)
+
+    assert report.documents_deleted == 4
+    assert get_prices(db_client, 1) == [100, None, 120]
+    assert get_prices(db_client, 1, store_id=2) == [300]
+
+
+def test_dropping_missing_prices_updates_the_latest_price(db_client, logger_util):
+    insert_prices(db_client, 1, [100, None, 100, None])
+    db_client.update_snapshot_prices({1: None}, 1)
+
+    report = PriceCompactor(db_client, logger_util, drop_missing_prices=True, pause_seconds=0).run(dry_run=False)
+
+    assert report.missing_prices == 2
+    assert report.redundant_prices == 1
+    assert get_prices(db_client, 1) == [100]
+    assert db_client._get_snapshot_prices([1], 1) == {1: 100}
+
+
+def test_interrupted_run_resumes_after_the_last_batch(db_client, logger_util, monkeypatch):
+    for product_id in range(1, 6):
+        insert_prices(db_client, product_id, [100, 100])
+    compactor = PriceCompactor(db_client, logger_util, batch_documents=4, pause_seconds=0)
+
+    interruptions = [KeyboardInterrupt()]
+
+    def interrupt_once(seconds):
+        if interruptions:
+            raise interruptions.pop()
+
+    monkeypatch.setattr(price_maintenance_util_module.time, "sleep", interrupt_once)
+    with pytest.raises(KeyboardInterrupt):
+        compactor.run(dry_run=False)
+    assert db_client.prices_collection.count_documents({}) == 8
+
+    report = compactor.run(dry_run=False)
+
+    assert report.products_scanned == 5
+    assert report.documents_scanned == 10
+    assert report.documents_deleted == 5
+    assert db_client.prices_collection.count_documents({}) == 5
+    assert not os.path.exists(MAINTENANCE_STATE_FILE_NAME)
+
+
+def test_bucketed_prices_are_not_supported(make_db_client, logger_util):
+    db_client = make_db_client(price_layout=PRICE_LAYOUT_BUCKETS)
+
+    with pytest.raises(ValueError):
+        PriceCompactor(db_client, logger_util).run()
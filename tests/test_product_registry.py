@@ -0,0 +1,26 @@
+from pricehistory.product_registry import ProductRegistry
+
+
+def test_categories_and_stores_are_remembered_per_product():
+    product_registry = ProductRegistry()
+
+    assert product_registry.add(1, category_id=30, store_id=1)
+    assert not product_registry.add(1, category_id=10, store_id=1)
+    assert product_registry.add(1, category_id=20, store_id=2)
+    assert product_registry.add(2, category_id=20, store_id=2)
+
+    assert len(product_registry) == 2
+    assert product_registry.get_categories(1) == [10, 20, 30]
+    assert product_registry.get_categories(2) == [20]
+    assert product_registry.get_categories(3) == []
+    assert product_registry.has_store(1, 2)
+    assert not product_registry.has_store(2, 1)
+    assert not product_registry.has_store(1, 3)
+
+
+def test_many_categories_fit_in_one_product():
+    product_registry = ProductRegistry()
+    for category_id in range(200, 0, -1):
+        product_registry.add(1, category_id, store_id=1)
+
+    assert product_registry.get_categories(1) == list(range(1, 201))
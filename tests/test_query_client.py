@@ -0,0 +1,70 @@
+import threading
+from datetime import datetime
+
+import pytest
+
+from benchmarks.round_trip_counter import RoundTripCounter
+from pricehistory.constants import CACHE_LOCK_PREFIX, CATEGORY_NAME_CACHE_KEY
+from pricehistory.data.category_document import CategoryDocument
+from pricehistory.query_client import QueryClient
+from tests.helpers import build_page
+
+
+@pytest.fixture
+def db_client(make_db_client):
+    return make_db_client(default_store_id=1)
+
+
+def test_cached_price_histories_are_dropped_when_prices_change(db_client):
+    category_document = CategoryDocument(id=1, display_name="Fruit")
+    db_client.save_product_prices(build_page([1, 2]), category_document)
+    query_client = QueryClient(db_client)
+    assert [price.price_cents for price in query_client.get_price_history(1)] == [100]
+    round_trip_counter = RoundTripCounter()
+    round_trip_counter.instrument(db_client)
+
+    assert [price.price_cents for price in query_client.get_price_history(1)] == [100]
+    assert round_trip_counter.mongo == 0
+
+    db_client.save_product_prices(build_page([1], price_cents=80, start_date=datetime(2024, 1, 2)), category_document)
+    assert query_client.get_price_histories([1, 2, 3]) == {
+        1: db_client.get_price_history(1),
+        2: db_client.get_price_history(2),
+        3: [],
+    }
+    assert [price.price_cents for price in query_client.get_price_history(1)] == [100, 80]
+
+
+def test_category_listings_and_names_follow_writes(db_client):
+    query_client = QueryClient(db_client)
+    assert query_client.get_category_products(1) == []
+    assert query_client.get_categories() == []
+
+    db_client.save_product_prices(build_page([2, 1]), CategoryDocument(id=1, display_name="Fruit"))
+
+    assert [product.id for product in query_client.get_category_products(1)] == [1, 2]
+    assert query_client.get_categories() == [CategoryDocument(id=1, display_name="Fruit")]
+    assert query_client.get_category_name(1) == "Fruit"
+    assert query_client.get_display_names([1, 3]) == {1: "Product 1", 3: None}
+
+
+def test_readers_wait_for_the_reader_already_loading_an_entry(db_client, cache):
+    db_client.save_product_prices(build_page([1]), CategoryDocument(id=1, display_name="Fruit"))
+    key = f"{CATEGORY_NAME_CACHE_KEY}_1"
+    # Another reader holds the lock and fills the cache a moment later
+    cache.set(f"{CACHE_LOCK_PREFIX}{key}", 1)
+    timer = threading.Timer(0.1, lambda: cache.set(key, '"Loaded elsewhere"'))
+    timer.start()
+
+    try:
+        assert QueryClient(db_client).get_category_name(1) == "Loaded elsewhere"
+    finally:
+        timer.cancel()
+
+
+def test_readers_load_the_entry_themselves_once_the_lock_times_out(db_client, cache):
+    db_client.save_product_prices(build_page([1]), CategoryDocument(id=1, display_name="Fruit"))
+    key = f"{CATEGORY_NAME_CACHE_KEY}_1"
+    cache.set(f"{CACHE_LOCK_PREFIX}{key}", 1)
+
+    assert QueryClient(db_client, lock_timeout_seconds=0.1).get_category_name(1) == "Fruit"
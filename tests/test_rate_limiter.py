@@ -0,0 +1,67 @@
+import pytest
+
+from pricehistory.constants import BACKOFF_BASE_SECONDS, BACKOFF_MAX_SECONDS
+from pricehistory.rate_limiter import RateLimiter
+
+
+def test_requests_without_a_budget_are_never_delayed():
+    rate_limiter = RateLimiter(requests_per_minute=None, jitter_seconds=0)
+
+    assert [rate_limiter._reserve() for _ in range(5)] == [0, 0, 0, 0, 0]
+
+
+def test_concurrent_requests_reserve_consecutive_slots():
+    rate_limiter = RateLimiter(requests_per_minute=60, jitter_seconds=0, burst=2)
+
+    wait_seconds = [rate_limiter._reserve() for _ in range(4)]
+
+    assert wait_seconds[:2] == [0, 0]
+    assert wait_seconds[2:] == [pytest.approx(1, abs=0.01), pytest.approx(2, abs=0.01)]
+
+
+def test_throttling_halves_the_rate_down_to_the_minimum():
+    rate_limiter = RateLimiter(requests_per_minute=60, jitter_seconds=0)
+
+    rate_limiter.record_failure(429)
+    assert rate_limiter.requests_per_minute == pytest.approx(30)
+    rate_limiter.record_failure(500)
+    assert rate_limiter.requests_per_minute == pytest.approx(30)
+    for _ in range(10):
+        rate_limiter.record_failure(403)
+    assert rate_limiter.requests_per_minute == pytest.approx(6)
+
+
+def test_backoff_doubles_with_each_failure_until_a_success():
+    rate_limiter = RateLimiter(requests_per_minute=None, jitter_seconds=0)
+
+    for num_failures in range(1, 10):
+        backoff_seconds = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (num_failures - 1))
+        assert backoff_seconds / 2 <= rate_limiter.record_failure() <= backoff_seconds
+
+    rate_limiter.record_success(0.1)
+    assert rate_limiter.record_failure() <= BACKOFF_BASE_SECONDS
+
+
+def test_rate_slows_down_with_latency_and_recovers_once_healthy():
+    rate_limiter = RateLimiter(requests_per_minute=60, jitter_seconds=0)
+    rate_limiter.record_success(0.1)
+
+    for _ in range(5):
+        rate_limiter.record_success(2.0)
+    assert rate_limiter.requests_per_minute < 60
+
+    for _ in range(100):
+        rate_limiter.record_success(0.1)
+    assert rate_limiter.requests_per_minute == pytest.approx(60)
+
+
+def test_changing_the_budget_keeps_the_rate_within_it():
+    rate_limiter = RateLimiter(requests_per_minute=60, jitter_seconds=0)
+    rate_limiter.record_failure(429)
+
+    rate_limiter.set_requests_per_minute(20)
+    assert rate_limiter.requests_per_minute == pytest.approx(20)
+    rate_limiter.set_requests_per_minute(600)
+    assert rate_limiter.requests_per_minute == pytest.approx(60)
+    rate_limiter.set_requests_per_minute(None)
+    assert rate_limiter.requests_per_minute is None
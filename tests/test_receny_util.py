@@ -0,0 +1,84 @@
+import pickle
+from datetime import datetime, timedelta
+
+from pricehistory import receny_util as receny_util_module
+from pricehistory.receny_util import RecencyUtil
+
+
+def make_recency_util(working_dir) -> RecencyUtil:
+    return RecencyUtil(
+        recency_file_path=str(working_dir / "recency.journal"),
+        legacy_recency_file_path=str(working_dir / "recency.pickle"),
+    )
+
+
+def test_checkpoints_are_loaded_back_from_the_journal(working_dir):
+    recency_util = make_recency_util(working_dir)
+    recency_util.record_category_page_success(1, "100")
+    recency_util.record_category_page_success(1, "200")
+    recency_util.record_category_page_success(1, "50", store_id=2)
+
+    reloaded_recency_util = make_recency_util(working_dir)
+
+    assert reloaded_recency_util.get_category_after_cursor(1) == "200"
+    assert reloaded_recency_util.get_category_after_cursor(1, store_id=2) == "50"
+    assert reloaded_recency_util.get_category_after_cursor(2) is None
+
+
+def test_partial_last_line_is_skipped(working_dir):
+    recency_util = make_recency_util(working_dir)
+    recency_util.record_category_page_success(1, "100")
+    with open(working_dir / "recency.journal", mode="a", encoding="utf-8") as journal_file:
+        journal_file.write('{"category": "1", "time"')
+
+    assert make_recency_util(working_dir).get_category_after_cursor(1) == "100"
+
+
+def test_journal_is_compacted_to_the_latest_checkpoint_of_each_category(working_dir, monkeypatch):
+    monkeypatch.setattr(receny_util_module, "RECENCY_COMPACTION_MIN_ENTRIES", 10)
+    recency_util = make_recency_util(working_dir)
+    for page in range(25):
+        recency_util.record_category_page_success(page % 2, str(page))
+
+    with open(working_dir / "recency.journal", encoding="utf-8") as journal_file:
+        assert len(journal_file.readlines()) <= 10
+    reloaded_recency_util = make_recency_util(working_dir)
+    assert reloaded_recency_util.get_category_after_cursor(0) == "24"
+    assert reloaded_recency_util.get_category_after_cursor(1) == "23"
+
+
+def test_compaction_keeps_what_other_processes_appended(working_dir, monkeypatch):
+    monkeypatch.setattr(receny_util_module, "RECENCY_COMPACTION_MIN_ENTRIES", 5)
+    recency_util = make_recency_util(working_dir)
+    other_recency_util = make_recency_util(working_dir)
+    other_recency_util.record_category_page_success(2, "100")
+
+    for page in range(10):
+        recency_util.record_category_page_success(1, str(page))
+
+    reloaded_recency_util = make_recency_util(working_dir)
+    assert reloaded_recency_util.get_category_after_cursor(1) == "9"
+    assert reloaded_recency_util.get_category_after_cursor(2) == "100"
+
+
+def test_legacy_pickle_is_migrated_to_the_journal(working_dir):
+    with open(working_dir / "recency.pickle", mode="wb") as recency_file:
+        pickle.dump({"1": (datetime.now(), "100")}, recency_file)
+
+    recency_util = make_recency_util(working_dir)
+
+    assert recency_util.get_category_after_cursor(1) == "100"
+    assert not (working_dir / "recency.pickle").exists()
+    assert make_recency_util(working_dir).get_category_after_cursor(1) == "100"
+
+
+def test_old_checkpoints_are_cleaned(working_dir):
+    with open(working_dir / "recency.pickle", mode="wb") as recency_file:
+        pickle.dump({"1": (datetime.now() - timedelta(hours=13), "100"), "2": (datetime.now(), "200")}, recency_file)
+    recency_util = make_recency_util(working_dir)
+
+    recency_util.clean_records(age_in_hours_to_clean=12)
+
+    assert recency_util.get_category_after_cursor(1) is None
+    assert recency_util.get_category_after_cursor(2) == "200"
+    assert make_recency_util(working_dir).get_category_after_cursor(1) is None
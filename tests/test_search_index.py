@@ -0,0 +1,74 @@
+from pricehistory.data.category_document import CategoryDocument
+from pricehistory.data.product_document import ProductDocument
+from pricehistory.query_client import QueryClient
+from pricehistory.search_index import SearchIndex, fold_text, get_trigrams
+from tests.helpers import build_page
+
+PRODUCTS = [
+    ProductDocument(id=1, display_name="Jalapeño-Lime Tortilla Chips", category=1),
+    ProductDocument(id=2, display_name="Lime", category=2),
+    ProductDocument(id=3, display_name="Limeade Concentrate", category=3),
+    ProductDocument(id=4, display_name="Whole Milk", category=4),
+]
+
+
+def search_ids(search_index, search_text):
+    return [product_document.id for product_document in search_index.search(search_text)]
+
+
+def test_fold_text():
+    assert fold_text("  Jalapeño-Lime  CHIPS! ") == "jalapeno lime chips"
+    assert get_trigrams("Ab") == {"  a", " ab", "ab "}
+    assert get_trigrams("Ab", partial_last_word=True) == {"  a", " ab"}
+
+
+def test_search_matches_prefixes_and_tolerates_typos(cache):
+    search_index = SearchIndex(cache)
+    assert search_index.update(PRODUCTS) == 4
+
+    assert search_ids(search_index, "jalapeno") == [1]
+    # Whole words rank first, then names that start with the search text, then shorter names
+    assert search_ids(search_index, "lime") == [2, 3, 1]
+    assert search_ids(search_index, "lim") == [2, 3, 1]
+    assert search_ids(search_index, "tortila chips") == [1]
+    assert search_ids(search_index, "milk") == [4]
+    assert search_ids(search_index, "!!") == []
+
+
+def test_update_only_reindexes_changed_products(cache):
+    search_index = SearchIndex(cache)
+    search_index.update(PRODUCTS)
+    generation = search_index.get_generation()
+
+    assert search_index.update(PRODUCTS) == 0
+    assert search_index.get_generation() == generation
+
+    assert search_index.update([ProductDocument(id=4, display_name="Oat Milk", category=5)]) == 1
+    assert search_index.get_generation() > generation
+    assert search_ids(search_index, "whole") == []
+    assert search_index.search("oat") == [ProductDocument(id=4, display_name="Oat Milk", category=5)]
+
+
+def test_rebuild_from_the_database(db_client, cache):
+    db_client.save_product_prices(build_page([1, 2]), CategoryDocument(id=1, display_name="Fruit"))
+    db_client.flush_writes()
+    cache.flushall()
+    search_index = SearchIndex(cache)
+    assert search_ids(search_index, "product") == []
+
+    assert search_index.rebuild(db_client.products_collection) == 2
+    assert sorted(search_ids(search_index, "product")) == [1, 2]
+
+
+def test_cached_search_results_follow_new_products(db_client):
+    query_client = QueryClient(db_client)
+    db_client.save_product_prices(build_page([1]), CategoryDocument(id=1, display_name="Fruit"))
+    db_client.flush_writes()
+    assert query_client.search_product_ids("product") == [1]
+
+    db_client.save_product_prices(build_page([2]), CategoryDocument(id=1, display_name="Fruit"))
+    db_client.flush_writes()
+
+    assert query_client.search_product_ids("product") == [1, 2]
+    assert [product.id for product in query_client.search_products("prod")] == [1, 2]
+    assert query_client.search_products("   ") == []
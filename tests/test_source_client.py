@@ -0,0 +1,199 @@
+import asyncio
+import time
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+from benchmarks.synthetic_catalog import SyntheticCatalogTransport
+from pricehistory import rate_limiter as rate_limiter_module
+from pricehistory import source_client as source_client_module
+from pricehistory.constants import (
+    PIPELINE_QUEUE_SIZE,
+    QUERY_PROFILE_FULL,
+    QUERY_PROFILE_PRICES,
+    RECENCY_CATEGORY_COMPLETE,
+)
+from pricehistory.receny_util import RecencyUtil
+from tests.helpers import SlowCatalogTransport
+
+
+def test_save_retry_after_failed_flush_only_flushes_again(make_db_client, make_source_client, monkeypatch):
+    monkeypatch.setattr(source_client_module, "BACKOFF_BASE_SECONDS", 0)
+    db_client = make_db_client()
+    source_client = make_source_client(db_client, SyntheticCatalogTransport(num_products=200, num_categories=1))
+
+    prices_collection = db_client.prices_collection
+    bulk_write = prices_collection.bulk_write
+    failures = [AutoReconnect("connection dropped")]
+
+    def flaky_bulk_write(*args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return bulk_write(*args, **kwargs)
+
+    monkeypatch.setattr(prices_collection, "bulk_write", flaky_bulk_write)
+    checkpoints = []
+    record_checkpoint = source_client.recency_util.record_category_page_success
+    monkeypatch.setattr(
+        source_client.recency_util,
+        "record_category_page_success",
+        lambda *args: checkpoints.append(args) or record_checkpoint(*args),
+    )
+
+    asyncio.run(source_client.process_all_categories_async())
+
+    counters = db_client.metrics_util.summary()["counters"]
+    assert sum(counters["prices_new"].values()) == 200
+    assert sum(counters.get("prices_unchanged", {}).values()) == 0
+    assert counters["save_failures"]
+    assert prices_collection.count_documents({}) == 200
+    # One checkpoint per page, the failed page is not recorded twice
+    assert len(checkpoints) == 2
+
+
+def test_categories_are_crawled_concurrently(db_client, make_source_client):
+    transport = SlowCatalogTransport(num_products=600, num_categories=3)
+    source_client = make_source_client(db_client, transport)
+
+    asyncio.run(source_client.process_all_categories_async(concurrency=3))
+
+    assert transport.max_in_flight == 3
+    assert db_client.prices_collection.count_documents({}) == 600
+    for category_id in transport.categories:
+        assert source_client.recency_util.get_category_after_cursor(category_id) == RECENCY_CATEGORY_COMPLETE
+
+
+def test_failing_category_does_not_stop_the_others(db_client, make_source_client, monkeypatch):
+    monkeypatch.setattr(rate_limiter_module, "BACKOFF_BASE_SECONDS", 0)
+    transport = SlowCatalogTransport(num_products=600, num_categories=3, failing_categories=[2])
+    source_client = make_source_client(db_client, transport)
+
+    with pytest.raises(ValueError, match="Failed to fetch page"):
+        asyncio.run(source_client.process_all_categories_async(concurrency=3))
+
+    assert db_client.prices_collection.count_documents({}) == 400
+    assert source_client.recency_util.get_category_after_cursor(1) == RECENCY_CATEGORY_COMPLETE
+    assert source_client.recency_util.get_category_after_cursor(2) is None
+    assert source_client.recency_util.get_category_after_cursor(3) == RECENCY_CATEGORY_COMPLETE
+
+
+def test_next_page_is_fetched_while_the_previous_one_is_saved(db_client, make_source_client, monkeypatch):
+    transport = SlowCatalogTransport(num_products=500, num_categories=1)
+    source_client = make_source_client(db_client, transport)
+    pages_fetched = []
+    stage_product_prices = db_client.stage_product_prices
+
+    def slow_stage_product_prices(*args, **kwargs):
+        pages_fetched.append(transport.num_pages)
+        time.sleep(0.05)
+        pages_fetched.append(transport.num_pages)
+        return stage_product_prices(*args, **kwargs)
+
+    monkeypatch.setattr(db_client, "stage_product_prices", slow_stage_product_prices)
+
+    asyncio.run(source_client.process_all_categories_async())
+
+    assert db_client.prices_collection.count_documents({}) == 500
+    # While the first page was being saved, the fetch stage moved on to the pages after it
+    assert pages_fetched[1] > pages_fetched[0]
+
+
+def test_failed_save_stops_fetching_the_category(db_client, make_source_client, monkeypatch):
+    monkeypatch.setattr(source_client_module, "BACKOFF_BASE_SECONDS", 0)
+    transport = SyntheticCatalogTransport(num_products=2000, num_categories=1)
+    source_client = make_source_client(db_client, transport)
+
+    def failing_stage_product_prices(*args, **kwargs):
+        raise AutoReconnect("connection dropped")
+
+    monkeypatch.setattr(db_client, "stage_product_prices", failing_stage_product_prices)
+
+    with pytest.raises(ValueError, match="Failed to save page"):
+        asyncio.run(source_client.process_all_categories_async())
+
+    # Only the pages that fit in the queues between the stages are fetched before the crawl stops
+    assert transport.num_pages <= 2 * PIPELINE_QUEUE_SIZE + 3
+    assert source_client.recency_util.get_category_after_cursor(1) is None
+
+
+def test_stores_share_product_writes_and_keep_their_own_prices(make_db_client, make_source_client):
+    db_client = make_db_client(default_store_id=1)
+    transport = SyntheticCatalogTransport(num_products=300, num_categories=2)
+    source_client = make_source_client(db_client, transport, store_ids=(1, 2))
+
+    asyncio.run(source_client.process_all_categories_async(concurrency=2))
+
+    counters = db_client.metrics_util.summary()["counters"]
+    assert sum(counters["products_changed"].values()) == 300
+    assert db_client.products_collection.count_documents({}) == 300
+    assert db_client.prices_collection.count_documents({"store_id": 1}) == 300
+    assert db_client.prices_collection.count_documents({"store_id": 2}) == 300
+    assert len(db_client.get_price_history(7, 2)) == 1
+    # The first store keeps the checkpoints it had before stores were crawled together
+    recency_util = source_client.recency_util
+    assert recency_util.get_category_after_cursor(1) == RECENCY_CATEGORY_COMPLETE
+    assert recency_util.get_category_after_cursor(1, store_id=1) is None
+    assert recency_util.get_category_after_cursor(1, store_id=2) == RECENCY_CATEGORY_COMPLETE
+
+
+def test_price_only_profile_saves_the_same_prices_from_smaller_pages(
+    make_db_client, make_source_client, working_dir, cache
+):
+    prices_by_profile = {}
+    response_bytes_by_profile = {}
+    for query_profile in (QUERY_PROFILE_FULL, QUERY_PROFILE_PRICES):
+        # Each crawl starts from an empty database, so neither may see the other's price snapshot
+        cache.flushall()
+        db_client = make_db_client(default_store_id=1)
+        recency_util = RecencyUtil(
+            recency_file_path=str(working_dir / f"{query_profile}.journal"), legacy_recency_file_path=None
+        )
+        source_client = make_source_client(
+            db_client,
+            SyntheticCatalogTransport(num_products=200, num_categories=2),
+            recency_util=recency_util,
+            query_profile=query_profile,
+        )
+
+        asyncio.run(source_client.process_all_categories_async())
+
+        prices_by_profile[query_profile] = list(
+            db_client.prices_collection.find(projection={"_id": False, "start_date": False}, sort=[("product_id", 1)])
+        )
+        response_bytes_by_profile[query_profile] = db_client.metrics_util.summary()["counters"]["response_bytes"]
+
+    assert len(prices_by_profile[QUERY_PROFILE_PRICES]) == 200
+    assert prices_by_profile[QUERY_PROFILE_PRICES] == prices_by_profile[QUERY_PROFILE_FULL]
+    # Every page is counted under its category
+    assert set(response_bytes_by_profile[QUERY_PROFILE_PRICES]) == {"1", "2"}
+    assert sum(response_bytes_by_profile[QUERY_PROFILE_PRICES].values()) < (
+        sum(response_bytes_by_profile[QUERY_PROFILE_FULL].values()) / 2
+    )
+
+
+def test_unknown_query_profile_is_rejected(db_client, make_source_client):
+    with pytest.raises(ValueError, match="Unknown query profile"):
+        make_source_client(db_client, SyntheticCatalogTransport(num_products=1, num_categories=1), query_profile="all")
+
+
+class OverlappingCatalogTransport(SyntheticCatalogTransport):
+    """
+    Lists the second half of the first category's products in the second category as well.
+    """
+
+    def _get_product_ids(self, category_id):
+        return list(range((category_id - 1) * 50, (category_id - 1) * 50 + 100))
+
+
+def test_product_in_several_categories_is_saved_once_with_all_of_them(make_db_client, make_source_client):
+    db_client = make_db_client(default_store_id=1)
+    source_client = make_source_client(db_client, OverlappingCatalogTransport(num_products=150, num_categories=2))
+
+    asyncio.run(source_client.process_all_categories_async(concurrency=1))
+
+    assert db_client.prices_collection.count_documents({}) == 150
+    assert sum(db_client.metrics_util.summary()["counters"]["prices_already_saved"].values()) == 50
+    assert db_client.products_collection.find_one({"id": 0})["categories"] == [1]
+    assert db_client.products_collection.find_one({"id": 75})["categories"] == [1, 2]
+    assert db_client.products_collection.find_one({"id": 75})["category"] == 1
+    assert db_client.products_collection.find_one({"id": 125})["categories"] == [2]
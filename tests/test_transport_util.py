@@ -0,0 +1,112 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from gql import Client, gql
+
+from pricehistory.constants import PRICE_PRODUCTS_QUERY, PRODUCTS_QUERY, RESPONSE_BYTES_EXTENSION
+from pricehistory.transport_util import (
+    MeteredAIOHTTPTransport,
+    RecordingAIOHTTPTransport,
+    ReplayTransport,
+    get_fixture_file_name,
+    parse_browse_category_request,
+)
+
+PAGE = {
+    "browseCategory": {
+        "pageTitle": "Fruit",
+        "records": [
+            {
+                "id": "1",
+                "displayName": "Apple",
+                "onAd": True,
+                "SKUs": [
+                    {
+                        "id": "1",
+                        "contextPrices": [
+                            {
+                                "context": "ONLINE",
+                                "isOnSale": False,
+                                "listPrice": {"unit": "each", "formattedAmount": "$1.00"},
+                                "salePrice": None,
+                            }
+                        ],
+                        "customerFriendlySize": "each",
+                    }
+                ],
+            }
+        ],
+        "total": 1,
+        "hasMoreRecords": False,
+        "nextCursor": None,
+        "previousCursor": None,
+    }
+}
+
+
+def test_browse_category_request_is_parsed():
+    assert parse_browse_category_request(gql(PRICE_PRODUCTS_QUERY % ("12", 3, "null"))) == ("12", "3", None)
+    assert parse_browse_category_request(gql(PRODUCTS_QUERY % ("12", 3, '"abc"'))) == ("12", "3", "abc")
+    with pytest.raises(ValueError):
+        parse_browse_category_request(gql("{ categories { id } }"))
+
+
+def test_recorded_responses_are_replayed_with_the_fields_a_query_selects(tmp_path):
+    async def answer(request):
+        return web.json_response({"data": PAGE})
+
+    async def record():
+        app = web.Application()
+        app.router.add_post("/", answer)
+        async with TestServer(app) as server:
+            transport = RecordingAIOHTTPTransport(fixtures_dir=str(tmp_path), url=str(server.make_url("/")))
+            async with Client(transport=transport) as session:
+                return await session.execute(gql(PRODUCTS_QUERY % ("12", 3, "null")), get_execution_result=True)
+
+    async def replay():
+        async with Client(transport=ReplayTransport(fixtures_dir=str(tmp_path))) as session:
+            return await session.execute(gql(PRICE_PRODUCTS_QUERY % ("12", 3, "null")), get_execution_result=True)
+
+    recorded_result = asyncio.run(record())
+    replayed_result = asyncio.run(replay())
+
+    with open(tmp_path / get_fixture_file_name("12", "3", None), encoding="utf-8") as fixture_file:
+        assert json.load(fixture_file) == recorded_result.data == PAGE
+    record = replayed_result.data["browseCategory"]["records"][0]
+    assert record == {
+        "id": "1",
+        "displayName": "Apple",
+        "SKUs": [
+            {
+                "contextPrices": [{"context": "ONLINE", "listPrice": {"formattedAmount": "$1.00"}, "salePrice": None}],
+                "customerFriendlySize": "each",
+            }
+        ],
+    }
+    assert replayed_result.extensions == {
+        RESPONSE_BYTES_EXTENSION: len(json.dumps(replayed_result.data).encode("utf-8"))
+    }
+
+
+def test_metered_transport_reports_the_body_size_before_decoding():
+    # Latin-1 takes one byte for "é" where UTF-8 takes two, and the trailing newline is stripped before decoding
+    body = '{"data": {"name": "Crème brûlée"}}\n'.encode("latin-1")
+
+    async def answer(request):
+        return web.Response(body=body, content_type="application/json", charset="latin-1")
+
+    async def execute():
+        app = web.Application()
+        app.router.add_post("/", answer)
+        async with TestServer(app) as server:
+            transport = MeteredAIOHTTPTransport(url=str(server.make_url("/")))
+            async with Client(transport=transport) as session:
+                return await session.execute(gql("{ name }"), get_execution_result=True)
+
+    result = asyncio.run(execute())
+
+    assert result.data == {"name": "Crème brûlée"}
+    assert result.extensions == {RESPONSE_BYTES_EXTENSION: len(body)}
@@ -0,0 +1,78 @@
+import time
+from datetime import datetime
+
+from pricehistory.work_queue import WorkQueue
+
+
+def test_targets_are_leased_in_order_and_only_once(cache):
+    work_queue = WorkQueue(cache)
+    assert work_queue.enqueue([(1, 1), (1, 2)]) == 2
+    assert work_queue.enqueue([(1, 2), (2, 1)]) == 1
+
+    leases = [work_queue.lease("worker") for _ in range(4)]
+
+    assert [(lease.store_id, lease.category_id) for lease in leases[:3]] == [(1, 1), (1, 2), (2, 1)]
+    assert leases[3] is None
+    assert work_queue.num_items() == 3
+
+
+def test_expired_lease_is_taken_over_and_the_old_owner_is_locked_out(cache):
+    work_queue = WorkQueue(cache, lease_seconds=0.05)
+    work_queue.enqueue([(1, 1)])
+    lease = work_queue.lease("first")
+    assert work_queue.lease("second") is None
+
+    time.sleep(0.1)
+    taken_over_lease = work_queue.lease("second")
+
+    assert taken_over_lease.previous_owner == "first"
+    assert not work_queue.renew(lease, "first")
+    assert not work_queue.complete(lease, "first")
+    assert work_queue.renew(taken_over_lease, "second")
+    assert work_queue.complete(taken_over_lease, "second")
+    assert work_queue.num_items() == 0
+
+
+def test_released_target_can_be_leased_again_after_the_delay(cache):
+    work_queue = WorkQueue(cache)
+    work_queue.enqueue([(1, 1), (1, 2)])
+    delayed_lease = work_queue.lease("worker")
+    lease = work_queue.lease("worker")
+
+    assert not work_queue.release(lease, "other")
+    assert work_queue.release(delayed_lease, "worker", delay_seconds=60)
+    assert work_queue.release(lease, "worker")
+
+    released_lease = work_queue.lease("other")
+    assert (released_lease.category_id, released_lease.previous_owner) == (2, None)
+    assert work_queue.lease("other") is None
+
+
+def test_failing_target_is_given_up_on_after_max_attempts(cache):
+    work_queue = WorkQueue(cache, max_attempts=3)
+    work_queue.start_cycle([(1, 1), (1, 2)])
+
+    attempts = []
+    while (lease := work_queue.lease("worker")) is not None:
+        if lease.category_id == 1:
+            work_queue.complete(lease, "worker")
+            continue
+        attempts.append(lease.attempts)
+        work_queue.fail(lease, "worker")
+
+    assert attempts == [0, 1, 2]
+    assert work_queue.num_items() == 0
+    assert work_queue.get_failed() == [(1, 2)]
+
+
+def test_new_cycle_gives_failed_targets_their_attempts_back(cache):
+    work_queue = WorkQueue(cache, max_attempts=1)
+    work_queue.start_cycle([(1, 1)], start_date=datetime(2024, 1, 1))
+    lease = work_queue.lease("worker")
+    assert not work_queue.fail(lease, "worker")
+
+    assert work_queue.start_cycle([(1, 1)], start_date=datetime(2024, 1, 2)) == 1
+
+    lease = work_queue.lease("worker")
+    assert work_queue.get_failed() == []
+    assert (lease.cycle_id, lease.cycle_start, lease.attempts) == (2, datetime(2024, 1, 2), 0)
@@ -0,0 +1,93 @@
+import pytest
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError
+
+from benchmarks.local_mongo import LocalCollection
+from pricehistory.data.category_document import CategoryDocument
+from pricehistory.write_behind_buffer import WriteBehindBuffer
+from tests.helpers import build_page
+
+
+def test_buffer_is_flushed_once_full_or_old_enough():
+    collection = LocalCollection("prices")
+    write_buffer = WriteBehindBuffer(max_operations=3, max_age_seconds=60)
+
+    for i in range(2):
+        write_buffer.add(collection, InsertOne({"i": i}))
+        assert not write_buffer.flush_if_due()
+    write_buffer.add(collection, InsertOne({"i": 2}))
+    assert write_buffer.flush_if_due()
+    assert collection.count_documents({}) == 3
+
+    write_buffer.add(collection, InsertOne({"i": 3}))
+    write_buffer.max_age_seconds = 0
+    assert write_buffer.flush_if_due()
+    assert collection.count_documents({}) == 4
+
+
+def test_later_write_to_the_same_key_replaces_the_earlier_one():
+    collection = LocalCollection("products")
+    write_buffer = WriteBehindBuffer(max_operations=10)
+
+    write_buffer.add(collection, InsertOne({"id": 1, "name": "Old"}), key=1)
+    write_buffer.add(collection, InsertOne({"id": 2, "name": "Other"}), key=2)
+    write_buffer.add(collection, InsertOne({"id": 1, "name": "New"}), key=1)
+    assert write_buffer.num_operations == 2
+    write_buffer.flush()
+
+    assert [document["name"] for document in collection.find(sort=[("id", 1)])] == ["New", "Other"]
+
+
+def test_callbacks_run_after_the_listeners_once_their_writes_are_in():
+    collection = LocalCollection("prices")
+    write_buffer = WriteBehindBuffer(max_operations=10)
+    events = []
+    write_buffer.add_flush_listener(lambda: events.append("listener"))
+
+    write_buffer.add(collection, InsertOne({"i": 0}))
+    write_buffer.add_after_flush(lambda: events.append(("page", collection.count_documents({}))))
+    assert events == []
+    write_buffer.flush()
+    write_buffer.flush()
+
+    assert events == ["listener", ("page", 1), "listener"]
+
+
+def test_only_failed_writes_are_kept_for_the_next_flush(monkeypatch):
+    collection = LocalCollection("prices")
+    write_buffer = WriteBehindBuffer(max_operations=10)
+    callbacks = []
+    bulk_write = collection.bulk_write
+
+    def partly_failing_bulk_write(operations, **kwargs):
+        bulk_write(operations[:1], **kwargs)
+        raise BulkWriteError({"writeErrors": [{"index": 1, "code": 11000, "errmsg": "duplicate key"}]})
+
+    for i in range(2):
+        write_buffer.add(collection, InsertOne({"i": i}))
+    write_buffer.add_after_flush(lambda: callbacks.append("page"))
+    monkeypatch.setattr(collection, "bulk_write", partly_failing_bulk_write)
+    with pytest.raises(BulkWriteError):
+        write_buffer.flush()
+    monkeypatch.undo()
+
+    assert callbacks == []
+    assert write_buffer.num_operations == 1
+    write_buffer.flush()
+    assert sorted(document["i"] for document in collection.find()) == [0, 1]
+    assert callbacks == ["page"]
+
+
+def test_pages_of_many_categories_share_bulk_writes(make_db_client):
+    db_client = make_db_client(write_buffer_size=1000, default_store_id=1)
+
+    for category_id in range(1, 6):
+        product_ids = range(category_id * 100, category_id * 100 + 100)
+        db_client.save_product_prices(
+            build_page(product_ids, category_id=category_id),
+            CategoryDocument(id=category_id, display_name=f"Category {category_id}"),
+        )
+    db_client.flush_writes()
+
+    assert db_client.prices_collection.count_documents({}) == 500
+    assert db_client.metrics_util.summary()["stages"]["write_buffer_flush"]["total"]["count"] == 1